@@ -0,0 +1,273 @@
+import gzip
+import hashlib
+import json
+import logging
+import math
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Sequence, Tuple
+
+import numpy as np
+
+from columnar import LEVEL_CODES, LEVEL_NAMES, MAGIC
+
+logger = logging.getLogger(__name__)
+
+# Gestione import opzionali - non critici
+BROTLI_AVAILABLE = False
+try:
+    import brotli
+    BROTLI_AVAILABLE = True
+except ImportError:
+    logger.info("brotli non disponibile. Le allerte verranno compresse solo con gzip.")
+
+
+# Tile: sotto questo zoom le allerte vengono aggregate in una griglia di celle per tile
+TILE_CLUSTER_MAX_ZOOM = 10
+TILE_CLUSTER_GRID = 8
+TILE_CACHE_SIZE = 4096
+
+
+def tile_bounds(z: int, x: int, y: int) -> Tuple[float, float, float, float]:
+    "Limiti (ovest, sud, est, nord) in gradi di una tile XYZ Web Mercator."
+    n = 2 ** z
+
+    def lat(row):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / n))))
+
+    return x / n * 360.0 - 180.0, lat(y + 1), (x + 1) / n * 360.0 - 180.0, lat(y)
+
+
+class AlertsIndex:
+    """
+    Indice spaziale delle allerte di un'istantanea: array di latitudine,
+    longitudine, punteggio e livello, più l'ordinamento per latitudine usato
+    per restringere le query bbox con una ricerca binaria.
+    """
+
+    def __init__(self, alerts: Sequence[Dict]):
+        n = len(alerts)
+        self.lat = np.fromiter((a.get('lat', np.nan) for a in alerts), dtype=np.float64, count=n)
+        self.lon = np.fromiter((a.get('lon', np.nan) for a in alerts), dtype=np.float64, count=n)
+        self.score = np.fromiter((a.get('risk_score', 0) for a in alerts), dtype=np.float64, count=n)
+        self.level = np.fromiter((LEVEL_CODES.get(a.get('alert_level'), 0) for a in alerts), dtype=np.int8, count=n)
+        self.by_lat = np.argsort(self.lat, kind='stable')
+        self.sorted_lat = self.lat[self.by_lat]
+
+    def query(self, bbox: Optional[Sequence[float]] = None, levels: Optional[Iterable[str]] = None,
+              min_score: Optional[float] = None) -> np.ndarray:
+        """
+        Indici delle allerte che soddisfano i filtri, nell'ordine dell'istantanea
+        (rischio decrescente). `bbox` è (ovest, sud, est, nord) in gradi.
+        """
+        if bbox is not None:
+            west, south, east, north = bbox
+            lo = np.searchsorted(self.sorted_lat, south, side='left')
+            hi = np.searchsorted(self.sorted_lat, north, side='right')
+            idx = self.by_lat[lo:hi]
+            lon = self.lon[idx]
+            idx = idx[(lon >= west) & (lon <= east)]
+        else:
+            idx = np.arange(len(self.lat))
+
+        if levels is not None:
+            codes = [LEVEL_CODES[level] for level in levels]
+            idx = idx[np.isin(self.level[idx], codes)]
+        if min_score is not None:
+            idx = idx[self.score[idx] >= min_score]
+        if bbox is not None:
+            idx = np.sort(idx)
+        return idx
+
+
+class AlertsSnapshot:
+    """
+    Istantanea in memoria del file delle allerte: JSON compatto, ETag e
+    varianti gzip/brotli calcolati una sola volta per versione del file.
+    """
+
+    mimetype = 'application/json'
+
+    def __init__(self, raw: bytes):
+        self.data = json.loads(raw)
+        self.content_hash = hashlib.sha256(raw).hexdigest()
+        self.body = json.dumps(self.data, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+        self.etag = hashlib.sha256(self.body).hexdigest()[:32]
+        self.encodings = {'gzip': gzip.compress(self.body, compresslevel=6)}
+        if BROTLI_AVAILABLE:
+            # Qualità 5: quasi la stessa compressione di 9 in un terzo del tempo
+            self.encodings['br'] = brotli.compress(self.body, quality=5)
+        self.index = AlertsIndex(self.data.get('alerts', []))
+        self._tiles = OrderedDict()
+        self._tiles_lock = threading.Lock()
+        self._deltas = {}
+
+    @property
+    def version(self) -> Optional[int]:
+        "Versione dell'istantanea assegnata dall'esportatore (None per file senza versione)."
+        return self.data.get('metadata', {}).get('snapshot_version')
+
+    def delta(self, since: int, store) -> Optional[bytes]:
+        """
+        Corpo JSON della differenza tra la versione `since` e questa istantanea,
+        calcolata una volta sola per versione di partenza. None se `since` non è
+        più nello storico di `store` (SnapshotStore).
+        """
+        if since not in self._deltas:
+            delta = store.delta_since(since, self.data)
+            if delta is None:
+                return None
+            delta['summary'] = self.data.get('summary', {})
+            self._deltas[since] = json.dumps(delta, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+        return self._deltas[since]
+
+    def tile(self, z: int, x: int, y: int) -> bytes:
+        """
+        Corpo JSON della tile z/x/y, calcolato alla prima richiesta e poi tenuto
+        in cache (LRU) finché l'istantanea resta quella corrente.
+        """
+        key = (z, x, y)
+        with self._tiles_lock:
+            if key in self._tiles:
+                self._tiles.move_to_end(key)
+                return self._tiles[key]
+
+        body = json.dumps(self._build_tile(z, x, y), separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+        with self._tiles_lock:
+            self._tiles[key] = body
+            while len(self._tiles) > TILE_CACHE_SIZE:
+                self._tiles.popitem(last=False)
+        return body
+
+    def _build_tile(self, z: int, x: int, y: int) -> Dict:
+        "Allerte della tile: aggregate in cluster a zoom bassi, singole a zoom alti."
+        bbox = tile_bounds(z, x, y)
+        idx = self.index.query(bbox)
+        tile = {'z': z, 'x': x, 'y': y, 'bbox': [round(v, 6) for v in bbox]}
+
+        if z > TILE_CLUSTER_MAX_ZOOM:
+            alerts = self.data.get('alerts', [])
+            tile.update(type='alerts', features=[alerts[i] for i in idx])
+            return tile
+
+        west, south, east, north = bbox
+        grid = TILE_CLUSTER_GRID
+        lat, lon = self.index.lat[idx], self.index.lon[idx]
+        col = np.clip(((lon - west) / (east - west) * grid).astype(np.int64), 0, grid - 1)
+        row = np.clip(((north - lat) / (north - south) * grid).astype(np.int64), 0, grid - 1)
+        cell = row * grid + col
+
+        n_cells, n_levels = grid * grid, len(LEVEL_CODES)
+        count = np.bincount(cell, minlength=n_cells)
+        lat_sum = np.bincount(cell, weights=lat, minlength=n_cells)
+        lon_sum = np.bincount(cell, weights=lon, minlength=n_cells)
+        max_risk = np.full(n_cells, -np.inf)
+        np.maximum.at(max_risk, cell, self.index.score[idx])
+        histogram = np.bincount(cell * n_levels + self.index.level[idx],
+                                minlength=n_cells * n_levels).reshape(n_cells, n_levels)
+
+        clusters = []
+        for c in np.flatnonzero(count):
+            levels = {LEVEL_NAMES[k]: int(histogram[c, k]) for k in range(n_levels) if histogram[c, k]}
+            clusters.append({
+                'lat': round(float(lat_sum[c] / count[c]), 4),
+                'lon': round(float(lon_sum[c] / count[c]), 4),
+                'count': int(count[c]),
+                'max_risk': round(float(max_risk[c]), 1),
+                'alert_level': LEVEL_NAMES[int(np.flatnonzero(histogram[c]).max())],
+                'levels': levels
+            })
+        tile.update(type='clusters', features=clusters)
+        return tile
+
+    def filtered(self, bbox=None, levels=None, min_score=None, limit=None, offset: int = 0) -> Dict:
+        """
+        Sottoinsieme dell'istantanea per le query di /api/alerts: stesso schema
+        del file completo, con riepilogo calcolato sulle sole allerte selezionate
+        e un blocco `pagination`.
+        """
+        matches = self.index.query(bbox, levels, min_score)
+        page = matches[offset:offset + limit if limit is not None else None]
+        alerts = self.data.get('alerts', [])
+        page_alerts = [alerts[i] for i in page]
+
+        counts = np.bincount(self.index.level[matches], minlength=len(LEVEL_CODES))
+        return {
+            'metadata': self.data.get('metadata', {}),
+            'summary': {
+                'total': int(len(matches)),
+                'red': int(counts[LEVEL_CODES['ROSSO']]),
+                'orange': int(counts[LEVEL_CODES['ARANCIONE']]),
+                'yellow': int(counts[LEVEL_CODES['GIALLO']]),
+                'green': int(counts[LEVEL_CODES['VERDE']])
+            },
+            'pagination': {
+                'total': int(len(matches)),
+                'offset': offset,
+                'limit': limit,
+                'returned': len(page_alerts)
+            },
+            'alerts': page_alerts,
+            'critical_areas': [a for a in page_alerts if a.get('alert_level') in ('ROSSO', 'ARANCIONE')]
+        }
+
+
+class ColumnarSnapshot:
+    """
+    Istantanea del file binario colonnare (`alerts_data.bin`): il corpo è già
+    compatto, quindi si precalcola solo la variante gzip.
+    """
+
+    mimetype = 'application/octet-stream'
+
+    def __init__(self, raw: bytes):
+        if raw[:len(MAGIC)] != MAGIC:
+            raise ValueError("file colonnare non valido")
+        self.body = raw
+        self.content_hash = hashlib.sha256(raw).hexdigest()
+        self.etag = self.content_hash[:32]
+        self.encodings = {'gzip': gzip.compress(raw, compresslevel=6)}
+
+
+class AlertsCache:
+    """
+    Mantiene l'istantanea corrente di `alerts_data.json` (o del file indicato,
+    con la relativa classe di istantanea). Il file viene riletto solo quando
+    cambiano data di modifica o dimensione, e l'istantanea viene ricostruita
+    solo se cambia anche il contenuto.
+    """
+
+    def __init__(self, alerts_file: Path, snapshot_cls=None):
+        self.alerts_file = Path(alerts_file)
+        self.snapshot_cls = snapshot_cls or AlertsSnapshot
+        self._snapshot = None
+        self._signature = None
+        self._lock = threading.Lock()
+        self.reloads = 0
+
+    def get(self) -> Optional[AlertsSnapshot]:
+        "Istantanea aggiornata, oppure None se il file non esiste."
+        try:
+            stat = self.alerts_file.stat()
+        except FileNotFoundError:
+            return None
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if signature == self._signature:
+            return self._snapshot
+
+        with self._lock:
+            if signature == self._signature:
+                return self._snapshot
+            try:
+                raw = self.alerts_file.read_bytes()
+                content_hash = hashlib.sha256(raw).hexdigest()
+                if self._snapshot is None or content_hash != self._snapshot.content_hash:
+                    self._snapshot = self.snapshot_cls(raw)
+                    self.reloads += 1
+                    logger.info(f"Istantanea {self.alerts_file.name} ricaricata ({len(self._snapshot.body)} byte).")
+                self._signature = signature
+            except (OSError, ValueError) as e:
+                # File in scrittura o non valido: si continua a servire l'istantanea precedente
+                logger.warning(f"Impossibile ricaricare {self.alerts_file.name}: {e}")
+            return self._snapshot
@@ -0,0 +1,214 @@
+import json
+import shutil
+import struct
+import tempfile
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from snapshot_store import atomic_open
+
+# Codici numerici dei livelli di allerta, in ordine crescente di rischio
+# (stesso ordine di ALERT_LEVELS in ml_forecast). Usati dal formato colonnare
+# e dall'indice delle allerte del server (alerts_cache).
+LEVEL_CODES = {'VERDE': 0, 'GIALLO': 1, 'ARANCIONE': 2, 'ROSSO': 3}
+LEVEL_NAMES = list(LEVEL_CODES)
+
+# Formato binario colonnare delle allerte (little endian):
+#   "GRSK" | uint32 versione | uint32 lunghezza header | header JSON (UTF-8) | colonne
+# L'header contiene metadata, summary, numero di allerte, dizionari delle
+# stringhe e per ogni colonna nome, dtype e offset dall'inizio delle colonne
+# (cioè dalla fine dell'header).
+# Ogni colonna è allineata a 8 byte, così il client la legge come typed array
+# (Float32Array, Uint8Array, Uint16Array) senza copie.
+MAGIC = b'GRSK'
+COLUMNAR_FORMAT_VERSION = 1
+_PREAMBLE = struct.Struct('<4sII')
+_ALIGN = 8
+
+# Colonne numeriche: nome nel JSON -> dtype
+NUMERIC_COLUMNS = {
+    'lat': '<f4',
+    'lon': '<f4',
+    'risk_score': '<f4',
+    'precipitation_mm': '<f4'
+}
+# Colonne di stringhe codificate con dizionario
+DICTIONARY_COLUMNS = ('comune', 'provincia', 'alert_color')
+
+
+def _pad(size: int) -> int:
+    return -size % _ALIGN
+
+
+def _index_dtype(n_values: int) -> str:
+    if n_values <= 0xFF:
+        return '<u1'
+    if n_values <= 0xFFFF:
+        return '<u2'
+    return '<u4'
+
+
+def encode_alerts(data: Dict) -> bytes:
+    """
+    Codifica la struttura di `alerts_data.json` (metadata, summary, alerts)
+    nel formato colonnare. L'ordine delle allerte è preservato; `critical_areas`
+    non viene salvato perché si ricava dalle colonne dei livelli.
+    """
+    alerts = data.get('alerts', [])
+    n = len(alerts)
+
+    columns = {}
+    for name, dtype in NUMERIC_COLUMNS.items():
+        columns[name] = np.fromiter((a.get(name, 0) for a in alerts), dtype=dtype, count=n)
+    columns['alert_level'] = np.fromiter(
+        (LEVEL_CODES.get(a.get('alert_level'), 0) for a in alerts), dtype='<u1', count=n)
+
+    dictionaries = {}
+    for name in DICTIONARY_COLUMNS:
+        values, codes = np.unique(np.array([str(a.get(name, '')) for a in alerts], dtype=object),
+                                  return_inverse=True)
+        dictionaries[name] = values.tolist()
+        columns[name] = codes.astype(_index_dtype(len(values)))
+
+    parts = [_preamble_and_header(data.get('metadata', {}), data.get('summary', {}), n, dictionaries,
+                                  [(name, values.dtype.str) for name, values in columns.items()])]
+    for values in columns.values():
+        raw = values.tobytes()
+        parts.append(raw + b'\0' * _pad(len(raw)))
+    return b''.join(parts)
+
+
+def _preamble_and_header(metadata: Dict, summary: Dict, n: int, dictionaries: Dict,
+                         dtypes: Sequence[tuple]) -> bytes:
+    "Preambolo e header JSON (allineato), con gli offset delle colonne indicate (nome, dtype)."
+    layout = []
+    offset = 0
+    for name, dtype in dtypes:
+        layout.append({'name': name, 'dtype': dtype, 'offset': offset})
+        nbytes = n * np.dtype(dtype).itemsize
+        offset += nbytes + _pad(nbytes)
+
+    header = {
+        'metadata': metadata,
+        'summary': summary,
+        'count': n,
+        'levels': LEVEL_NAMES,
+        'dictionaries': dictionaries,
+        'columns': layout
+    }
+    header_bytes = json.dumps(header, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    header_bytes += b' ' * _pad(_PREAMBLE.size + len(header_bytes))
+    return _PREAMBLE.pack(MAGIC, COLUMNAR_FORMAT_VERSION, len(header_bytes)) + header_bytes
+
+
+class ColumnarWriter:
+    """
+    Scrittura incrementale del formato colonnare per l'esportazione in streaming:
+    ogni colonna viene accodata a un file temporaneo e il file finale viene
+    composto alla chiusura, quando numero di allerte e dizionari sono noti.
+    La memoria usata non dipende dal numero di allerte.
+    """
+
+    _COPY_BLOCK = 1 << 20
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.count = 0
+        self._tmp_dir = Path(tempfile.mkdtemp(dir=self.path.parent, prefix=f".{self.path.name}."))
+        names = list(NUMERIC_COLUMNS) + ['alert_level'] + list(DICTIONARY_COLUMNS)
+        self._spools = {name: open(self._tmp_dir / name, 'wb') for name in names}
+        self._dictionaries = {name: {} for name in DICTIONARY_COLUMNS}
+
+    def append(self, alerts: Sequence[Dict]):
+        "Accoda un blocco di allerte (stesso schema di `alerts_data.json`)."
+        n = len(alerts)
+        for name, dtype in NUMERIC_COLUMNS.items():
+            self._spools[name].write(np.fromiter((a.get(name, 0) for a in alerts), dtype=dtype, count=n).tobytes())
+        self._spools['alert_level'].write(np.fromiter(
+            (LEVEL_CODES.get(a.get('alert_level'), 0) for a in alerts), dtype='<u1', count=n).tobytes())
+        for name in DICTIONARY_COLUMNS:
+            codes = self._dictionaries[name]
+            self._spools[name].write(np.fromiter(
+                (codes.setdefault(str(a.get(name, '')), len(codes)) for a in alerts), dtype='<u4', count=n).tobytes())
+        self.count += n
+
+    def close(self, metadata: Dict, summary: Dict):
+        "Compone il file finale (scrittura atomica) e rimuove i file temporanei."
+        try:
+            for spool in self._spools.values():
+                spool.close()
+            # Stessi dtype (np.dtype(...).str, es. '|u1') e dizionari ordinati come
+            # `encode_alerts`: i codici accodati in ordine di arrivo vengono rimappati
+            dtypes = [(name, np.dtype(dtype).str) for name, dtype in NUMERIC_COLUMNS.items()]
+            dtypes.append(('alert_level', np.dtype('<u1').str))
+            dtypes += [(name, np.dtype(_index_dtype(len(self._dictionaries[name]))).str)
+                       for name in DICTIONARY_COLUMNS]
+            dictionaries, remaps = {}, {}
+            for name, codes in self._dictionaries.items():
+                values = sorted(codes)
+                dictionaries[name] = values
+                remaps[name] = np.empty(len(values), dtype=np.uint32)
+                remaps[name][[codes[v] for v in values]] = np.arange(len(values), dtype=np.uint32)
+
+            with atomic_open(self.path) as f:
+                f.write(_preamble_and_header(metadata, summary, self.count, dictionaries, dtypes))
+                for name, dtype in dtypes:
+                    self._copy_column(f, name, dtype, remaps.get(name))
+        finally:
+            self.abort()
+
+    def _copy_column(self, f, name: str, dtype: str, remap: Optional[np.ndarray] = None):
+        spool_dtype = np.dtype('<u4') if name in DICTIONARY_COLUMNS else np.dtype(dtype)
+        step = self._COPY_BLOCK // spool_dtype.itemsize
+        with open(self._tmp_dir / name, 'rb') as src:
+            while True:
+                block = np.fromfile(src, dtype=spool_dtype, count=step)
+                if block.size == 0:
+                    break
+                if remap is not None:
+                    block = remap[block]
+                f.write(block.astype(dtype, copy=False).tobytes())
+        nbytes = self.count * np.dtype(dtype).itemsize
+        f.write(b'\0' * _pad(nbytes))
+
+    def abort(self):
+        "Chiude e rimuove i file temporanei senza scrivere il file finale."
+        for spool in self._spools.values():
+            spool.close()
+        shutil.rmtree(self._tmp_dir, ignore_errors=True)
+
+
+def decode_alerts(raw: bytes) -> Dict:
+    """
+    Decodifica il formato colonnare nella stessa struttura di `alerts_data.json`.
+    I valori float32 vengono riarrotondati alle cifre del JSON.
+    """
+    magic, version, header_len = _PREAMBLE.unpack_from(raw)
+    if magic != MAGIC:
+        raise ValueError("File colonnare delle allerte non valido")
+    if version != COLUMNAR_FORMAT_VERSION:
+        raise ValueError(f"Versione del formato colonnare non supportata: {version}")
+    header = json.loads(raw[_PREAMBLE.size:_PREAMBLE.size + header_len])
+    n = header['count']
+    base = _PREAMBLE.size + header_len
+    columns = {c['name']: np.frombuffer(raw, dtype=c['dtype'], count=n, offset=base + c['offset'])
+               for c in header['columns']}
+
+    decimals = {'lat': 4, 'lon': 4, 'risk_score': 1, 'precipitation_mm': 1}
+    values: Dict[str, List] = {name: np.round(columns[name].astype(np.float64), decimals[name]).tolist()
+                               for name in NUMERIC_COLUMNS}
+    for name in DICTIONARY_COLUMNS:
+        dictionary = header['dictionaries'][name]
+        values[name] = [dictionary[i] for i in columns[name]]
+    values['alert_level'] = [header['levels'][i] for i in columns['alert_level']]
+
+    keys = ['comune', 'provincia', 'lat', 'lon', 'alert_level', 'alert_color', 'risk_score', 'precipitation_mm']
+    alerts = [dict(zip(keys, row)) for row in zip(*(values[k] for k in keys))]
+    return {
+        'metadata': header['metadata'],
+        'summary': header['summary'],
+        'alerts': alerts,
+        'critical_areas': [a for a in alerts if a['alert_level'] in ('ROSSO', 'ARANCIONE')]
+    }
@@ -1,18 +1,29 @@
+import functools
+import heapq
+import itertools
 import json
 import geopandas as gpd
+import numpy as np
+import pandas as pd
+from collections import Counter
 from datetime import datetime
 from pathlib import Path
+from typing import Iterable, List, Tuple
 import logging
 
+from columnar import ColumnarWriter, encode_alerts
+from snapshot_store import SnapshotStore, atomic_open, atomic_write
+
 logger = logging.getLogger(__name__)
 
 
 class DataExporter:
     """Pubblica le predizioni come JSON statico per il frontend."""
     
-    def __init__(self, output_folder: str = "frontend/data"):
+    def __init__(self, output_folder: str = "frontend/data", keep_versions: int = 10):
         self.output_folder = Path(output_folder)
         self.output_folder.mkdir(parents=True, exist_ok=True)
+        self.snapshots = SnapshotStore(self.output_folder / "snapshots", keep=keep_versions)
 
     def export_geodataframe(self, gdf: gpd.GeoDataFrame, layer_title: str = None) -> dict:
         """
@@ -33,84 +44,247 @@ class DataExporter:
         # Prepara i dati
         dati = self._prepare_data(gdf, layer_title)
         
-        # Salva JSON principale
+        # Versione dell'istantanea e differenza con la precedente, salvate prima
+        # del file principale: quando il server lo vede la versione è già nello storico
+        delta = self.snapshots.save(dati)
+        
+        # Salva JSON principale (compatto, scrittura atomica: il server non legge mai un file a metà)
         file_json = self.output_folder / "alerts_data.json"
-        with open(file_json, 'w', encoding='utf-8') as f:
-            json.dump(dati, f, indent=2, ensure_ascii=False)
+        atomic_write(file_json, self._dumps(dati))
         
         # Salva anche GeoJSON per eventuali usi futuri
         file_geojson = self.output_folder / "current_alerts.geojson"
-        gdf.to_file(file_geojson, driver='GeoJSON')
+        atomic_write(file_geojson, self._dumps(self._to_geojson(dati['alerts'], dati['metadata']['timestamp'])))
+        
+        # Stesse allerte in formato binario colonnare, per snapshot grandi
+        file_columnar = self.output_folder / "alerts_data.bin"
+        atomic_write(file_columnar, encode_alerts(dati))
+        
+        logger.info(f"✅ Pubblicazione completata: {len(dati['alerts'])} allerte")
+        
+        return {
+            "successo": True,
+            "timestamp": datetime.now().isoformat(),
+            "numero_allerte": len(dati['alerts']),
+            "versione": dati['metadata']['snapshot_version'],
+            "differenze": {k: len(delta[k]) for k in ('added', 'removed', 'changed')},
+            "files": {
+                "json": str(file_json),
+                "geojson": str(file_geojson),
+                "columnar": str(file_columnar)
+            }
+        }
+
+    def export_stream(self, chunks: Iterable[gpd.GeoDataFrame], layer_title: str = None,
+                      top_k: int = 500) -> dict:
+        """
+        Esportazione in streaming per griglie molto grandi: consuma i blocchi di
+        predizioni uno alla volta e scrive JSON, GeoJSON e formato colonnare in
+        modo incrementale. In memoria restano solo i contatori del riepilogo e
+        le `top_k` aree critiche a rischio più alto.
+        
+        Stesso schema di export_geodataframe, con due differenze: le allerte sono
+        ordinate per rischio solo all'interno di ogni blocco e `critical_areas`
+        contiene al più `top_k` elementi.
+        
+        Come nel percorso batch, l'istantanea entra nello storico prima di
+        sostituire `alerts_data.json`: il JSON viene scritto su un file temporaneo,
+        conservato con la sua versione e solo dopo rinominato sul file principale.
+        """
+        logger.info("Pubblicazione predizioni in streaming...")
+        # Il primo blocco fornisce l'istante della predizione, come gdf.attrs nel percorso batch
+        chunks = iter(chunks)
+        primo = next(chunks, None)
+        timestamp = primo.attrs.get('timestamp') if primo is not None else None
+        if primo is not None:
+            chunks = itertools.chain([primo], chunks)
+        
+        version = self.snapshots.next_version()
+        metadata = self._metadata(layer_title, timestamp)
+        metadata['snapshot_version'] = version
+        
+        file_json = self.output_folder / "alerts_data.json"
+        file_geojson = self.output_folder / "current_alerts.geojson"
+        file_columnar = self.output_folder / "alerts_data.bin"
+        
+        conteggi = Counter()
+        critiche: List[Tuple[float, int, dict]] = []  # min-heap (rischio, progressivo, allerta)
+        totale = 0
+        
+        conserva = functools.partial(self.snapshots.save_file, version)
+        with atomic_open(file_json, before_replace=conserva) as f_json, atomic_open(file_geojson) as f_geojson:
+            columnar = ColumnarWriter(file_columnar)
+            try:
+                f_json.write(b'{"metadata":' + self._dumps(metadata) + b',"alerts":[')
+                f_geojson.write(b'{"type":"FeatureCollection","features":[')
+                
+                for chunk in chunks:
+                    allerte, _ = self._alert_records(chunk)
+                    if not allerte:
+                        continue
+                    separatore = b',' if totale else b''
+                    f_json.write(separatore + b','.join(self._dumps(a) for a in allerte))
+                    f_geojson.write(separatore + b','.join(
+                        self._dumps(self._feature(a, metadata['timestamp'])) for a in allerte))
+                    columnar.append(allerte)
+                    
+                    for a in allerte:
+                        conteggi[a['alert_level']] += 1
+                        if a['alert_level'] in ('ROSSO', 'ARANCIONE'):
+                            voce = (a['risk_score'], totale, a)
+                            if len(critiche) < top_k:
+                                heapq.heappush(critiche, voce)
+                            elif voce[0] > critiche[0][0]:
+                                heapq.heapreplace(critiche, voce)
+                        totale += 1
+                
+                summary = self._summary(totale, conteggi)
+                critical_areas = [a for _, _, a in sorted(critiche, key=lambda v: (-v[0], v[1]))]
+                f_json.write(b'],"summary":' + self._dumps(summary)
+                             + b',"critical_areas":' + self._dumps(critical_areas) + b'}')
+                f_geojson.write(b']}')
+                columnar.close(metadata, summary)
+            except BaseException:
+                columnar.abort()
+                raise
         
-        logger.info(f"✅ Pubblicazione completata: {len(gdf)} allerte")
+        logger.info(f"✅ Pubblicazione in streaming completata: {totale} allerte")
         
         return {
             "successo": True,
             "timestamp": datetime.now().isoformat(),
-            "numero_allerte": len(gdf),
+            "numero_allerte": totale,
+            "versione": version,
             "files": {
                 "json": str(file_json),
-                "geojson": str(file_geojson)
+                "geojson": str(file_geojson),
+                "columnar": str(file_columnar)
             }
         }
 
+    @staticmethod
+    def _dumps(data: dict) -> bytes:
+        return json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+    @staticmethod
+    def _column(gdf: gpd.GeoDataFrame, name: str, default):
+        """Colonna come array, con il valore di default per colonna assente o valori mancanti."""
+        if name not in gdf.columns:
+            return np.full(len(gdf), default, dtype=object if isinstance(default, str) else np.float64)
+        values = gdf[name]
+        categorical = isinstance(values.dtype, pd.CategoricalDtype)
+        if isinstance(default, str):
+            if categorical:
+                # Si convertono solo le categorie; il codice -1 (mancante) prende il default
+                labels = np.append(values.cat.categories.astype(str).to_numpy(dtype=object), default)
+                return labels[values.cat.codes.to_numpy()]
+            return values.astype(object).where(values.notna(), default).astype(str).to_numpy()
+        if categorical:
+            values = values.astype(object)
+        return pd.to_numeric(values, errors='coerce').fillna(default).to_numpy(dtype=np.float64)
+
     def _prepare_data(self, gdf: gpd.GeoDataFrame, title: str) -> dict:
-        """Prepara struttura dati per il frontend."""
+        """Prepara struttura dati per il frontend, lavorando per colonne."""
         
         if gdf.empty:
             return self._get_empty_data_structure(title)
         
-        # Conta allerte per livello
-        conteggi = gdf['alert_level'].value_counts()
+        allerte, levels = self._alert_records(gdf)
         
-        # Prepara lista allerte
-        allerte = []
-        for _, riga in gdf.iterrows():
-            try:
-                lon, lat = riga.geometry.x, riga.geometry.y
-                allerte.append({
-                    "comune": str(riga.get('comune', 'N/A')),
-                    "provincia": str(riga.get('provincia', 'N/A')),
-                    "lat": round(float(lat), 4),
-                    "lon": round(float(lon), 4),
-                    "alert_level": str(riga.get('alert_level', 'VERDE')),
-                    "alert_color": str(riga.get('alert_color', '#26de81')),
-                    "risk_score": round(float(riga.get('risk_score', 0)), 1),
-                    "precipitation_mm": round(float(riga.get('precipitation_mm', 0)), 1)
-                })
-            except Exception as e:
-                logger.warning(f"Errore riga: {e}")
-                continue
-        
-        # Ordina per rischio decrescente
-        allerte.sort(key=lambda x: x["risk_score"], reverse=True)
+        # Conta allerte per livello
+        conteggi = pd.Series(levels).value_counts()
         
         return {
-            "metadata": {
-                "title": title or "Georisk Sentinel Lombardia",
-                "timestamp": datetime.now().isoformat(),
-                "version": "2.0.0"
-            },
-            "summary": {
-                "total": len(allerte),
-                "red": int(conteggi.get("ROSSO", 0)),
-                "orange": int(conteggi.get("ARANCIONE", 0)),
-                "yellow": int(conteggi.get("GIALLO", 0)),
-                "green": int(conteggi.get("VERDE", 0))
-            },
+            "metadata": self._metadata(title, gdf.attrs.get('timestamp')),
+            "summary": self._summary(len(allerte), conteggi),
             "alerts": allerte,
             "critical_areas": [a for a in allerte if a['alert_level'] in ['ROSSO', 'ARANCIONE']]
         }
+
+    def _alert_records(self, gdf: gpd.GeoDataFrame) -> Tuple[list, np.ndarray]:
+        """Allerte del GeoDataFrame ordinate per rischio decrescente, e i relativi livelli."""
+        if gdf.empty:
+            return [], np.array([], dtype=object)
+        
+        # Solo geometrie puntuali valide
+        valid = (gdf.geometry.notna() & ~gdf.geometry.is_empty & (gdf.geometry.geom_type == 'Point')).to_numpy()
+        gdf = gdf[valid]
+        if len(gdf) < len(valid):
+            logger.warning(f"Scartate {len(valid) - len(gdf)} righe con geometria non valida.")
+        
+        lon = np.round(gdf.geometry.x.to_numpy(dtype=np.float64), 4)
+        lat = np.round(gdf.geometry.y.to_numpy(dtype=np.float64), 4)
+        risk = np.round(self._column(gdf, 'risk_score', 0.0), 1)
+        precip = np.round(self._column(gdf, 'precipitation_mm', 0.0), 1)
+        levels = self._column(gdf, 'alert_level', 'VERDE')
+        
+        # Ordina per rischio decrescente (stabile, come il sort di Python)
+        order = np.argsort(-risk, kind='stable')
+        columns = {
+            "comune": self._column(gdf, 'comune', 'N/A')[order].tolist(),
+            "provincia": self._column(gdf, 'provincia', 'N/A')[order].tolist(),
+            "lat": lat[order].tolist(),
+            "lon": lon[order].tolist(),
+            "alert_level": levels[order].tolist(),
+            "alert_color": self._column(gdf, 'alert_color', '#26de81')[order].tolist(),
+            "risk_score": risk[order].tolist(),
+            "precipitation_mm": precip[order].tolist()
+        }
+        keys = list(columns)
+        allerte = [dict(zip(keys, row)) for row in zip(*columns.values())]
+        return allerte, levels
+
+    @staticmethod
+    def _metadata(title: str, timestamp: str = None) -> dict:
+        "Metadati dell'istantanea; `timestamp` è l'istante della predizione, se noto."
+        return {
+            "title": title or "Georisk Sentinel Lombardia",
+            "timestamp": timestamp or datetime.now().isoformat(),
+            "version": "2.0.0"
+        }
+
+    @staticmethod
+    def _summary(total: int, conteggi) -> dict:
+        return {
+            "total": total,
+            "red": int(conteggi.get("ROSSO", 0)),
+            "orange": int(conteggi.get("ARANCIONE", 0)),
+            "yellow": int(conteggi.get("GIALLO", 0)),
+            "green": int(conteggi.get("VERDE", 0))
+        }
+
+    @staticmethod
+    def _feature(alert: dict, timestamp: str) -> dict:
+        """
+        Feature GeoJSON puntuale (EPSG:4326) con le proprietà delle colonne delle
+        predizioni, come scritte in precedenza da `gdf.to_file`: coordinate in
+        `latitude`/`longitude` e istante della predizione su ogni feature.
+        """
+        return {
+            "type": "Feature",
+            "properties": {
+                "latitude": alert['lat'],
+                "longitude": alert['lon'],
+                "risk_score": alert['risk_score'],
+                "alert_level": alert['alert_level'],
+                "comune": alert['comune'],
+                "provincia": alert['provincia'],
+                "alert_color": alert['alert_color'],
+                "precipitation_mm": alert['precipitation_mm'],
+                "timestamp": timestamp
+            },
+            "geometry": {"type": "Point", "coordinates": [alert['lon'], alert['lat']]}
+        }
+
+    def _to_geojson(self, allerte: list, timestamp: str) -> dict:
+        """FeatureCollection di punti delle allerte, con l'istante della predizione."""
+        return {"type": "FeatureCollection", "features": [self._feature(a, timestamp) for a in allerte]}
     
     def _get_empty_data_structure(self, title: str) -> dict:
         """Struttura dati vuota ma valida."""
         return {
-            "metadata": {
-                "title": title or "Georisk Sentinel Lombardia",
-                "timestamp": datetime.now().isoformat(),
-                "version": "2.0.0"
-            },
-            "summary": {"total": 0, "red": 0, "orange": 0, "yellow": 0, "green": 0},
+            "metadata": self._metadata(title),
+            "summary": self._summary(0, {}),
             "alerts": [],
             "critical_areas": []
         }
\ No newline at end of file
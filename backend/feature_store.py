@@ -0,0 +1,118 @@
+import hashlib
+import json
+import logging
+from pathlib import Path
+from typing import Callable, Dict, Optional
+
+import numpy as np
+
+import metrics
+from snapshot_store import atomic_open, atomic_write
+
+logger = logging.getLogger(__name__)
+
+# Da incrementare quando cambia la definizione delle feature del terreno
+STORE_FORMAT_VERSION = 1
+
+
+class StaticFeatureStore:
+    """
+    Archivio su disco (.npz) delle feature statiche del terreno per la griglia
+    di predizione. Il file è identificato da un hash di DEM, raggio del buffer,
+    limiti, risoluzione e tipo della griglia (punti a partire dai limiti o
+    centri delle celle): se uno di questi cambia viene ricostruito.
+    """
+
+    def __init__(self, store_dir: str = "data/processed/static_features"):
+        self.store_dir = Path(store_dir)
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+
+    def _file_digest(self, file_path: Path) -> str:
+        """
+        SHA-256 del contenuto del file. Il risultato viene memorizzato insieme a
+        dimensione e data di modifica per non rileggere il DEM a ogni esecuzione.
+        """
+        stat = file_path.stat()
+        signature = [str(file_path.resolve()), stat.st_size, stat.st_mtime_ns]
+        digest_file = self.store_dir / "dem_digest.json"
+        if digest_file.exists():
+            try:
+                with open(digest_file, 'r', encoding='utf-8') as f:
+                    saved = json.load(f)
+                if saved.get('signature') == signature:
+                    return saved['sha256']
+            except (OSError, json.JSONDecodeError, KeyError):
+                pass
+
+        sha = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+        digest = sha.hexdigest()
+        atomic_write(digest_file, json.dumps({'signature': signature, 'sha256': digest}).encode('utf-8'))
+        return digest
+
+    def key(self, dem_path: str, buffer_radius_m: float, bounds: Dict, resolution_deg: float,
+            cell_centers: bool = False) -> str:
+        "Chiave dell'archivio per la combinazione di input indicata."
+        payload = {
+            'version': STORE_FORMAT_VERSION,
+            'dem_sha256': self._file_digest(Path(dem_path)),
+            'buffer_radius_m': float(buffer_radius_m),
+            'bounds': {k: float(bounds[k]) for k in sorted(bounds)},
+            'resolution_deg': float(resolution_deg)
+        }
+        if cell_centers:
+            payload['cell_centers'] = True
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()[:20]
+
+    def _path(self, key: str) -> Path:
+        return self.store_dir / f"static_features_{key}.npz"
+
+    def load(self, key: str, n_points: int) -> Optional[Dict[str, np.ndarray]]:
+        "Carica le feature salvate per la chiave, se presenti e coerenti con la griglia."
+        path = self._path(key)
+        if not path.exists():
+            return None
+        try:
+            with np.load(path) as data:
+                features = {name: data[name] for name in data.files}
+        except (OSError, ValueError) as e:
+            logger.warning(f"Archivio feature statiche non leggibile ({e}). Verrà ricostruito.")
+            return None
+        if any(len(values) != n_points for values in features.values()):
+            logger.warning("Archivio feature statiche non coerente con la griglia. Verrà ricostruito.")
+            return None
+        return features
+
+    def save(self, key: str, features: Dict[str, np.ndarray]):
+        "Salva le feature (scrittura atomica) ed elimina gli archivi di chiavi precedenti."
+        path = self._path(key)
+        with atomic_open(path) as f:
+            np.savez(f, **features)
+        for old in self.store_dir.glob("static_features_*.npz"):
+            if old != path:
+                old.unlink(missing_ok=True)
+        logger.info(f"Feature statiche salvate in {path}")
+
+    def load_or_build(self, dem_path: str, buffer_radius_m: float, bounds: Dict, resolution_deg: float,
+                      lats: np.ndarray, lons: np.ndarray,
+                      builder: Callable[[np.ndarray, np.ndarray], Dict[str, np.ndarray]],
+                      cell_centers: bool = False) -> Dict[str, np.ndarray]:
+        """
+        Restituisce le feature statiche della griglia, calcolandole con `builder`
+        solo se l'archivio manca o è stato generato da input diversi.
+        """
+        key = self.key(dem_path, buffer_radius_m, bounds, resolution_deg, cell_centers)
+        features = self.load(key, len(lats))
+        if features is not None:
+            metrics.incr('static_features_cache_hits')
+            logger.info(f"Feature statiche caricate dall'archivio ({len(lats)} celle).")
+            return features
+
+        metrics.incr('static_features_cache_misses')
+
+        logger.info(f"Calcolo feature statiche per {len(lats)} celle della griglia...")
+        features = {name: np.asarray(values, dtype=np.float32) for name, values in builder(lats, lons).items()}
+        self.save(key, features)
+        return features
@@ -0,0 +1,195 @@
+import json
+import logging
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence
+
+from snapshot_store import atomic_write
+
+logger = logging.getLogger(__name__)
+
+# Contatori del processo, incrementati dai moduli del pipeline (meteo, DEM, cache)
+_counters = Counter()
+_counters_lock = threading.Lock()
+
+# Descrizione dei contatori noti, usata per il report e per /metrics
+COUNTER_HELP = {
+    'dem_reads': "Letture del raster DEM",
+    'dem_points_sampled': "Punti campionati dal DEM",
+    'weather_api_calls': "Richieste HTTP all'API meteo, tentativi inclusi",
+    'weather_api_failures': "Richieste all'API meteo fallite",
+    'weather_cache_hits': "Località servite dalla cache meteo",
+    'weather_cache_misses': "Località non presenti nella cache meteo",
+    'static_features_cache_hits': "Griglie con feature statiche lette dall'archivio",
+    'static_features_cache_misses': "Griglie con feature statiche ricalcolate",
+    'points_scored': "Punti valutati dal modello",
+    'alerts_exported': "Allerte esportate"
+}
+
+
+def incr(name: str, amount: int = 1):
+    "Incrementa il contatore `name` del processo."
+    if amount:
+        with _counters_lock:
+            _counters[name] += int(amount)
+
+
+def counters() -> Dict[str, int]:
+    "Valori correnti dei contatori del processo."
+    with _counters_lock:
+        return dict(_counters)
+
+
+class RunMetrics:
+    """
+    Metriche di un'esecuzione del pipeline: durata di ogni fase e variazione
+    dei contatori del processo durante la fase. Il report viene salvato come
+    JSON accanto ai dati esportati.
+    """
+
+    def __init__(self):
+        self.started_at = datetime.now()
+        self._start = time.perf_counter()
+        self._baseline = counters()
+        self.phases: List[Dict] = []
+        self.status = 'running'
+        self.error: Optional[str] = None
+
+    @staticmethod
+    def _delta(before: Dict[str, int], after: Dict[str, int]) -> Dict[str, int]:
+        return {name: value - before.get(name, 0) for name, value in sorted(after.items())
+                if value != before.get(name, 0)}
+
+    @contextmanager
+    def phase(self, name: str):
+        "Misura la fase `name`: durata, esito e contatori incrementati nel frattempo."
+        before = counters()
+        start = time.perf_counter()
+        record = {'name': name, 'status': 'ok'}
+        try:
+            yield record
+        except BaseException:
+            record['status'] = 'failed'
+            raise
+        finally:
+            record['duration_s'] = round(time.perf_counter() - start, 4)
+            record['counters'] = self._delta(before, counters())
+            self.phases.append(record)
+
+    def finish(self, error: Optional[BaseException] = None):
+        "Chiude l'esecuzione, con l'eventuale errore che l'ha interrotta."
+        self.status = 'failed' if error is not None else 'ok'
+        self.error = str(error) if error is not None else None
+
+    def to_dict(self) -> Dict:
+        return {
+            'started_at': self.started_at.isoformat(),
+            'finished_at': datetime.now().isoformat(),
+            'status': self.status,
+            'error': self.error,
+            'duration_s': round(time.perf_counter() - self._start, 4),
+            'phases': self.phases,
+            'counters': self._delta(self._baseline, counters())
+        }
+
+    def save(self, path: Path) -> Dict:
+        "Scrive il report JSON (scrittura atomica) e lo restituisce."
+        report = self.to_dict()
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        atomic_write(path, json.dumps(report, indent=2, ensure_ascii=False).encode('utf-8'))
+        logger.info(f"Report dell'esecuzione salvato in {path} ({report['duration_s']:.1f}s).")
+        return report
+
+
+class Histogram:
+    """
+    Istogramma cumulativo in stile Prometheus (bucket `le`, somma e conteggio),
+    con un insieme di bucket per ogni combinazione di etichette. Thread-safe.
+    """
+
+    DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+    def __init__(self, name: str, help_text: str, label_names: Sequence[str] = (),
+                 buckets: Iterable[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[tuple, Dict] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.label_names)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {'counts': [0] * (len(self.buckets) + 1), 'sum': 0.0}
+            series['counts'][index] += 1
+            series['sum'] += value
+
+    def render(self) -> List[str]:
+        "Righe del formato di testo Prometheus."
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {key: (list(s['counts']), s['sum']) for key, s in sorted(self._series.items())}
+        for key, (counts, total) in series.items():
+            labels = [f'{name}="{_escape(value)}"' for name, value in zip(self.label_names, key)]
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                bucket_labels = ','.join(labels + ['le="%s"' % le])
+                lines.append(f"{self.name}_bucket{{{bucket_labels}}} {cumulative}")
+            suffix = f"{{{','.join(labels)}}}" if labels else ''
+            lines.append(f"{self.name}_sum{suffix} {total:.6f}")
+            lines.append(f"{self.name}_count{suffix} {cumulative}")
+        return lines
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def render_run_report(report: Optional[Dict], prefix: str = 'georisk_run') -> List[str]:
+    """
+    Righe Prometheus (gauge) dell'ultimo report del pipeline: esito, durata
+    totale e per fase, contatori dell'esecuzione.
+    """
+    if not report:
+        return []
+    lines = [
+        f"# HELP {prefix}_success Esito dell'ultima esecuzione del pipeline (1 = completata)",
+        f"# TYPE {prefix}_success gauge",
+        f"{prefix}_success {1 if report.get('status') == 'ok' else 0}"
+    ]
+    try:
+        finished = datetime.fromisoformat(report['finished_at']).timestamp()
+        lines += [f"# HELP {prefix}_timestamp_seconds Fine dell'ultima esecuzione del pipeline (epoch)",
+                  f"# TYPE {prefix}_timestamp_seconds gauge",
+                  f"{prefix}_timestamp_seconds {finished:.3f}"]
+    except (KeyError, TypeError, ValueError):
+        pass
+
+    lines += [f"# HELP {prefix}_duration_seconds Durata dell'ultima esecuzione del pipeline",
+              f"# TYPE {prefix}_duration_seconds gauge",
+              f"{prefix}_duration_seconds {float(report.get('duration_s', 0)):.4f}",
+              f"# HELP {prefix}_phase_duration_seconds Durata delle fasi dell'ultima esecuzione",
+              f"# TYPE {prefix}_phase_duration_seconds gauge"]
+    for phase in report.get('phases', []):
+        lines.append(f'{prefix}_phase_duration_seconds{{phase="{_escape(phase["name"])}"}} '
+                     f'{float(phase.get("duration_s", 0)):.4f}')
+
+    run_counters = report.get('counters', {})
+    for name in sorted(set(COUNTER_HELP) | set(run_counters)):
+        metric = f"{prefix}_{name}"
+        lines += [f"# HELP {metric} {COUNTER_HELP.get(name, name)} (ultima esecuzione)",
+                  f"# TYPE {metric} gauge",
+                  f"{metric} {int(run_counters.get(name, 0))}"]
+    return lines
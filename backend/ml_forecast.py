@@ -1,8 +1,12 @@
 import warnings
+import hashlib
 import logging
 import json
-from datetime import datetime, timedelta
-from typing import Dict, List, Tuple, Optional
+import mmap
+import shutil
+from datetime import datetime
+from typing import Dict, Iterator, List, Tuple, Optional
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 import joblib
@@ -10,30 +14,23 @@ import numpy as np
 import pandas as pd
 import geopandas as gpd
 import rasterio
-from rasterio.mask import mask
-import requests
+import rasterio.warp
 import xgboost as xgb
 from scipy import ndimage
-from shapely.geometry import Point, mapping
+from shapely.geometry import Point
 from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import StandardScaler
 from sklearn.metrics import r2_score, mean_squared_error, mean_absolute_error
 
+import metrics
+from weather_client import WeatherFeatureCache, WeatherFetchEngine
+
 # configurazione logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 warnings.filterwarnings('ignore', category=UserWarning, module='geopandas')
 
 # Gestione import opzionali - non critici
-CACHE_AVAILABLE = False
-try:
-    import requests_cache
-    requests_cache.install_cache('georisk_api_cache', backend='sqlite', expire_after=3600)
-    CACHE_AVAILABLE = True
-    logger.info("Cache delle richieste API attivata (dati salvati per 1 ora).")
-except ImportError:
-    logger.info("requests_cache non disponibile. Cache disabilitata (non è un problema).")
-
 PYDANTIC_AVAILABLE = False
 try:
     from pydantic import BaseModel, Field
@@ -55,137 +52,430 @@ except ImportError:
     logger.info("Validazione dati disabilitata")
 
 
+OPEN_METEO_URL = "https://api.open-meteo.com/v1/forecast"
+
+# Ordine delle colonne della matrice delle features
+FEATURE_NAMES = [
+    'elevation_mean', 'elevation_std', 'slope_mean', 'roughness',
+    'precip_1d_past', 'precip_3d_past', 'precip_7d_past', 'precip_3d_forecast',
+    'month', 'day_of_year', 'latitude', 'longitude'
+]
+
+# Versione del formato della directory del modello (vedi RiskPredictor.save_model)
+MODEL_FORMAT_VERSION = 1
+
+# Livelli di allerta in ordine crescente di rischio e soglie minime di default
+ALERT_LEVELS = ['VERDE', 'GIALLO', 'ARANCIONE', 'ROSSO']
+DEFAULT_ALERT_THRESHOLDS = {'GIALLO': 30, 'ARANCIONE': 50, 'ROSSO': 70}
+
+# Valori usati quando i dati meteo di una località non sono disponibili
+WEATHER_FALLBACK = {
+    'precip_1d_past': 5.0,
+    'precip_3d_past': 15.0,
+    'precip_7d_past': 30.0,
+    'precip_3d_forecast': 10.0
+}
+
+
+class TerrainSampler:
+    """
+    Campionatore del terreno in memoria: legge il DEM una sola volta, precalcola
+    i raster di quota, pendenza e rugosità e restituisce le statistiche nel buffer
+    di ogni punto con indicizzazione vettoriale delle finestre.
+
+    Definizioni delle feature (pixel validi toccati dal buffer):
+      - elevation_mean / elevation_std: media e deviazione standard della quota,
+        come con `rasterio.mask(all_touched=True)`. Il cerchio è calcolato in metri
+        locali (gradi scalati alla latitudine) invece che in UTM 32N: cambiano al più
+        alcuni pixel di bordo (nei test: entro 3 m sulla media e 5 m sulla deviazione).
+      - slope_mean: media del modulo del gradiente 2D del raster (`np.gradient`
+        su righe e colonne), in metri di quota per pixel.
+      - roughness: deviazione standard dello scarto tra la quota e la sua media
+        mobile 3x3 (normalizzata per ignorare i nodata).
+    Pendenza e rugosità sono nuove definizioni: l'estrazione per-punto originale
+    applicava `np.gradient` e il filtro 3x3 all'array 1D dei pixel mascherati
+    (l'unpacking `dy, dx` sollevava ValueError) e ricadeva sempre nel fallback.
+    """
+
+    MIN_PIXELS = 10          # stessa soglia minima dell'estrazione per-punto
+    MAX_CHUNK_CELLS = 250_000    # limita la memoria della matrice punti x finestra
+
+    def __init__(self, dem_path: str, buffer_radius_m: float = 500):
+        self.dem_path = Path(dem_path)
+        self.buffer_radius_m = float(buffer_radius_m)
+
+        with rasterio.open(self.dem_path) as dem:
+            elevation = dem.read(1, masked=True).astype(np.float64).filled(np.nan)
+            self.transform = dem.transform
+            self.crs = dem.crs
+        metrics.incr('dem_reads')
+        self.height, self.width = elevation.shape
+
+        valid = np.isfinite(elevation)
+        dy, dx = np.gradient(elevation)
+        self.elevation = elevation
+        self.slope = np.sqrt(dx**2 + dy**2)
+
+        # Rugosità: scarto dalla media mobile 3x3 (normalizzata per ignorare i nodata)
+        filled = np.where(valid, elevation, 0.0)
+        weights = ndimage.uniform_filter(valid.astype(np.float64), size=3)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            smoothed = ndimage.uniform_filter(filled, size=3) / weights
+        self.residual = elevation - smoothed
+
+        self._is_geographic = self.crs is None or self.crs.is_geographic
+        logger.info(f"DEM caricato in memoria: {self.dem_path.name} ({self.width}x{self.height} pixel)")
+
+    def _to_pixel(self, lats: np.ndarray, lons: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        "Converte lat/lon in coordinate pixel frazionarie (colonna, riga)."
+        xs, ys = lons, lats
+        if self.crs is not None and self.crs.to_epsg() != 4326:
+            xs, ys = rasterio.warp.transform('EPSG:4326', self.crs, lons, lats)
+            xs, ys = np.asarray(xs), np.asarray(ys)
+        cols, rows = ~self.transform * (xs, ys)
+        return np.asarray(cols, dtype=np.float64), np.asarray(rows, dtype=np.float64)
+
+    def _pixel_size_m(self, lats: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        "Dimensione dei pixel in metri alla latitudine di ogni punto."
+        px_w, px_h = abs(self.transform.a), abs(self.transform.e)
+        if self._is_geographic:
+            px_w_m = px_w * 111_320.0 * np.cos(np.radians(lats))
+            px_h_m = np.full_like(lats, px_h * 110_574.0)
+        else:
+            px_w_m = np.full_like(lats, px_w)
+            px_h_m = np.full_like(lats, px_h)
+        return px_w_m, px_h_m
+
+    def sample(self, lats, lons) -> Dict[str, np.ndarray]:
+        """
+        Calcola le feature del terreno per un array di punti.
+
+        I pixel inclusi sono quelli toccati dal cerchio di raggio `buffer_radius_m`
+        (equivalente di `all_touched=True`). I punti con meno di MIN_PIXELS pixel
+        validi restituiscono NaN, da sostituire con il fallback del chiamante.
+        """
+        lats = np.atleast_1d(np.asarray(lats, dtype=np.float64))
+        lons = np.atleast_1d(np.asarray(lons, dtype=np.float64))
+        n = lats.size
+        metrics.incr('dem_points_sampled', n)
+        out = {name: np.full(n, np.nan) for name in ('elevation_mean', 'elevation_std', 'slope_mean', 'roughness')}
+        if n == 0:
+            return out
+
+        cols_f, rows_f = self._to_pixel(lats, lons)
+        px_w_m, px_h_m = self._pixel_size_m(lats)
+
+        # Finestra comune a tutti i punti, dimensionata sul pixel più piccolo
+        r = self.buffer_radius_m
+        kx = int(np.ceil(r / np.nanmin(px_w_m))) + 1
+        ky = int(np.ceil(r / np.nanmin(px_h_m))) + 1
+        off_y, off_x = np.mgrid[-ky:ky + 1, -kx:kx + 1]
+        off_y, off_x = off_y.ravel(), off_x.ravel()
+        chunk = max(1, self.MAX_CHUNK_CELLS // off_x.size)
+
+        for start in range(0, n, chunk):
+            sl = slice(start, min(start + chunk, n))
+            row0 = np.floor(rows_f[sl]).astype(np.int64)
+            col0 = np.floor(cols_f[sl]).astype(np.int64)
+            fy = (rows_f[sl] - row0)[:, None]
+            fx = (cols_f[sl] - col0)[:, None]
+
+            # Distanza minima punto-pixel in metri (pixel "toccato" dal cerchio)
+            lo_x = (off_x[None, :] - fx) * px_w_m[sl, None]
+            lo_y = (off_y[None, :] - fy) * px_h_m[sl, None]
+            dist_x = np.maximum(np.maximum(lo_x, 0.0), -(lo_x + px_w_m[sl, None]))
+            dist_y = np.maximum(np.maximum(lo_y, 0.0), -(lo_y + px_h_m[sl, None]))
+            touched = dist_x**2 + dist_y**2 <= r**2
+
+            rows = row0[:, None] + off_y[None, :]
+            cols = col0[:, None] + off_x[None, :]
+            inside = (rows >= 0) & (rows < self.height) & (cols >= 0) & (cols < self.width)
+            rows = np.clip(rows, 0, self.height - 1)
+            cols = np.clip(cols, 0, self.width - 1)
+
+            elev = self.elevation[rows, cols]
+            mask = touched & inside & np.isfinite(elev)
+            count = mask.sum(axis=1)
+            enough = count >= self.MIN_PIXELS
+            denom = np.maximum(count, 1)
+
+            def _mean(values):
+                return np.where(mask, values, 0.0).sum(axis=1) / denom
+
+            def _std(values, mean):
+                return np.sqrt(np.where(mask, (values - mean[:, None])**2, 0.0).sum(axis=1) / denom)
+
+            with np.errstate(invalid='ignore'):
+                slope = np.nan_to_num(self.slope[rows, cols])
+                residual = np.nan_to_num(self.residual[rows, cols])
+                elev_mean = _mean(elev)
+                res_mean = _mean(residual)
+                stats = {
+                    'elevation_mean': elev_mean,
+                    'elevation_std': _std(elev, elev_mean),
+                    'slope_mean': _mean(slope),
+                    'roughness': _std(residual, res_mean),
+                }
+            for name, values in stats.items():
+                out[name][sl] = np.where(enough, values, np.nan)
+
+        return out
+
+
 class FeatureEngineering:
     "estrazione feature e feature engineering"
     
     def __init__(self, config: Dict, dem_path: Optional[str] = None):
         self.config = config.get('feature_engineering', {})
         self.dem_path = Path(dem_path) if dem_path else None
-        
-    def extract_terrain_features(self, geometry: Point) -> Dict:
-        "Estrae features del terreno da un DEM"
-        buffer_radius_m = self.config.get('terrain_buffer_radius_m', 500)
-        
-        if self.dem_path and self.dem_path.exists():
+        self._terrain_sampler = None
+        self.weather_engine = WeatherFetchEngine.from_config(self.config.get('weather_fetch', {}))
+        self.weather_cache = WeatherFeatureCache.from_config(self.config.get('weather_cache', {}))
+
+    @property
+    def terrain_sampler(self) -> Optional[TerrainSampler]:
+        "Carica il DEM in memoria alla prima richiesta."
+        if self._terrain_sampler is None and self.dem_path and self.dem_path.exists():
             try:
-                with rasterio.open(self.dem_path) as dem:
-                    point_gdf = gpd.GeoDataFrame([{'geometry': geometry}], crs='EPSG:4326')
-                    
-                    # Proietta in UTM (zona 32N per Lombardia)
-                    point_proj = point_gdf.to_crs("EPSG:32632")
-                    
-                    # raggio buffer in metri
-                    buffer_utm = point_proj.buffer(buffer_radius_m)
-                    
-                    # Riporta il buffer al CRS del DEM
-                    buffer_dem_crs = buffer_utm.to_crs(dem.crs)
-                    
-                    # Maschera il DEM con il buffer
-                    geometry_to_mask = [mapping(g) for g in buffer_dem_crs.geometry]
-                    
-                    out_image, out_transform = mask(
-                        dem, 
-                        shapes=geometry_to_mask,
-                        crop=True, 
-                        all_touched=True
-                    )
-
-                    elevation_data = out_image[0][out_image[0] != dem.nodata]
-                    if elevation_data.size < 10:
-                        raise ValueError("Dati DEM insufficienti nell'area del buffer.")
-
-                    dy, dx = np.gradient(elevation_data)
-                    slope = np.sqrt(dx**2 + dy**2)
-                    return {
-                        'elevation_mean': float(np.mean(elevation_data)),
-                        'elevation_std': float(np.std(elevation_data)),
-                        'slope_mean': float(np.mean(slope)),
-                        'roughness': float(np.std(elevation_data - ndimage.uniform_filter(elevation_data, size=3)))
-                    }
-            except (ValueError, rasterio.errors.RasterioIOError, IndexError) as e:
-                logger.warning(f"Errore estrazione DEM per {geometry.wkt}: {e}. Uso fallback.")
-                
-        # Fallback
-        lat = geometry.y
-        elevation_estimate = 200 + (lat - 45.4) * 1500
+                self._terrain_sampler = TerrainSampler(
+                    self.dem_path, self.config.get('terrain_buffer_radius_m', 500)
+                )
+            except rasterio.errors.RasterioIOError as e:
+                logger.warning(f"Impossibile leggere il DEM {self.dem_path}: {e}. Uso fallback.")
+                self.dem_path = None
+        return self._terrain_sampler
+
+    @staticmethod
+    def _terrain_fallback(lats: np.ndarray) -> Dict[str, np.ndarray]:
+        "Stima del terreno in funzione della latitudine quando il DEM non è utilizzabile."
         return {
-            'elevation_mean': elevation_estimate,
-            'elevation_std': 150,
-            'slope_mean': 5 + (lat - 45.4) * 20,
-            'roughness': 20
+            'elevation_mean': 200 + (lats - 45.4) * 1500,
+            'elevation_std': np.full_like(lats, 150.0),
+            'slope_mean': 5 + (lats - 45.4) * 20,
+            'roughness': np.full_like(lats, 20.0)
         }
 
-    def extract_weather_features(self, lat: float, lon: float) -> Dict:
-        """Estrae features meteo con gestione errori robusta."""
-        fallback_data = {
-            'precip_1d_past': 5.0,
-            'precip_3d_past': 15.0,
-            'precip_7d_past': 30.0,
-            'precip_3d_forecast': 10.0
+    def extract_terrain_features_batch(self, lats, lons) -> Dict[str, np.ndarray]:
+        "Estrae features del terreno per array di coordinate, con fallback per punto."
+        lats = np.atleast_1d(np.asarray(lats, dtype=np.float64))
+        lons = np.atleast_1d(np.asarray(lons, dtype=np.float64))
+        fallback = self._terrain_fallback(lats)
+
+        sampler = self.terrain_sampler
+        if sampler is None:
+            return fallback
+
+        features = sampler.sample(lats, lons)
+        missing = np.isnan(features['elevation_mean'])
+        if missing.any():
+            logger.warning(f"Dati DEM insufficienti per {int(missing.sum())}/{lats.size} punti. Uso fallback.")
+            for name, values in features.items():
+                values[missing] = fallback[name][missing]
+        return features
+
+    def extract_terrain_features(self, geometry: Point) -> Dict:
+        "Estrae features del terreno da un DEM"
+        features = self.extract_terrain_features_batch([geometry.y], [geometry.x])
+        return {name: float(values[0]) for name, values in features.items()}
+
+    def _parse_weather(self, data: Dict) -> Optional[Dict]:
+        """
+        Calcola le feature di precipitazione da una risposta Open-Meteo per una località.
+        Solleva ValueError se la risposta non ha la struttura attesa; restituisce
+        None se contiene meno giorni di `weather_past_days`.
+        """
+        # Validazione struttura response
+        if not isinstance(data, dict) or 'daily' not in data or 'precipitation_sum' not in data['daily']:
+            raise ValueError("Struttura response API non valida")
+
+        precip_raw = data['daily']['precipitation_sum']
+        precip = [float(p) if p is not None else 0.0 for p in precip_raw]
+
+        num_past = self.config.get('weather_past_days', 7)
+
+        if len(precip) < num_past:
+            logger.warning(f"Dati meteo insufficienti ({len(precip)} < {num_past})")
+            return None
+
+        return {
+            'precip_1d_past': precip[num_past-1],
+            'precip_3d_past': sum(precip[num_past-3:num_past]),
+            'precip_7d_past': sum(precip[0:num_past]),
+            'precip_3d_forecast': sum(precip[num_past:])
         }
-        
+
+    def _parse_weather_locations(self, data) -> List[Optional[Dict]]:
+        "Riduce una risposta multi-località alle sole feature (None per le località non valide)."
+        # Con una sola coordinata l'API restituisce un oggetto invece di una lista
+        locations = data if isinstance(data, list) else [data]
+        parsed = []
+        for location in locations:
+            try:
+                parsed.append(self._parse_weather(location))
+            except (ValueError, TypeError, KeyError) as e:
+                logger.warning(f"Errore API meteo per una località del blocco: {e}")
+                parsed.append(None)
+        return parsed
+
+    def extract_weather_features_batch(self, lats, lons) -> List[Dict]:
+        """
+        Estrae features meteo per più località, raggruppandole in richieste
+        multi-coordinata (latitude/longitude separate da virgola) di
+        `weather_batch_size` punti. Ogni località mantiene il proprio fallback.
+        """
+        lats, lons = list(lats), list(lons)
+        results = [dict(WEATHER_FALLBACK) for _ in lats]
+
         # Validazione coordinate
-        if not (-90 <= lat <= 90) or not (-180 <= lon <= 180):
-            logger.warning(f"Coordinate non valide: ({lat}, {lon})")
-            return fallback_data
-        
-        params = {
-            "latitude": lat,
-            "longitude": lon,
+        valid_idx = []
+        for i, (lat, lon) in enumerate(zip(lats, lons)):
+            if not (-90 <= lat <= 90) or not (-180 <= lon <= 180):
+                logger.warning(f"Coordinate non valide: ({lat}, {lon})")
+            else:
+                valid_idx.append(i)
+
+        # Località da richiedere all'API: ogni punto, oppure una per cella non in cache
+        targets, target_points, target_keys = [], [], []
+        if self.weather_cache is None:
+            for i in valid_idx:
+                targets.append((lats[i], lons[i]))
+                target_points.append([i])
+                target_keys.append(None)
+        else:
+            missing = {}
+            for i in valid_idx:
+                key = self.weather_cache.key(lats[i], lons[i])
+                cached = self.weather_cache.get(key)
+                if cached is not None:
+                    results[i] = cached
+                else:
+                    missing.setdefault(key, []).append(i)
+            for key, points in missing.items():
+                targets.append(self.weather_cache.cell_center(key))
+                target_points.append(points)
+                target_keys.append(key)
+
+        batch_size = max(1, int(self.config.get('weather_batch_size', 50)))
+        api_url = self.config.get('weather_api_url', OPEN_METEO_URL)
+
+        batches = [list(range(start, min(start + batch_size, len(targets))))
+                   for start in range(0, len(targets), batch_size)]
+        params_list = [{
+            "latitude": ",".join(f"{targets[t][0]:.4f}" for t in batch),
+            "longitude": ",".join(f"{targets[t][1]:.4f}" for t in batch),
             "daily": "precipitation_sum",
             "past_days": self.config.get('weather_past_days', 7),
             "forecast_days": self.config.get('weather_forecast_days', 3),
             "timezone": "Europe/Rome"
-        }
-        
-        try:
-            response = requests.get(
-                "https://api.open-meteo.com/v1/forecast",
-                params=params,
-                timeout=10,  # Timeout esplicito
-                headers={'User-Agent': 'Georisk-Sentinel/1.0'}
-            )
-            response.raise_for_status()
-            
-            data = response.json()
-            
-            # Validazione struttura response
-            if 'daily' not in data or 'precipitation_sum' not in data['daily']:
-                raise ValueError("Struttura response API non valida")
-            
-            precip_raw = data['daily']['precipitation_sum']
-            precip = [float(p) if p is not None else 0.0 for p in precip_raw]
-            
-            num_past = self.config.get('weather_past_days', 7)
-            
-            if len(precip) < num_past:
-                logger.warning(f"Dati meteo insufficienti ({len(precip)} < {num_past})")
-                return fallback_data
-            
-            return {
-                'precip_1d_past': precip[num_past-1],
-                'precip_3d_past': sum(precip[num_past-3:num_past]),
-                'precip_7d_past': sum(precip[0:num_past]),
-                'precip_3d_forecast': sum(precip[num_past:])
-            }
-            
-        except (requests.exceptions.RequestException, ValueError, KeyError) as e:
-            logger.warning(f"Errore API meteo per ({lat:.3f},{lon:.3f}): {e}")
-            return fallback_data
+        } for batch in batches]
+
+        # I blocchi partono in parallelo, con concorrenza e rate limit del motore
+        responses = self.weather_engine.fetch_all(api_url, params_list, parse=self._parse_weather_locations)
+
+        for batch, locations in zip(batches, responses):
+            if locations is None:
+                logger.warning(f"Errore API meteo per un blocco di {len(batch)} località. Uso fallback.")
+                continue
+            if len(locations) != len(batch):
+                logger.warning(f"Errore API meteo: attese {len(batch)} località, ricevute {len(locations)}")
+                continue
+
+            for t, parsed in zip(batch, locations):
+                if parsed is None:
+                    continue
+                if target_keys[t] is not None:
+                    self.weather_cache.put(target_keys[t], parsed)
+                for i in target_points[t]:
+                    results[i] = dict(parsed)
+
+        return results
+
+    def weather_stats(self) -> Dict:
+        "Statistiche delle richieste meteo e, se attiva, della cache."
+        stats = self.weather_engine.stats()
+        if self.weather_cache is not None:
+            stats['cache'] = self.weather_cache.stats()
+        return stats
+
+    def weather_feature_arrays(self, lats, lons) -> Dict[str, np.ndarray]:
+        "Feature meteo di più località come colonne float32 (vedi extract_weather_features_batch)."
+        weather = self.extract_weather_features_batch(lats, lons)
+        return {name: np.array([w[name] for w in weather], dtype=np.float32) for name in WEATHER_FALLBACK}
+
+    def extract_weather_features(self, lat: float, lon: float) -> Dict:
+        """Estrae features meteo con gestione errori robusta."""
+        return self.extract_weather_features_batch([lat], [lon])[0]
+
+    def create_feature_matrix(self, lats, lons, dates, columns: Optional[List[str]] = None,
+                              static_features: Optional[Dict[str, np.ndarray]] = None,
+                              weather_features: Optional[Dict[str, np.ndarray]] = None) -> pd.DataFrame:
+        """
+        Crea la matrice delle features per array di località e date in un'unica
+        passata: terreno e meteo vengono estratti in batch e scritti in un blocco
+        float32 con le colonne nell'ordine di FEATURE_NAMES (o di `columns`).
+
+        Args:
+            lats, lons: array di coordinate (gradi decimali)
+            dates: una data unica oppure un array di date, una per località
+            columns: ordine delle colonne richiesto (es. `feature_names_` del modello)
+            static_features: feature del terreno già calcolate per queste località
+                (es. da StaticFeatureStore); se assenti vengono estratte dal DEM
+            weather_features: feature meteo già scaricate per queste località
+                (colonne di WEATHER_FALLBACK); se assenti vengono richieste all'API
+        """
+        lats = np.atleast_1d(np.asarray(lats, dtype=np.float64))
+        lons = np.atleast_1d(np.asarray(lons, dtype=np.float64))
+        n = lats.size
+
+        matrix = np.empty((n, len(FEATURE_NAMES)), dtype=np.float32)
+        col = {name: j for j, name in enumerate(FEATURE_NAMES)}
+
+        if static_features is None:
+            static_features = self.extract_terrain_features_batch(lats, lons)
+        for name, values in static_features.items():
+            matrix[:, col[name]] = values
+
+        if weather_features is None:
+            weather_features = self.weather_feature_arrays(lats, lons)
+        for name, values in weather_features.items():
+            matrix[:, col[name]] = values
+
+        dates = pd.to_datetime(dates)
+        if isinstance(dates, pd.Timestamp):
+            matrix[:, col['month']] = dates.month
+            matrix[:, col['day_of_year']] = dates.dayofyear
+        else:
+            dates = pd.DatetimeIndex(dates)
+            matrix[:, col['month']] = dates.month
+            matrix[:, col['day_of_year']] = dates.dayofyear
+
+        matrix[:, col['latitude']] = lats
+        matrix[:, col['longitude']] = lons
+
+        features = pd.DataFrame(matrix, columns=FEATURE_NAMES, copy=False)
+        if columns is not None and list(columns) != FEATURE_NAMES:
+            features = features.reindex(columns=columns)
+        return features
 
     def create_feature_vector(self, lat: float, lon: float, date: datetime) -> pd.DataFrame:
         "Crea un vettore di features completo per una data località e data."
-        point = Point(lon, lat)
-        features = {}
-        features.update(self.extract_terrain_features(point))
-        features.update(self.extract_weather_features(lat, lon))
-        
-        features['month'] = date.month
-        features['day_of_year'] = date.timetuple().tm_yday
-        features['latitude'] = lat
-        features['longitude'] = lon
-        
-        return pd.DataFrame([features])
+        return self.create_feature_matrix([lat], [lon], date)
+
+
+# Stato dei processi del pool di training: un FeatureEngineering (e un DEM) per processo.
+# I processi non contattano l'API meteo: il meteo arriva già scaricato dal processo principale.
+_worker_feature_engineer = None
+
+
+def _init_feature_worker(config: Dict, dem_path: Optional[str]):
+    global _worker_feature_engineer
+    fe_config = {**config.get('feature_engineering', {}), 'weather_cache': {'enabled': False}}
+    _worker_feature_engineer = FeatureEngineering({'feature_engineering': fe_config}, dem_path=dem_path)
+
+
+def _feature_shard(lats: np.ndarray, lons: np.ndarray, dates: pd.DatetimeIndex,
+                   weather: Dict[str, np.ndarray]) -> pd.DataFrame:
+    return _worker_feature_engineer.create_feature_matrix(lats, lons, dates, weather_features=weather)
 
 
 class RiskPredictor:
@@ -193,50 +483,98 @@ class RiskPredictor:
     
     def __init__(self, config: Dict):
         self.config = config.get('model', {})
+        self.prediction_config = config.get('prediction', {})
+        self.alert_thresholds = {**DEFAULT_ALERT_THRESHOLDS, **self.prediction_config.get('alert_thresholds', {})}
         self.model_type = self.config.get('type', 'xgboost')
+        # I modelli ad alberi sono invarianti allo scaling: di default non si applica
+        self.scale_features = self.config.get('scale_features', self.model_type != 'xgboost')
+        self.inference_nthread = int(self.config.get('inference_nthread', 0))
         self.model = None
         self.scaler = StandardScaler()
+        self.scale_mean_ = None
+        self.scale_std_ = None
+        self.metrics_ = {}
         self.feature_engineer = None
         self.feature_names_ = []
 
-    def prepare_training_data(self, historical_events: gpd.GeoDataFrame) -> Tuple[pd.DataFrame, pd.Series]:
-        "preparazione dati training da dati storici"
+    def prepare_training_data(self, historical_events: gpd.GeoDataFrame,
+                              n_workers: Optional[int] = None) -> Tuple[pd.DataFrame, pd.Series]:
+        """
+        Preparazione dati training da dati storici.
+
+        Le località (eventi + campioni negativi) vengono generate tutte nel processo
+        principale con un generatore inizializzato da `random_state`; con
+        `n_workers` > 1 (default: `training_workers` in config) il calcolo delle
+        features è distribuito a blocchi su un pool di processi e ricomposto
+        nello stesso ordine, quindi X e y coincidono con quelli del percorso seriale.
+        Il meteo viene comunque scaricato una sola volta dal processo principale,
+        così concorrenza e rate limit configurati valgono per l'intero pool.
+        """
         logger.info(f"Preparazione dati da {len(historical_events)} eventi storici...")
-        X_list, y_list = [], []
-
-        for _, event in historical_events.iterrows():
-            lat, lon = event.geometry.y, event.geometry.x
-            event_date = pd.to_datetime(event.get('data_evento', datetime.now()))
-            features = self.feature_engineer.create_feature_vector(lat, lon, event_date)
-            X_list.append(features)
-            y_list.append(event.get('intensita', 50)) # intensita =target
-        
-        X = pd.concat(X_list, ignore_index=True)
-        y = pd.Series(y_list)
+        rng = np.random.default_rng(self.config.get('random_state', 42))
+        now = pd.Timestamp.now()
+        n_events = len(historical_events)
+
+        if 'data_evento' in historical_events.columns:
+            event_dates = pd.DatetimeIndex(pd.to_datetime(historical_events['data_evento']).fillna(now))
+        else:
+            event_dates = pd.DatetimeIndex([now] * n_events)
+        if 'intensita' in historical_events.columns:
+            y = historical_events['intensita'].reset_index(drop=True)  # intensita = target
+        else:
+            y = pd.Series([50] * n_events)
 
         # Aggiungo campioni negativi (aree senza eventi) per bilanciare il dataset
-        n_negative = len(X)
+        n_negative = n_events
         logger.info(f"Aggiunta di {n_negative} campioni negativi casuali...")
-        neg_samples = []
-        ml_config = self.config if 'lombardy_bounds' in self.config else {}
-        bounds = ml_config.get('lombardy_bounds', {'lat_min': 45.4, 'lat_max': 46.6, 'lon_min': 8.5, 'lon_max': 11.4})
-        
-        for _ in range(n_negative):
-            lat = np.random.uniform(bounds['lat_min'], bounds['lat_max'])
-            lon = np.random.uniform(bounds['lon_min'], bounds['lon_max'])
-            date = datetime.now() - timedelta(days=np.random.randint(0, 3650))
-            neg_samples.append(self.feature_engineer.create_feature_vector(lat, lon, date))
+        bounds = self.prediction_config.get('lombardy_bounds', {'lat_min': 45.4, 'lat_max': 46.6, 'lon_min': 8.5, 'lon_max': 11.4})
 
-        X_negative = pd.concat(neg_samples, ignore_index=True)
+        neg_lats = rng.uniform(bounds['lat_min'], bounds['lat_max'], n_negative)
+        neg_lons = rng.uniform(bounds['lon_min'], bounds['lon_max'], n_negative)
+        neg_dates = now - pd.to_timedelta(rng.integers(0, 3650, n_negative), unit='D')
         y_negative = pd.Series([0] * n_negative)
 
-        X_final = pd.concat([X, X_negative], ignore_index=True)
+        lats = np.concatenate([historical_events.geometry.y.to_numpy(), neg_lats])
+        lons = np.concatenate([historical_events.geometry.x.to_numpy(), neg_lons])
+        dates = event_dates.append(neg_dates)
+
+        n_workers = int(n_workers if n_workers is not None else self.config.get('training_workers', 1))
+        if n_workers > 1 and len(lats) > 1:
+            X_final = self._build_features_parallel(lats, lons, dates, n_workers)
+        else:
+            X_final = self.feature_engineer.create_feature_matrix(lats, lons, dates)
         y_final = pd.concat([y, y_negative], ignore_index=True)
 
         self.feature_names_ = X_final.columns.tolist()
+        logger.info(f"Statistiche richieste meteo: {self.feature_engineer.weather_stats()}")
         logger.info(f"Dataset preparato: {len(X_final)} campioni, {len(self.feature_names_)} features")
         return X_final, y_final
 
+    def _build_features_parallel(self, lats: np.ndarray, lons: np.ndarray, dates: pd.DatetimeIndex,
+                                 n_workers: int) -> pd.DataFrame:
+        """
+        Calcola la matrice delle features a blocchi su un pool di processi, preservando
+        l'ordine. Il meteo viene scaricato prima, nel processo principale (un solo
+        motore di richieste e una sola cache); i processi estraggono il terreno dal
+        DEM e compongono i blocchi della matrice.
+        """
+        fe = self.feature_engineer
+        weather = fe.weather_feature_arrays(lats, lons)
+
+        n_shards = min(len(lats), n_workers * 4)
+        shards = np.array_split(np.arange(len(lats)), n_shards)
+        logger.info(f"Calcolo features su {n_workers} processi ({n_shards} blocchi)...")
+
+        dem_path = str(fe.dem_path) if fe.dem_path else None
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_feature_worker,
+                                 initargs=({'feature_engineering': fe.config}, dem_path)) as pool:
+            parts = list(pool.map(
+                _feature_shard,
+                [lats[idx] for idx in shards], [lons[idx] for idx in shards], [dates[idx] for idx in shards],
+                [{name: values[idx] for name, values in weather.items()} for idx in shards]
+            ))
+        return pd.concat(parts, ignore_index=True)
+
     def train(self, X: pd.DataFrame, y: pd.Series) -> Dict:
         """Addestra il modello con gestione feature names consistente."""
         
@@ -249,9 +587,14 @@ class RiskPredictor:
             random_state=self.config.get('random_state', 42)
         )
         
-        # Scaling
-        X_train_scaled = self.scaler.fit_transform(X_train)
-        X_test_scaled = self.scaler.transform(X_test)
+        # Scaling (solo se richiesto): i parametri vengono tenuti come array float32
+        if self.scale_features:
+            self.scaler.fit(X_train)
+            self._fold_scaler()
+        else:
+            self.scale_mean_ = self.scale_std_ = None
+        X_train_scaled = self._transform(X_train.to_numpy(dtype=np.float32))
+        X_test_scaled = self._transform(X_test.to_numpy(dtype=np.float32))
         
         # Training
         model_params = self.config.get('model_params', {
@@ -267,11 +610,12 @@ class RiskPredictor:
         
         logger.info(f"Training modello con parametri: {model_params}")
         self.model.fit(X_train_scaled, y_train)
+        self._configure_booster()
         
         # Valutazione
-        y_pred = self.model.predict(X_test_scaled)
+        y_pred = self._predict_scores(X_test_scaled, scaled=True)
         
-        metrics = {
+        train_metrics = {
             'test_r2': float(r2_score(y_test, y_pred)),
             'test_rmse': float(np.sqrt(mean_squared_error(y_test, y_pred))),
             'test_mae': float(mean_absolute_error(y_test, y_pred)),
@@ -280,8 +624,40 @@ class RiskPredictor:
             'feature_count': len(self.feature_names_)
         }
         
-        logger.info(f"Training completato. R2={metrics['test_r2']:.3f}, RMSE={metrics['test_rmse']:.2f}")
-        return metrics
+        self.metrics_ = train_metrics
+        logger.info(f"Training completato. R2={train_metrics['test_r2']:.3f}, RMSE={train_metrics['test_rmse']:.2f}")
+        return train_metrics
+
+    def _fold_scaler(self):
+        "Estrae media e deviazione standard dello scaler come array float32 contigui."
+        if hasattr(self.scaler, 'mean_'):
+            self.scale_mean_ = np.ascontiguousarray(self.scaler.mean_, dtype=np.float32)
+            self.scale_std_ = np.ascontiguousarray(self.scaler.scale_, dtype=np.float32)
+        else:
+            self.scale_mean_ = self.scale_std_ = None
+
+    def _transform(self, X: np.ndarray) -> np.ndarray:
+        "Applica lo scaling (se presente) direttamente sull'array float32, senza passare da sklearn."
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        if self.scale_mean_ is None:
+            return X
+        X = X - self.scale_mean_
+        X /= self.scale_std_
+        return X
+
+    def _configure_booster(self):
+        "Imposta il numero di thread usati dal booster in inferenza (0 = default XGBoost)."
+        if self.model is not None and self.inference_nthread > 0:
+            self.model.get_booster().set_param({'nthread': self.inference_nthread})
+
+    def _predict_scores(self, X: np.ndarray, scaled: bool = False) -> np.ndarray:
+        """
+        Inferenza nativa: array float32 contiguo passato a `Booster.inplace_predict`,
+        senza DataFrame né DMatrix intermedi.
+        """
+        if not scaled:
+            X = self._transform(X)
+        return self.model.get_booster().inplace_predict(X)
 
     def get_feature_importance(self) -> pd.DataFrame:
         "Restituisce l'importanza delle feature in un DataFrame ordinato."
@@ -295,62 +671,177 @@ class RiskPredictor:
         
         return importance_df
 
-    def predict(self, locations: List[Tuple[float, float]]) -> pd.DataFrame:
+    def classify_alert_levels(self, risk_scores: np.ndarray) -> pd.Categorical:
+        """
+        Assegna il livello di allerta a ogni punteggio secondo le soglie configurate.
+        Il risultato è categoriale (un byte per riga) con categorie fisse `ALERT_LEVELS`.
+        """
+        edges = [self.alert_thresholds[level] for level in ALERT_LEVELS[1:]]
+        codes = np.searchsorted(edges, risk_scores, side='right').astype(np.int8)
+        return pd.Categorical.from_codes(codes, categories=ALERT_LEVELS, ordered=True)
+
+    def _score_chunk(self, coords: np.ndarray, date: datetime,
+                     static_features: Optional[Dict[str, np.ndarray]] = None) -> pd.DataFrame:
+        "Calcola punteggio e livello di allerta per un blocco di coordinate (lat, lon)."
+        features_df = self.feature_engineer.create_feature_matrix(
+            coords[:, 0], coords[:, 1], date, columns=self.feature_names_, static_features=static_features
+        )
+        risk_scores = self._predict_scores(features_df.to_numpy(dtype=np.float32))
+        
+        # Applica clipping per assicurare che il punteggio sia tra 0 e 100
+        risk_scores = np.clip(risk_scores, 0, 100)
+
+        # Coordinate e punteggi in float32: bastano per le 4 e 1 cifre decimali esportate
+        return pd.DataFrame({
+            'latitude': coords[:, 0].astype(np.float32),
+            'longitude': coords[:, 1].astype(np.float32),
+            'risk_score': risk_scores.astype(np.float32, copy=False),
+            'alert_level': self.classify_alert_levels(risk_scores)
+        })
+
+    def predict_iter(self, locations, chunk_size: Optional[int] = None,
+                     static_features: Optional[Dict[str, np.ndarray]] = None) -> Iterator[pd.DataFrame]:
+        """
+        Predice il rischio a blocchi di `chunk_size` località, restituendo un
+        DataFrame per blocco: la memoria usata non dipende dalla dimensione della griglia.
+        Se `static_features` è indicato (array allineati a `locations`), il terreno
+        non viene ricalcolato.
+        """
+        if not self.model: 
+            raise RuntimeError("Modello non addestrato.")
+
+        coords = np.asarray(locations, dtype=np.float64).reshape(-1, 2)
+        chunk_size = max(1, int(chunk_size or self.prediction_config.get('chunk_size', 5000)))
+        date = datetime.now()
+
+        for start in range(0, len(coords), chunk_size):
+            sl = slice(start, start + chunk_size)
+            chunk_static = {name: values[sl] for name, values in static_features.items()} if static_features else None
+            yield self._score_chunk(coords[sl], date, chunk_static)
+        logger.info(f"Statistiche richieste meteo: {self.feature_engineer.weather_stats()}")
+
+    def predict(self, locations: List[Tuple[float, float]],
+                static_features: Optional[Dict[str, np.ndarray]] = None) -> pd.DataFrame:
         "Predice il rischio per una lista di località."
         if not self.model: 
             raise RuntimeError("Modello non addestrato.")
 
-        all_features = []
-        for lat, lon in locations:
-            all_features.append(self.feature_engineer.create_feature_vector(lat, lon, datetime.now()))
-        
-        features_df = pd.concat(all_features, ignore_index=True).reindex(columns=self.feature_names_)
-        
-        features_scaled = self.scaler.transform(features_df)
-        risk_scores = self.model.predict(features_scaled)
-        
-        # Applica clipping per assicurare che il punteggio sia tra 0 e 100
-        risk_scores = np.clip(risk_scores, 0, 100)
-        
-        results = []
-        for i, (lat, lon) in enumerate(locations):
-            score = risk_scores[i]
-            if score >= 70: 
-                alert_level = "ROSSO"
-            elif score >= 50: 
-                alert_level = "ARANCIONE"
-            elif score >= 30: 
-                alert_level = "GIALLO"
-            else: 
-                alert_level = "VERDE"
-            
-            results.append({
-                'latitude': lat, 
-                'longitude': lon, 
-                'risk_score': score, 
-                'alert_level': alert_level
-            })
-        
-        return pd.DataFrame(results)
+        coords = np.asarray(locations, dtype=np.float64).reshape(-1, 2)
+        results = self._score_chunk(coords, datetime.now(), static_features)
+        logger.info(f"Statistiche richieste meteo: {self.feature_engineer.weather_stats()}")
+        return results
 
     def save_model(self, filepath: str):
-        """Salva il modello, lo scaler e i nomi delle feature."""
-        model_data = {
-            'model': self.model, 
-            'scaler': self.scaler, 
-            'features': self.feature_names_
+        """
+        Salva il modello come directory versionata:
+          - model.ubj: booster nel formato nativo UBJSON di XGBoost
+          - scaler_mean.npy / scaler_scale.npy: parametri di scaling (se presenti)
+          - manifest.json: nomi delle feature, metriche di training e checksum SHA-256
+        La directory viene scritta a parte e sostituita in un solo passo.
+        """
+        target = Path(filepath)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        tmp_dir = target.with_name(target.name + '.tmp')
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        tmp_dir.mkdir()
+
+        files = {'model': 'model.ubj'}
+        self.model.save_model(str(tmp_dir / files['model']))
+        if self.scale_mean_ is not None:
+            files['scaler_mean'] = 'scaler_mean.npy'
+            files['scaler_scale'] = 'scaler_scale.npy'
+            np.save(tmp_dir / files['scaler_mean'], self.scale_mean_)
+            np.save(tmp_dir / files['scaler_scale'], self.scale_std_)
+
+        manifest = {
+            'format_version': MODEL_FORMAT_VERSION,
+            'created_at': datetime.now().isoformat(),
+            'model_type': self.model_type,
+            'xgboost_version': xgb.__version__,
+            'feature_names': self.feature_names_,
+            'metrics': self.metrics_,
+            'files': {
+                role: {'name': name, 'sha256': _sha256_file(tmp_dir / name)}
+                for role, name in files.items()
+            }
         }
-        Path(filepath).parent.mkdir(parents=True, exist_ok=True)
-        joblib.dump(model_data, filepath)
+        with open(tmp_dir / 'manifest.json', 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2)
+
+        # Sostituzione della versione precedente (directory o vecchio pickle)
+        if target.is_dir():
+            old_dir = target.with_name(target.name + '.old')
+            shutil.rmtree(old_dir, ignore_errors=True)
+            target.rename(old_dir)
+            tmp_dir.rename(target)
+            shutil.rmtree(old_dir, ignore_errors=True)
+        else:
+            if target.exists():
+                target.unlink()
+            tmp_dir.rename(target)
         logger.info(f"Modello salvato in: {filepath}")
 
     def load_model(self, filepath: str):
-        """Carica un modello salvato."""
+        """
+        Carica un modello salvato. Le directory create da `save_model` vengono lette
+        parte per parte (booster via memory map, checksum verificati); un file
+        singolo viene trattato come pickle joblib del formato precedente.
+        """
+        path = Path(filepath)
+        if path.is_file():
+            self._load_legacy_pickle(path)
+            return
+
+        with open(path / 'manifest.json', 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest.get('format_version', 0) > MODEL_FORMAT_VERSION:
+            raise ValueError(f"Formato modello {manifest['format_version']} non supportato "
+                             f"(massimo {MODEL_FORMAT_VERSION}).")
+        files = manifest['files']
+
+        model_file = path / files['model']['name']
+        with open(model_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if hashlib.sha256(mm).hexdigest() != files['model']['sha256']:
+                raise ValueError(f"Checksum non valido per {model_file}")
+            raw_model = bytearray(mm)
+        self.model = xgb.XGBRegressor()
+        self.model.load_model(raw_model)
+
+        if 'scaler_mean' in files:
+            for role in ('scaler_mean', 'scaler_scale'):
+                if _sha256_file(path / files[role]['name']) != files[role]['sha256']:
+                    raise ValueError(f"Checksum non valido per {path / files[role]['name']}")
+            self.scale_mean_ = np.ascontiguousarray(
+                np.load(path / files['scaler_mean']['name'], mmap_mode='r'), dtype=np.float32)
+            self.scale_std_ = np.ascontiguousarray(
+                np.load(path / files['scaler_scale']['name'], mmap_mode='r'), dtype=np.float32)
+        else:
+            self.scale_mean_ = self.scale_std_ = None
+
+        self.feature_names_ = manifest['feature_names']
+        self.metrics_ = manifest.get('metrics', {})
+        self._configure_booster()
+        logger.info(f"Modello caricato da: {filepath}")
+
+    def _load_legacy_pickle(self, filepath: Path):
+        """Carica un modello salvato con joblib (formato precedente a `model.ubj`)."""
         model_data = joblib.load(filepath)
         self.model = model_data['model']
         self.scaler = model_data['scaler']
         self.feature_names_ = model_data['features']
-        logger.info(f"Modello caricato da: {filepath}")
+        # Modelli salvati con lo scaler: i parametri vengono applicati come array
+        self._fold_scaler()
+        self._configure_booster()
+        logger.info(f"Modello caricato da: {filepath} (formato pickle)")
+
+
+def _sha256_file(path: Path) -> str:
+    "SHA-256 del contenuto di un file, letto a blocchi."
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
 
 
 # --- esecuzione di esempio ---
@@ -382,10 +873,10 @@ if __name__ == "__main__":
 
     # Prepara i dati e addestra il modello
     X, y = predictor.prepare_training_data(historical_events)
-    metrics = predictor.train(X, y)
+    train_metrics = predictor.train(X, y)
     
     print("\n📊 METRICHE DI PERFORMANCE DEL MODELLO:")
-    print(pd.DataFrame([metrics]).to_string())
+    print(pd.DataFrame([train_metrics]).to_string())
 
     # predizioni su una griglia
     logger.info("\n🎯 Esecuzione predizioni su una griglia per la Lombardia...")
@@ -405,7 +896,7 @@ if __name__ == "__main__":
     print(predictions_df.sort_values('risk_score', ascending=False).head().to_string())
     
     # salvataggio modello
-    predictor.save_model("models/georisk_predictor.pkl")
+    predictor.save_model("models/georisk_predictor")
     
     output_gdf = gpd.GeoDataFrame(
         predictions_df, 
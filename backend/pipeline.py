@@ -2,10 +2,15 @@ import argparse
 import json
 import logging
 import sys
+import time
+from datetime import datetime
 from pathlib import Path
+from typing import Dict, Optional, Tuple
 
 import geopandas as gpd
 import numpy as np
+import pandas as pd
+from scipy import ndimage
 
 # Aggiunge la directory corrente al path per garantire che gli import locali funzionino
 sys.path.insert(0, str(Path(__file__).parent))
@@ -14,6 +19,11 @@ from data_ingestion import DataIntegrator
 from ml_forecast import FeatureEngineering, RiskPredictor
 from post_processor import PredictionPostProcessor
 from data_exporter import DataExporter
+from feature_store import StaticFeatureStore
+from prediction_grid import adaptive_levels, grid_axes
+from risk_surface import RiskSurfaceWriter
+from pipeline_daemon import PipelineDaemon, RunLock
+import metrics
 
 logging.basicConfig(
     level=logging.INFO,
@@ -33,21 +43,61 @@ class MLPipeline:
         self.data_integrator = DataIntegrator(config_path)
         self.predictor = RiskPredictor(self.config.get('ml_params', {}))
         self.post_processor = PredictionPostProcessor(self.config)
-        self.exporter = DataExporter('frontend/data')
+        self.exporter = DataExporter(
+            'frontend/data',
+            keep_versions=self.config.get('pipeline_params', {}).get('snapshot_history', 10)
+        )
+        self.feature_store = StaticFeatureStore(
+            self.config['project_paths'].get('static_features', 'data/processed/static_features')
+        )
         self.data = {}
+        self.last_run_report = None
+        # Stato riusato tra le esecuzioni dello stesso processo (modalità demone):
+        # firme di DEM e modello caricati e feature statiche della griglia in memoria
+        self._dem_signature = None
+        self._model_signature = None
+        self._static_features = None
 
-    def run(self, force_training: bool = False):
-        """Esegue il pipeline completo: dati -> training -> predizione -> export."""
-        logger.info("Avvio pipeline Georisk Sentinel...")
+    def run(self, force_training: bool = False, refresh: bool = False):
+        """
+        Esegue il pipeline completo: dati -> training -> predizione -> export.
+        Con `refresh` salta ingestione e training: riusa modello e feature statiche
+        già salvati, scarica solo il meteo aggiornato e ripubblica.
+        
+        Durata e contatori di ogni fase (letture DEM, richieste meteo, cache,
+        punti valutati, allerte esportate) vengono salvati in `run_report.json`
+        accanto ai dati esportati, anche se l'esecuzione fallisce.
+        """
+        logger.info(f"Avvio pipeline Georisk Sentinel{' (refresh meteo)' if refresh else ''}...")
+        run_metrics = metrics.RunMetrics()
+        error = None
         try:
-            self._load_data()
-            self._manage_model(force_training)
-            self._generate_predictions()
-            self._publish_results()
+            with run_metrics.phase('dati'):
+                if refresh:
+                    self._load_cached_data()
+                else:
+                    self._load_data()
+            with run_metrics.phase('modello'):
+                if refresh:
+                    self._load_cached_model()
+                else:
+                    self._manage_model(force_training)
+            # In streaming la predizione avviene durante la pubblicazione e viene contata lì
+            with run_metrics.phase('predizione'):
+                self._generate_predictions()
+            with run_metrics.phase('pubblicazione'):
+                self._publish_results()
             logger.info("Pipeline completato con successo.")
         except Exception as e:
+            error = e
             logger.error(f"Esecuzione pipeline fallita: {e}", exc_info=True)
             raise
+        finally:
+            run_metrics.finish(error)
+            try:
+                self.last_run_report = run_metrics.save(self.exporter.output_folder / "run_report.json")
+            except OSError as e:
+                logger.warning(f"Impossibile salvare il report dell'esecuzione: {e}")
 
     def _load_data(self):
         """Carica e prepara i dati necessari per il training."""
@@ -55,27 +105,83 @@ class MLPipeline:
         self.data['events'], self.data['aux'] = self.data_integrator.prepare_training_dataset()
         logger.info(f"Caricati {len(self.data['events'])} eventi per il training.")
 
+    def _load_cached_data(self):
+        """Modalità refresh: usa il DEM già presente su disco, senza ingestione né training."""
+        logger.info("Fase 1: Dati in cache (refresh, ingestione saltata)...")
+        dem_path = self.data_integrator.downloader.data_dir / "lombardia_dem.tif"
+        if not dem_path.exists():
+            logger.warning(f"DEM non trovato in '{dem_path}'. Uso le stime di fallback del terreno.")
+        self.data['aux'] = {'dem_path': str(dem_path) if dem_path.exists() else None}
+
+    def _init_feature_engineer(self):
+        """
+        Il DEM viene caricato una sola volta e riusato per training e predizione.
+        Nelle esecuzioni successive dello stesso processo (DEM e cache meteo in
+        memoria) viene ricreato solo se il file del DEM è cambiato. La cache meteo
+        è indicizzata per ora della previsione: dopo un'ora il meteo viene riscaricato.
+        """
+        signature = _file_signature(self.data['aux'].get('dem_path'))
+        if self.predictor.feature_engineer is not None and signature == self._dem_signature:
+            return
+        self.predictor.feature_engineer = FeatureEngineering(
+            self.config['ml_params'],
+            dem_path=self.data['aux'].get('dem_path')
+        )
+        self._dem_signature = signature
+        self._static_features = None
+
+    def _load_cached_model(self):
+        """Modalità refresh: carica il modello salvato, senza mai riaddestrarlo."""
+        logger.info("Fase 2: Caricamento modello salvato...")
+        model_path = self._find_model(Path(self.config['project_paths']['model_artifact']))
+        if model_path is None:
+            raise FileNotFoundError(
+                f"Nessun modello in '{self.config['project_paths']['model_artifact']}': "
+                "la modalità refresh richiede un modello già addestrato."
+            )
+        self._init_feature_engineer()
+        if self.predictor.model is not None and _model_signature(model_path) == self._model_signature:
+            logger.info("Modello già in memoria e invariato su disco.")
+            return
+        self._load_model(model_path)
+
+    def _load_model(self, model_path: Path):
+        """Carica il modello salvato e ne riporta il tempo di caricamento."""
+        start = time.perf_counter()
+        self.predictor.load_model(str(model_path))
+        self._model_signature = _model_signature(model_path)
+        logger.info(f"Modello caricato in {(time.perf_counter() - start) * 1000:.1f} ms.")
+
+    def _find_model(self, model_path: Path) -> Optional[Path]:
+        """Percorso del modello da caricare, convertendo un eventuale pickle del formato precedente."""
+        if model_path.exists():
+            return model_path
+        legacy_path = model_path.with_suffix('.pkl')
+        if legacy_path.is_file():
+            logger.info(f"Conversione del modello '{legacy_path}' nel nuovo formato '{model_path}'...")
+            self.predictor.load_model(str(legacy_path))
+            self.predictor.save_model(str(model_path))
+            return model_path
+        return None
+
     def _manage_model(self, force_training: bool):
         """Carica un modello pre-addestrato o ne avvia il training."""
         logger.info("Fase 2: Gestione modello...")
         model_path = Path(self.config['project_paths']['model_artifact'])
+        self._init_feature_engineer()
         
-        if model_path.exists() and not force_training:
+        if not force_training and self._find_model(model_path) is not None:
             logger.info(f"Caricamento modello da '{model_path}'...")
-            self.predictor.load_model(str(model_path))
+            self._load_model(model_path)
         else:
             logger.info("Nessun modello trovato o training forzato. Avvio addestramento...")
-            feature_engineer = FeatureEngineering(
-                self.config['ml_params'],
-                dem_path=self.data['aux'].get('dem_path')
-            )
-            self.predictor.feature_engineer = feature_engineer
-            
             X, y = self.predictor.prepare_training_data(self.data['events'])
-            metrics = self.predictor.train(X, y)
+            train_metrics = self.predictor.train(X, y)
             
-            logger.info(f"Training completato. Metriche: R2={metrics['test_r2']:.3f}, RMSE={metrics['test_rmse']:.2f}")
+            logger.info(f"Training completato. Metriche: R2={train_metrics['test_r2']:.3f}, "
+                        f"RMSE={train_metrics['test_rmse']:.2f}")
             self.predictor.save_model(str(model_path))
+            self._model_signature = _model_signature(model_path)
 
     def _generate_predictions(self):
         """Genera le predizioni di rischio su una griglia geografica."""
@@ -83,32 +189,210 @@ class MLPipeline:
         cfg = self.config['ml_params']['prediction']
         bounds = cfg['lombardy_bounds']
         
-        lats = np.arange(bounds['lat_min'], bounds['lat_max'], cfg['grid_resolution_deg'])
-        lons = np.arange(bounds['lon_min'], bounds['lon_max'], cfg['grid_resolution_deg'])
-        points = [(lat, lon) for lat in lats for lon in lons]
-        
-        predictions_df = self.predictor.predict(points)
-        
-        threshold = cfg['min_risk_score_threshold']
-        predictions_df = predictions_df[predictions_df['risk_score'] >= threshold]
+        surface_enabled = cfg.get('risk_surface', {}).get('enabled', False)
+        lats, lons, res = grid_axes(cfg)
+        lat_grid, lon_grid = np.meshgrid(lats, lons, indexing='ij')
+        grid_points = np.column_stack([lat_grid.ravel(), lon_grid.ravel()])
+        static_features = self._load_static_features(grid_points, res)
+        if cfg.get('adaptive_refinement', {}).get('enabled', False):
+            # Griglia adattiva: le feature statiche sono quelle delle celle del livello più fine
+            surface = self._risk_surface(
+                (bounds['lon_min'], bounds['lat_min'], bounds['lon_max'], bounds['lat_max']), res
+            ) if surface_enabled else None
+            try:
+                points, rows, cols = self._adaptive_grid_points(surface)
+            except BaseException:
+                if surface is not None:
+                    surface.abort()
+                raise
+            if static_features is not None:
+                cells = rows * len(lons) + cols
+                static_features = {name: values[cells] for name, values in static_features.items()}
+        else:
+            points = grid_points
+            # I punti della griglia uniforme sono i centri dei pixel
+            surface = self._risk_surface(
+                (lons[0] - res / 2, lats[0] - res / 2, lons[-1] + res / 2, lats[-1] + res / 2), res
+            ) if surface_enabled else None
         
-        if predictions_df.empty:
+        chunks = self._alert_chunks(points, static_features, surface)
+        if self.config.get('pipeline_params', {}).get('streaming_export', False):
+            # I blocchi vengono calcolati ed esportati uno alla volta in fase 4
+            self.data['prediction_chunks'] = chunks
+            logger.info(f"Predizione in streaming su {len(points)} celle.")
+            return
+
+        chunks = list(chunks)
+        if not chunks:
             logger.warning("Nessuna area ha superato la soglia di rischio. Non verranno generate allerte.")
             self.data['predictions'] = gpd.GeoDataFrame()
             return
 
-        predictions_gdf = gpd.GeoDataFrame(
-            predictions_df,
-            geometry=gpd.points_from_xy(predictions_df.longitude, predictions_df.latitude),
-            crs='EPSG:4326'
-        )
-        
-        self.data['predictions'] = self.post_processor.enrich_predictions(predictions_gdf)
+        self.data['predictions'] = gpd.GeoDataFrame(pd.concat(chunks, ignore_index=True), crs='EPSG:4326')
+        self.data['predictions'].attrs.update(chunks[0].attrs)
         logger.info(f"Generate {len(self.data['predictions'])} allerte valide.")
 
+    def _risk_surface(self, bounds, resolution_deg: float) -> RiskSurfaceWriter:
+        "Writer della superficie di rischio (GeoTIFF COG) per la griglia indicata."
+        paths = self.config['project_paths']
+        return RiskSurfaceWriter(
+            paths.get('risk_surface', f"{paths['frontend_data']}/risk_surface.tif"),
+            bounds, resolution_deg,
+            block_size=self.config['ml_params']['prediction']['risk_surface'].get('block_size', 256)
+        )
+
+    def _adaptive_grid_points(self, surface: Optional[RiskSurfaceWriter] = None
+                              ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Raffinamento a quadtree: valuta una griglia grossolana e suddivide in 4
+        solo le celle con punteggio vicino o sopra la soglia minima, o adiacenti
+        a una cella in queste condizioni (bordi delle aree a rischio). Le celle
+        scartate sono lontane dalla soglia insieme a tutte le vicine. Restituisce
+        i centri (lat, lon) delle celle dell'ultimo livello, la cui risoluzione
+        è al più `min_resolution_deg`, con i loro indici di riga e colonna nella
+        griglia `grid_axes`. I punteggi dei livelli intermedi vengono riportati
+        su `surface`, se indicata, per le aree non raffinate.
+        """
+        cfg = self.config['ml_params']['prediction']
+        bounds = cfg['lombardy_bounds']
+        threshold = cfg['min_risk_score_threshold']
+        margin = cfg['adaptive_refinement'].get('score_margin', 10)
+        coarse, depth = adaptive_levels(cfg)
+
+        def n_cells(span, res):
+            return int(np.ceil(span / res - 1e-9))
+
+        lat_span = bounds['lat_max'] - bounds['lat_min']
+        lon_span = bounds['lon_max'] - bounds['lon_min']
+        rows0, cols0 = n_cells(lat_span, coarse), n_cells(lon_span, coarse)
+
+        def centers(rows, cols, res, final):
+            # Livelli intermedi: celle anche solo in parte nei limiti; ultimo livello: centro nei limiti
+            offset = 0.5 if final else 0.0
+            inside = ((bounds['lat_min'] + (rows + offset) * res < bounds['lat_max'])
+                      & (bounds['lon_min'] + (cols + offset) * res < bounds['lon_max']))
+            rows, cols = rows[inside], cols[inside]
+            lat = bounds['lat_min'] + (rows + 0.5) * res
+            lon = bounds['lon_min'] + (cols + 0.5) * res
+            return rows, cols, np.column_stack([lat, lon])
+
+        grid_rows, grid_cols = np.meshgrid(np.arange(rows0), np.arange(cols0), indexing='ij')
+        rows, cols, coords = centers(grid_rows.ravel(), grid_cols.ravel(), coarse, final=depth == 0)
+        parent_near = None
+        evaluated = 0
+
+        for level in range(depth):
+            res = coarse / 2 ** level
+            scores = np.concatenate([
+                chunk['risk_score'].to_numpy()
+                for chunk in self.predictor.predict_iter(coords, cfg.get('chunk_size'))
+            ]) if len(coords) else np.empty(0)
+            evaluated += len(coords)
+            metrics.incr('points_scored', len(coords))
+            if surface is not None:
+                surface.add(coords[:, 0], coords[:, 1], scores, cell_size_deg=res)
+
+            # Celle vicine alla soglia: valutate a questo livello, le altre ereditate dal livello superiore
+            shape = (rows0 * 2 ** level, cols0 * 2 ** level)
+            near = np.zeros(shape, dtype=bool) if parent_near is None else np.kron(
+                parent_near, np.ones((2, 2), dtype=bool))
+            near[rows, cols] = scores >= threshold - margin
+            refine = ndimage.binary_dilation(near, structure=np.ones((3, 3), dtype=bool))[rows, cols]
+            parent_near = near
+
+            logger.info(f"Livello {level} ({res:.4f}°): {len(coords)} celle valutate, {int(refine.sum())} da raffinare.")
+            child_rows = (2 * rows[refine])[:, None] + np.array([0, 0, 1, 1])
+            child_cols = (2 * cols[refine])[:, None] + np.array([0, 1, 0, 1])
+            rows, cols, coords = centers(child_rows.ravel(), child_cols.ravel(), res / 2, final=level == depth - 1)
+
+        final_res = coarse / 2 ** depth
+        uniform = n_cells(lat_span, final_res) * n_cells(lon_span, final_res)
+        logger.info(f"Griglia adattiva: {evaluated + len(coords)} celle valutate in totale "
+                    f"({len(coords)} a {final_res:.4f}°) contro {uniform} della griglia uniforme.")
+        return coords, rows, cols
+
+    def _alert_chunks(self, points, static_features, surface: Optional[RiskSurfaceWriter] = None):
+        """
+        Predizione a blocchi: di ogni blocco si tengono solo i punti sopra soglia,
+        arricchiti con comune, provincia e colore e con lo stesso istante di
+        predizione. Se indicata, `surface` riceve i punteggi di tutti i punti e
+        viene scritta alla fine. Alla fine salva la cache meteo.
+        """
+        cfg = self.config['ml_params']['prediction']
+        threshold = cfg['min_risk_score_threshold']
+        timestamp = datetime.now().isoformat()
+        try:
+            for chunk in self.predictor.predict_iter(points, cfg.get('chunk_size'), static_features):
+                metrics.incr('points_scored', len(chunk))
+                if surface is not None:
+                    surface.add(chunk['latitude'], chunk['longitude'], chunk['risk_score'])
+                chunk = chunk[chunk['risk_score'] >= threshold]
+                if chunk.empty:
+                    continue
+                chunk_gdf = gpd.GeoDataFrame(
+                    chunk,
+                    geometry=gpd.points_from_xy(chunk.longitude, chunk.latitude),
+                    crs='EPSG:4326'
+                )
+                yield self.post_processor.enrich_predictions(chunk_gdf, timestamp)
+        except BaseException:
+            if surface is not None:
+                surface.abort()
+            raise
+
+        if surface is not None:
+            surface.close()
+
+        # Persiste le feature meteo per le esecuzioni successive
+        weather_cache = self.predictor.feature_engineer.weather_cache
+        if weather_cache is not None:
+            weather_cache.save()
+
+    def _load_static_features(self, points, resolution_deg: float) -> Optional[Dict[str, np.ndarray]]:
+        """
+        Feature del terreno della griglia `grid_axes`, lette dall'archivio o calcolate
+        e salvate. Restano in memoria per le esecuzioni successive finché la chiave
+        dell'archivio (DEM, buffer, limiti, risoluzione, tipo di griglia) non cambia.
+        """
+        feature_engineer = self.predictor.feature_engineer
+        if feature_engineer.dem_path is None or not feature_engineer.dem_path.exists():
+            return None
+
+        cfg = self.config['ml_params']
+        coords = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        params = dict(
+            dem_path=str(feature_engineer.dem_path),
+            buffer_radius_m=cfg.get('feature_engineering', {}).get('terrain_buffer_radius_m', 500),
+            bounds=cfg['prediction']['lombardy_bounds'],
+            resolution_deg=resolution_deg,
+            cell_centers=cfg['prediction'].get('adaptive_refinement', {}).get('enabled', False)
+        )
+        key = self.feature_store.key(**params)
+        if self._static_features is not None and self._static_features[0] == (key, len(coords)):
+            logger.info(f"Feature statiche già in memoria ({len(coords)} celle).")
+            return self._static_features[1]
+
+        features = self.feature_store.load_or_build(
+            **params,
+            lats=coords[:, 0],
+            lons=coords[:, 1],
+            builder=feature_engineer.extract_terrain_features_batch
+        )
+        self._static_features = ((key, len(coords)), features)
+        return features
+
     def _publish_results(self):
         """Esporta i risultati finali in un formato consumabile dal frontend."""
         logger.info("Fase 4: Pubblicazione risultati...")
+        if 'prediction_chunks' in self.data:
+            result = self.exporter.export_stream(
+                self.data.pop('prediction_chunks'),
+                "Georisk Sentinel Lombardia - Predizioni ML"
+            )
+            metrics.incr('alerts_exported', result['numero_allerte'])
+            logger.info(f"Pubblicati {result['numero_allerte']} allerte.")
+            return
+
         if self.data.get('predictions', gpd.GeoDataFrame()).empty:
             logger.warning("Nessuna predizione da pubblicare.")
             # Esporta comunque un file vuoto per mantenere il frontend consistente
@@ -119,17 +403,53 @@ class MLPipeline:
             self.data['predictions'],
             "Georisk Sentinel Lombardia - Predizioni ML"
         )
+        metrics.incr('alerts_exported', result['numero_allerte'])
         logger.info(f"Pubblicati {result['numero_allerte']} allerte.")
 
 
+def _file_signature(path) -> Optional[tuple]:
+    "Identità di un file su disco (inode, dimensione, data di modifica), o None se manca."
+    try:
+        stat = Path(path).stat()
+    except (TypeError, OSError):
+        return None
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+def _model_signature(model_path: Path) -> Optional[tuple]:
+    "Firma del modello salvato: il manifest delle directory di save_model, o il file del pickle."
+    model_path = Path(model_path)
+    return _file_signature(model_path / 'manifest.json' if model_path.is_dir() else model_path)
+
+
 def main():
     """Entry point per l'esecuzione del pipeline da linea di comando."""
     parser = argparse.ArgumentParser(description='Georisk Sentinel ML Pipeline')
-    parser.add_argument('--train', action='store_true', help='Forza il re-training del modello anche se ne esiste uno salvato.')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--train', action='store_true', help='Forza il re-training del modello anche se ne esiste uno salvato.')
+    mode.add_argument('--refresh', action='store_true',
+                      help='Aggiorna solo meteo e predizioni: salta ingestione e training e riusa modello e feature statiche.')
+    mode.add_argument('--daemon', action='store_true',
+                      help='Resta attivo e ripubblica a intervalli regolari tenendo in memoria modello, DEM e '
+                           'feature statiche (il meteo viene riscaricato a ogni nuova ora).')
+    parser.add_argument('--interval', type=float, default=None,
+                        help='Intervallo del demone in minuti (default: pipeline_params.daemon.interval_minutes).')
     args = parser.parse_args()
     
     pipeline = MLPipeline("config.json")
-    pipeline.run(force_training=args.train)
+    daemon_cfg = pipeline.config.get('pipeline_params', {}).get('daemon', {})
+    lock = RunLock(daemon_cfg.get('lock_file', 'data/processed/pipeline.lock'))
+
+    if args.daemon:
+        interval = args.interval if args.interval is not None else daemon_cfg.get('interval_minutes', 60)
+        daemon = PipelineDaemon(pipeline, interval * 60, lock)
+        daemon.install_signal_handlers()
+        daemon.run_forever()
+        return
+
+    # Anche le esecuzioni singole non si sovrappongono a quelle del demone
+    with lock:
+        pipeline.run(force_training=args.train, refresh=args.refresh)
 
 
 if __name__ == "__main__":
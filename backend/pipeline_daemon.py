@@ -0,0 +1,159 @@
+import logging
+import os
+import signal
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+try:
+    import fcntl
+    FCNTL_AVAILABLE = True
+except ImportError:
+    FCNTL_AVAILABLE = False
+    logger.info("fcntl non disponibile: il lock delle esecuzioni vale solo all'interno del processo.")
+
+
+class RunLock:
+    """
+    Lock delle esecuzioni del pipeline: un lock di thread per le esecuzioni
+    dello stesso processo e un `flock` esclusivo sul file indicato per quelle
+    di processi diversi (demone e run manuali da linea di comando).
+    Il file contiene il PID del processo che detiene il lock.
+    """
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self._thread_lock = threading.Lock()
+        self._file = None
+
+    def acquire(self, blocking: bool = True) -> bool:
+        "Acquisisce il lock; senza `blocking` restituisce False se è già occupato."
+        if not self._thread_lock.acquire(blocking):
+            return False
+        if not FCNTL_AVAILABLE:
+            return True
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            f = open(self.path, 'a+')
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                f.close()
+                self._thread_lock.release()
+                return False
+            f.seek(0)
+            f.truncate()
+            f.write(str(os.getpid()))
+            f.flush()
+            self._file = f
+            return True
+        except BaseException:
+            self._thread_lock.release()
+            raise
+
+    def release(self):
+        if self._file is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+        self._thread_lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class PipelineDaemon:
+    """
+    Esegue il pipeline a intervalli regolari nello stesso processo, così modello,
+    DEM e feature statiche della griglia restano in memoria tra un'esecuzione e
+    l'altra. La prima esecuzione è completa (ingestione e gestione del modello);
+    le successive aggiornano solo meteo e predizioni. La cache meteo è indicizzata
+    per ora della previsione: con l'intervallo orario ogni esecuzione scarica il
+    meteo nuovo, mentre le esecuzioni anticipate (`trigger`) nella stessa ora la riusano.
+
+    Le esecuzioni non si sovrappongono mai: le richieste arrivate durante
+    un'esecuzione (`trigger`, SIGUSR1) vengono accorpate in un'unica esecuzione
+    successiva, e un'esecuzione trovata in corso in un altro processo viene saltata.
+    """
+
+    def __init__(self, pipeline, interval_s: float, lock: RunLock):
+        self.pipeline = pipeline
+        self.interval_s = float(interval_s)
+        self.lock = lock
+        self.runs = 0
+        self.failures = 0
+        self._trigger = threading.Event()
+        self._stop = threading.Event()
+
+    def trigger(self):
+        "Richiede un'esecuzione appena possibile (accorpata se una è già in attesa)."
+        self._trigger.set()
+
+    def stop(self):
+        "Termina il ciclo dopo l'eventuale esecuzione in corso."
+        self._stop.set()
+        self._trigger.set()
+
+    def run_once(self) -> bool:
+        """
+        Un'esecuzione del pipeline. Restituisce False se è stata saltata perché
+        un'altra era in corso o se è fallita; gli errori non fermano il demone.
+        """
+        if not self.lock.acquire(blocking=False):
+            logger.warning("Esecuzione del pipeline già in corso: questa esecuzione viene saltata.")
+            return False
+        try:
+            self.pipeline.run(refresh=self.runs > 0)
+            self.runs += 1
+            return True
+        except Exception as e:
+            self.failures += 1
+            logger.error(f"Esecuzione del demone fallita, riprovo al prossimo ciclo: {e}")
+            return False
+        finally:
+            # Le predizioni sono già pubblicate: non servono fino al ciclo successivo
+            self.pipeline.data.pop('predictions', None)
+            self.pipeline.data.pop('prediction_chunks', None)
+            self.lock.release()
+
+    def run_forever(self, max_runs: Optional[int] = None):
+        """
+        Ciclo del demone: esegue subito, poi ogni `interval_s` secondi misurati
+        dall'inizio dell'esecuzione precedente, o prima se arriva un `trigger`.
+        """
+        logger.info(f"Demone del pipeline avviato (intervallo {self.interval_s / 60:.1f} min).")
+        attempts = 0
+        next_run = time.monotonic()
+        while not self._stop.is_set():
+            self._trigger.wait(timeout=max(0.0, next_run - time.monotonic()))
+            if self._stop.is_set():
+                break
+            # Le richieste arrivate fin qui sono coperte da questa esecuzione
+            self._trigger.clear()
+            started = time.monotonic()
+            self.run_once()
+            attempts += 1
+            logger.info(f"Esecuzione {attempts} del demone terminata in {time.monotonic() - started:.1f}s.")
+            if max_runs is not None and attempts >= max_runs:
+                break
+            next_run = started + self.interval_s
+        logger.info(f"Demone del pipeline fermato ({self.runs} esecuzioni riuscite, {self.failures} fallite).")
+
+    def install_signal_handlers(self):
+        "SIGTERM/SIGINT fermano il demone, SIGUSR1 richiede un'esecuzione immediata."
+        # Gli handler girano nel thread principale mentre questo può essere dentro
+        # Event.wait: le operazioni sugli eventi vengono delegate a un thread a parte.
+        def _defer(action):
+            return lambda signum, frame: threading.Thread(target=action, daemon=True).start()
+
+        signal.signal(signal.SIGTERM, _defer(self.stop))
+        signal.signal(signal.SIGINT, _defer(self.stop))
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, _defer(self.trigger))
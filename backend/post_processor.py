@@ -1,15 +1,34 @@
+import hashlib
+import json
 import logging
 from datetime import datetime
+from pathlib import Path
+from typing import Optional, Tuple
 
 import geopandas as gpd
 import numpy as np
+import pandas as pd
 from scipy.spatial import KDTree
 
+from prediction_grid import grid_axes
+from snapshot_store import atomic_open
+
 logger = logging.getLogger(__name__)
 
+# Da incrementare quando cambia il modo in cui viene costruita la tabella
+LOOKUP_FORMAT_VERSION = 1
+
+
 class PredictionPostProcessor:
     def __init__(self, config: dict):
         self.config = config.get('post_processing', {})
+        self.prediction_config = config.get('ml_params', {}).get('prediction', {})
+        self.lookup_dir = Path(config.get('project_paths', {}).get('processed_data', 'data/processed'))
+        
+        # Confini comunali (opzionali): indice spaziale e tabella griglia -> comune caricati al primo uso
+        self.boundaries_config = self.config.get('comuni_boundaries', {})
+        self._comuni = None
+        self._grid_lookup = None
         
         capitals_raw = self.config.get('capoluoghi_coords', {})
         if capitals_raw:
@@ -18,31 +37,177 @@ class PredictionPostProcessor:
             # Converte le coordinate da (lat, lon) a (lon, lat) per coerenza spaziale
             self.capital_coords = np.array([[c[1], c[0]] for c in coords_prov])
             self.capital_provinces = [c[2] for c in coords_prov]
+            # Nomi e province come categoriali: l'arricchimento copia solo i codici
+            self._capital_comune = pd.Categorical(self.capital_names)
+            self._capital_provincia = pd.Categorical(self.capital_provinces)
             self.kdtree = KDTree(self.capital_coords)
         else:
             self.kdtree = None
             logger.warning("Dati dei capoluoghi non trovati nella configurazione. L'arricchimento della località sarà limitato.")
 
+    def _load_comuni(self) -> Optional[gpd.GeoDataFrame]:
+        """Poligoni dei comuni (EPSG:4326) con nome e provincia, o None se il file non è configurato o manca."""
+        if self._comuni is not None:
+            return self._comuni if not self._comuni.empty else None
+        
+        path = self.boundaries_config.get('path')
+        if not path or not Path(path).exists():
+            if path:
+                logger.warning(f"Confini comunali non trovati in '{path}'. Uso il capoluogo più vicino.")
+            self._comuni = gpd.GeoDataFrame()
+            return None
+        
+        name_field = self.boundaries_config.get('name_field', 'COMUNE')
+        province_field = self.boundaries_config.get('province_field', 'SIGLA')
+        comuni = gpd.read_file(path)
+        comuni = comuni.to_crs('EPSG:4326') if comuni.crs is not None else comuni.set_crs('EPSG:4326')
+        self._comuni = gpd.GeoDataFrame({
+            'comune': pd.Categorical(comuni[name_field].astype(str).to_numpy()),
+            'provincia': pd.Categorical(comuni[province_field].astype(str).to_numpy())
+        }, geometry=comuni.geometry.to_numpy(), crs='EPSG:4326')
+        self._comuni.sindex  # costruisce subito l'indice spaziale (STRtree)
+        logger.info(f"Caricati {len(self._comuni)} confini comunali da '{path}'.")
+        return self._comuni
+
+    def _locate(self, lons: np.ndarray, lats: np.ndarray) -> np.ndarray:
+        """
+        Indice del comune che contiene ciascun punto, tramite l'indice spaziale.
+        I punti fuori da tutti i poligoni (laghi, bordi) vengono assegnati al comune più vicino.
+        """
+        comuni = self._comuni
+        points = gpd.points_from_xy(lons, lats, crs='EPSG:4326')
+        codes = np.full(len(points), -1, dtype=np.int32)
+        point_idx, comune_idx = comuni.sindex.query(points, predicate='intersects')
+        # Punti sul confine tra due comuni: vale il primo trovato
+        codes[point_idx[::-1]] = comune_idx[::-1]
+        missing = np.flatnonzero(codes < 0)
+        if len(missing):
+            point_idx, comune_idx = comuni.sindex.nearest(points[missing], return_all=False)
+            codes[missing[point_idx]] = comune_idx
+        return codes
+
+    def _grid_params(self) -> Optional[Tuple[np.ndarray, np.ndarray, float]]:
+        "Latitudini, longitudini e passo della griglia di predizione configurata (come in MLPipeline)."
+        if not self.prediction_config.get('lombardy_bounds') or not self.prediction_config.get('grid_resolution_deg'):
+            return None
+        return grid_axes(self.prediction_config)
+
+    def _lookup_key(self, lats: np.ndarray, lons: np.ndarray) -> str:
+        sha = hashlib.sha256()
+        with open(self.boundaries_config['path'], 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+        payload = {
+            'version': LOOKUP_FORMAT_VERSION,
+            'boundaries_sha256': sha.hexdigest(),
+            'fields': [self.boundaries_config.get('name_field', 'COMUNE'),
+                       self.boundaries_config.get('province_field', 'SIGLA')],
+            'lat': [float(lats[0]), float(lats[-1]), len(lats)],
+            'lon': [float(lons[0]), float(lons[-1]), len(lons)]
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()[:20]
+
+    def _load_grid_lookup(self) -> Optional[dict]:
+        """
+        Tabella (righe x colonne della griglia) con l'indice del comune di ogni
+        cella. Viene calcolata una volta con l'indice spaziale e salvata in
+        `processed_data`; si ricostruisce se cambiano confini o griglia.
+        """
+        if self._grid_lookup is not None:
+            return self._grid_lookup
+        grid = self._grid_params()
+        if grid is None or self._load_comuni() is None:
+            return None
+        
+        lats, lons, res = grid
+        key = self._lookup_key(lats, lons)
+        path = self.lookup_dir / f"comuni_lookup_{key}.npz"
+        if path.exists():
+            try:
+                with np.load(path) as data:
+                    codes = data['codes']
+                if codes.shape == (len(lats), len(lons)):
+                    logger.info(f"Tabella griglia-comuni caricata da {path}.")
+                    self._grid_lookup = {'lats': lats, 'lons': lons, 'res': res, 'codes': codes}
+                    return self._grid_lookup
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning(f"Tabella griglia-comuni non leggibile ({e}). Verrà ricostruita.")
+        
+        logger.info(f"Calcolo tabella griglia-comuni per {len(lats) * len(lons)} celle...")
+        lat_grid, lon_grid = np.meshgrid(lats, lons, indexing='ij')
+        codes = self._locate(lon_grid.ravel(), lat_grid.ravel()).reshape(lat_grid.shape)
+        self.lookup_dir.mkdir(parents=True, exist_ok=True)
+        for old in self.lookup_dir.glob("comuni_lookup_*.npz"):
+            old.unlink(missing_ok=True)
+        with atomic_open(path) as f:
+            np.savez(f, codes=codes)
+        self._grid_lookup = {'lats': lats, 'lons': lons, 'res': res, 'codes': codes}
+        return self._grid_lookup
+
+    def _comune_codes(self, lons: np.ndarray, lats: np.ndarray) -> np.ndarray:
+        """Indice del comune per ogni punto: lettura dalla tabella per i punti della griglia, indice spaziale per gli altri."""
+        codes = np.full(len(lats), -1, dtype=np.int32)
+        lookup = self._load_grid_lookup()
+        if lookup is not None:
+            res = lookup['res']
+            glats, glons = lookup['lats'], lookup['lons']
+            rows = np.rint((lats - glats[0]) / res).astype(np.int64)
+            cols = np.rint((lons - glons[0]) / res).astype(np.int64)
+            on_grid = (rows >= 0) & (rows < len(glats)) & (cols >= 0) & (cols < len(glons))
+            rows, cols = np.where(on_grid, rows, 0), np.where(on_grid, cols, 0)
+            # Tolleranza relativa al passo: le coordinate delle predizioni sono float32
+            tolerance = res * 1e-3
+            on_grid &= (np.abs(glats[rows] - lats) < tolerance) & (np.abs(glons[cols] - lons) < tolerance)
+            codes[on_grid] = lookup['codes'][rows[on_grid], cols[on_grid]]
+        
+        off_grid = np.flatnonzero(codes < 0)
+        if len(off_grid):
+            codes[off_grid] = self._locate(lons[off_grid], lats[off_grid])
+        return codes
+
     def _enrich_locations(self, gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
-        """Usa un KDTree per associare efficientemente ogni punto al comune e provincia più vicini."""
-        if not self.kdtree or gdf.empty:
-            return gdf.assign(comune="Unknown", provincia="N/A")
+        """
+        Associa a ogni punto comune e provincia (colonne categoriali). Con i confini
+        comunali configurati usa la tabella precalcolata della griglia (e l'indice
+        spaziale per i punti fuori griglia); altrimenti usa un KDTree sul capoluogo
+        più vicino.
+        """
+        if gdf.empty:
+            return gdf
+        
+        if self._load_comuni() is not None:
+            codes = self._comune_codes(gdf.geometry.x.to_numpy(), gdf.geometry.y.to_numpy())
+            gdf['comune'] = self._comuni['comune'].array[codes]
+            gdf['provincia'] = self._comuni['provincia'].array[codes]
+            return gdf
+        
+        if not self.kdtree:
+            unknown = np.zeros(len(gdf), dtype=np.int8)
+            gdf['comune'] = pd.Categorical.from_codes(unknown, categories=["Unknown"])
+            gdf['provincia'] = pd.Categorical.from_codes(unknown, categories=["N/A"])
+            return gdf
 
-        points_to_query = np.array([gdf.geometry.x, gdf.geometry.y]).T
+        points_to_query = np.column_stack([gdf.geometry.x.to_numpy(), gdf.geometry.y.to_numpy()])
         _, indices = self.kdtree.query(points_to_query, k=1)
         
-        gdf['comune'] = [self.capital_names[i] for i in indices]
-        gdf['provincia'] = [self.capital_provinces[i] for i in indices]
+        gdf['comune'] = self._capital_comune[indices]
+        gdf['provincia'] = self._capital_provincia[indices]
         
         return gdf
 
-    def enrich_predictions(self, predictions_gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
-        """Flusso principale per arricchire un GeoDataFrame di predizioni."""
+    def enrich_predictions(self, predictions_gdf: gpd.GeoDataFrame,
+                           timestamp: Optional[str] = None) -> gpd.GeoDataFrame:
+        """
+        Flusso principale per arricchire un GeoDataFrame di predizioni. Le colonne
+        vengono aggiunte al GeoDataFrame ricevuto, senza copiarlo. L'istante della
+        predizione (`timestamp`, di default adesso) è unico per tutta l'istantanea
+        e viene salvato in `gdf.attrs['timestamp']` invece che su ogni riga.
+        """
         if predictions_gdf.empty:
             logger.info("GeoDataFrame delle predizioni vuoto. Nessun arricchimento necessario.")
             return predictions_gdf
 
-        gdf = predictions_gdf.copy()
+        gdf = predictions_gdf
         
         try:
             gdf = self._enrich_locations(gdf)
@@ -51,15 +216,19 @@ class PredictionPostProcessor:
                 'ROSSO': '#ff4757', 'ARANCIONE': '#ff9f43', 
                 'GIALLO': '#ffd32c', 'VERDE': '#26de81'
             })
-            gdf['alert_color'] = gdf['alert_level'].map(color_map).fillna('#26de81')
+            # Colori calcolati sulle categorie del livello; l'ultimo vale per i livelli mancanti
+            levels = gdf['alert_level'].astype('category').array
+            colors = [color_map.get(level, '#26de81') for level in levels.categories] + ['#26de81']
+            palette, inverse = np.unique(colors, return_inverse=True)
+            gdf['alert_color'] = pd.Categorical.from_codes(inverse[levels.codes], categories=palette)
             
-            gdf['precipitation_mm'] = np.clip(gdf['risk_score'] * 0.8, 0, 100).round(1)
-            gdf['timestamp'] = datetime.now().isoformat()
+            gdf['precipitation_mm'] = np.clip(gdf['risk_score'] * 0.8, 0, 100).round(1).astype(np.float32)
+            gdf.attrs['timestamp'] = timestamp or datetime.now().isoformat()
             
             logger.info(f"Arricchimento completato. {len(gdf)} record processati.")
             return gdf
             
         except Exception as e:
             logger.error(f"Errore imprevisto durante l'arricchimento delle predizioni: {e}")
-            # In caso di errore, restituisce il GDF originale per non bloccare la pipeline
+            # In caso di errore restituisce il GDF ricevuto (con le colonne già aggiunte) per non bloccare la pipeline
             return predictions_gdf
\ No newline at end of file
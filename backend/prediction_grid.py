@@ -0,0 +1,36 @@
+from typing import Dict, Tuple
+
+import numpy as np
+
+
+def adaptive_levels(prediction_config: Dict) -> Tuple[float, int]:
+    "Risoluzione del livello grossolano e numero di suddivisioni della griglia adattiva."
+    adaptive = prediction_config['adaptive_refinement']
+    coarse = adaptive.get('coarse_resolution_deg', 0.6)
+    finest = adaptive.get('min_resolution_deg', prediction_config['grid_resolution_deg'])
+    return coarse, max(0, int(np.ceil(np.log2(coarse / finest) - 1e-9)))
+
+
+def cell_centers(start: float, stop: float, res: float) -> np.ndarray:
+    "Centri delle celle di passo `res` a partire da `start`, con centro prima di `stop`."
+    centers = start + (np.arange(int(np.ceil((stop - start) / res - 1e-9))) + 0.5) * res
+    return centers[centers < stop]
+
+
+def grid_axes(prediction_config: Dict) -> Tuple[np.ndarray, np.ndarray, float]:
+    """
+    Latitudini, longitudini e passo della griglia su cui sono indicizzate le
+    feature statiche e la tabella dei comuni. È la griglia uniforme
+    (`grid_resolution_deg`, punti a partire dai limiti) oppure, con il
+    raffinamento adattivo, la griglia dei centri delle celle del livello più
+    fine del quadtree: ogni punto dell'ultimo livello ne è un nodo.
+    """
+    bounds = prediction_config['lombardy_bounds']
+    if prediction_config.get('adaptive_refinement', {}).get('enabled', False):
+        coarse, depth = adaptive_levels(prediction_config)
+        res = coarse / 2 ** depth
+        return (cell_centers(bounds['lat_min'], bounds['lat_max'], res),
+                cell_centers(bounds['lon_min'], bounds['lon_max'], res), res)
+    res = prediction_config['grid_resolution_deg']
+    return (np.arange(bounds['lat_min'], bounds['lat_max'], res),
+            np.arange(bounds['lon_min'], bounds['lon_max'], res), res)
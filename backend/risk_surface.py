@@ -0,0 +1,139 @@
+import logging
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Dict, Optional, Sequence, Tuple
+
+import numpy as np
+import rasterio
+import rasterio.shutil
+from rasterio.enums import Resampling
+from rasterio.transform import from_bounds
+from rasterio.windows import Window
+from rasterio.windows import from_bounds as window_from_bounds
+
+logger = logging.getLogger(__name__)
+
+NODATA = -9999.0
+
+
+class RiskSurfaceWriter:
+    """
+    Superficie continua del punteggio di rischio, scritta come GeoTIFF
+    Cloud-Optimized (tile interne, overview, DEFLATE). I punteggi vengono
+    accumulati in un array su disco (memmap) e il raster viene scritto blocco
+    per blocco, quindi la memoria usata non dipende dalla dimensione della griglia.
+    Stesse convenzioni del DEM: limiti (ovest, sud, est, nord), `from_bounds`, EPSG:4326.
+    """
+
+    def __init__(self, path: str, bounds: Tuple[float, float, float, float], resolution_deg: float,
+                 block_size: int = 256):
+        """
+        `bounds` è (ovest, sud, est, nord): i punti passati ad `add` sono i
+        centri dei pixel di lato `resolution_deg` a partire dall'angolo nord-ovest.
+        """
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.resolution_deg = float(resolution_deg)
+        self.block_size = int(block_size)
+        west, south, east, north = bounds
+        self.width = int(np.ceil((east - west) / self.resolution_deg - 1e-9))
+        self.height = int(np.ceil((north - south) / self.resolution_deg - 1e-9))
+        # Limiti estesi a un numero intero di pixel, così la risoluzione è esatta
+        self.bounds = (west, north - self.height * self.resolution_deg,
+                       west + self.width * self.resolution_deg, north)
+        self.transform = from_bounds(*self.bounds, self.width, self.height)
+
+        self._tmp_dir = Path(tempfile.mkdtemp(dir=self.path.parent, prefix=f".{self.path.name}."))
+        self._scores = np.memmap(self._tmp_dir / "scores.f32", dtype=np.float32, mode='w+',
+                                 shape=(self.height, self.width))
+        self._scores[:] = NODATA
+
+    def _pixels(self, lats: np.ndarray, lons: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        west, _, _, north = self.bounds
+        rows = np.floor((north - np.asarray(lats, dtype=np.float64)) / self.resolution_deg).astype(np.int64)
+        cols = np.floor((np.asarray(lons, dtype=np.float64) - west) / self.resolution_deg).astype(np.int64)
+        inside = (rows >= 0) & (rows < self.height) & (cols >= 0) & (cols < self.width)
+        return rows, cols, inside
+
+    def add(self, lats: Sequence[float], lons: Sequence[float], scores: Sequence[float],
+            cell_size_deg: Optional[float] = None):
+        """
+        Registra i punteggi dei punti indicati. Con `cell_size_deg` maggiore della
+        risoluzione (celle grossolane della griglia adattiva) il punteggio copre
+        tutti i pixel della cella centrata nel punto; valori aggiunti dopo sovrascrivono.
+        """
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        scores = np.asarray(scores, dtype=np.float32)
+        span = max(1, int(round((cell_size_deg or self.resolution_deg) / self.resolution_deg)))
+        if span > 1:
+            # Angolo nord-ovest della cella: si scrivono span x span pixel a partire da lì
+            half = (span - 1) / 2 * self.resolution_deg
+            lats, lons = lats + half, lons - half
+        for dr in range(span):
+            for dc in range(span):
+                rows, cols, inside = self._pixels(lats - dr * self.resolution_deg,
+                                                  lons + dc * self.resolution_deg)
+                self._scores[rows[inside], cols[inside]] = scores[inside]
+
+    def close(self) -> str:
+        """
+        Scrive il COG (scrittura atomica) e rimuove i file temporanei. Il raster
+        intermedio viene scritto a blocchi dal memmap; il driver COG aggiunge
+        le overview (media) e riordina il file per le letture per finestre.
+        """
+        try:
+            self._scores.flush()
+            tiled_path = self._tmp_dir / "tiled.tif"
+            profile = {
+                'driver': 'GTiff', 'height': self.height, 'width': self.width, 'count': 1,
+                'dtype': 'float32', 'crs': 'EPSG:4326', 'transform': self.transform, 'nodata': NODATA,
+                'tiled': True, 'blockxsize': self.block_size, 'blockysize': self.block_size
+            }
+            with rasterio.open(tiled_path, 'w', **profile) as dst:
+                for row in range(0, self.height, self.block_size):
+                    for col in range(0, self.width, self.block_size):
+                        window = Window(col, row, min(self.block_size, self.width - col),
+                                        min(self.block_size, self.height - row))
+                        dst.write(np.asarray(self._scores[window.toslices()]), 1, window=window)
+
+            cog_path = self._tmp_dir / "cog.tif"
+            rasterio.shutil.copy(tiled_path, cog_path, driver='COG', COMPRESS='DEFLATE', PREDICTOR='YES',
+                                 BLOCKSIZE=self.block_size, OVERVIEW_RESAMPLING='AVERAGE')
+            os.replace(cog_path, self.path)
+            logger.info(f"Superficie di rischio scritta in {self.path} ({self.width}x{self.height} pixel).")
+            return str(self.path)
+        finally:
+            self.abort()
+
+    def abort(self):
+        "Rimuove i file temporanei senza scrivere il raster."
+        if self._scores is not None:
+            del self._scores
+            self._scores = None
+        shutil.rmtree(self._tmp_dir, ignore_errors=True)
+
+
+def read_window(path: str, bbox: Sequence[float], width: int, height: int) -> Dict:
+    """
+    Legge la porzione `bbox` (ovest, sud, est, nord) della superficie alla
+    risoluzione richiesta (`width` x `height` pixel). Per letture ridotte GDAL
+    usa le overview del COG, senza leggere il raster a piena risoluzione.
+    """
+    with rasterio.open(path) as src:
+        left, bottom, right, top = src.bounds
+        west, south, east, north = bbox
+        west, south, east, north = max(west, left), max(south, bottom), min(east, right), min(north, top)
+        if west >= east or south >= north:
+            raise ValueError("bbox fuori dalla superficie di rischio")
+        window = window_from_bounds(west, south, east, north, transform=src.transform)
+        values = src.read(1, window=window, out_shape=(height, width),
+                          resampling=Resampling.average, masked=True)
+    return {
+        'bbox': [west, south, east, north],
+        'width': width,
+        'height': height,
+        'values': values
+    }
@@ -1,13 +1,35 @@
+import hashlib
+import json
 import os
+import sys
+import time
 from pathlib import Path
-from flask import Flask, jsonify, send_from_directory, send_file
+from typing import Optional, Tuple
+from flask import Flask, Response, g, jsonify, request, send_from_directory
 from flask_cors import CORS
 from dotenv import load_dotenv
 import logging
+import numpy as np
+
+# Aggiunge la directory corrente al path per garantire che gli import locali funzionino
+sys.path.insert(0, str(Path(__file__).parent))
+
+from alerts_cache import AlertsCache, AlertsSnapshot, ColumnarSnapshot
+from columnar import LEVEL_CODES
+from snapshot_store import SnapshotStore
+from metrics import Histogram, render_run_report
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Gestione import opzionali - non critici
+RASTERIO_AVAILABLE = False
+try:
+    from risk_surface import NODATA, read_window
+    RASTERIO_AVAILABLE = True
+except ImportError:
+    logger.info("rasterio non disponibile. L'endpoint della superficie di rischio è disattivato.")
+
 # Carica variabili ambiente
 load_dotenv(Path(__file__).parent / '.env')
 
@@ -24,6 +46,78 @@ app = Flask(__name__,
 
 CORS(app)
 
+# Istantanea in memoria delle allerte, ricaricata solo quando il file cambia
+alerts_cache = AlertsCache(DATA_DIR / 'alerts_data.json')
+columnar_cache = AlertsCache(DATA_DIR / 'alerts_data.bin', snapshot_cls=ColumnarSnapshot)
+# Storico delle versioni scritto da DataExporter, per le richieste ?since=
+snapshot_store = SnapshotStore(DATA_DIR / 'snapshots')
+
+
+def _load_project_paths() -> dict:
+    "Sezione `project_paths` di config.json, la stessa usata dal pipeline."
+    try:
+        with open(PROJECT_ROOT / 'config.json', 'r', encoding='utf-8') as f:
+            return json.load(f).get('project_paths', {})
+    except (OSError, json.JSONDecodeError) as e:
+        logger.warning(f"config.json non leggibile ({e}). Uso i percorsi predefiniti.")
+        return {}
+
+
+def _project_path(path: str) -> Path:
+    "I percorsi di config.json sono relativi alla radice del progetto, come per il pipeline."
+    path = Path(path)
+    return path if path.is_absolute() else PROJECT_ROOT / path
+
+
+PROJECT_PATHS = _load_project_paths()
+# Superficie di rischio (GeoTIFF COG) scritta dal pipeline in project_paths.risk_surface
+RISK_SURFACE_FILE = _project_path(PROJECT_PATHS.get(
+    'risk_surface', f"{PROJECT_PATHS.get('frontend_data', 'frontend/data')}/risk_surface.tif"))
+RISK_SURFACE_MAX_PIXELS = 1024
+# Report dell'ultima esecuzione del pipeline (durate delle fasi e contatori)
+RUN_REPORT_FILE = DATA_DIR / 'run_report.json'
+
+# Latenza delle richieste alle API delle allerte, esposta su /metrics
+REQUEST_LATENCY = Histogram(
+    'georisk_http_request_duration_seconds',
+    "Latenza delle richieste a /api/alerts",
+    label_names=('endpoint', 'method', 'status')
+)
+
+
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def record_latency(response: Response) -> Response:
+    "Registra la latenza delle richieste a /api/alerts (e relativi sotto-percorsi)."
+    start = g.pop('request_start', None)
+    if start is not None and request.url_rule is not None and request.url_rule.rule.startswith('/api/alerts'):
+        REQUEST_LATENCY.observe(time.perf_counter() - start, endpoint=request.url_rule.rule,
+                                method=request.method, status=response.status_code)
+    return response
+
+
+def snapshot_response(snapshot) -> Response:
+    """Risposta per un'istantanea: 304 se il client ha già l'ETag, altrimenti corpo precompresso."""
+    if request.if_none_match.contains(snapshot.etag):
+        response = Response(status=304)
+    else:
+        body, encoding = snapshot.body, None
+        for candidate in ('br', 'gzip'):
+            if candidate in snapshot.encodings and request.accept_encodings[candidate]:
+                body, encoding = snapshot.encodings[candidate], candidate
+                break
+        response = Response(body, mimetype=snapshot.mimetype)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(snapshot.etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.vary.add('Accept-Encoding')
+    return response
+
 
 @app.route('/api/config')
 def get_api_key():
@@ -37,13 +131,106 @@ def get_api_key():
     return jsonify({"apiKey": api_key})
 
 
+ALERTS_QUERY_PARAMS = ('bbox', 'level', 'min_score', 'limit', 'offset')
+
+
+def _to_number(value: str, kind, name: str):
+    try:
+        return kind(value)
+    except ValueError:
+        raise ValueError(f"Valore non numerico per {name}: '{value}'") from None
+
+
+def delta_response(snapshot: AlertsSnapshot, since_arg: str) -> Response:
+    """
+    Differenze dalla versione `since` all'istantanea corrente (nuove, rimosse e
+    modificate). Se la versione non è più disponibile si invia l'istantanea completa.
+    """
+    since = _to_number(since_arg, int, 'since')
+    if since < 0:
+        raise ValueError("since deve essere >= 0")
+    body = snapshot.delta(since, snapshot_store)
+    if body is None:
+        return snapshot_response(snapshot)
+
+    etag = f"{snapshot.etag}-since{since}"
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+def parse_bbox(args) -> Optional[Tuple[float, float, float, float]]:
+    """Parametro bbox=ovest,sud,est,nord (None se assente). Solleva ValueError se non valido."""
+    if not args.get('bbox'):
+        return None
+    parts = args['bbox'].split(',')
+    if len(parts) != 4:
+        raise ValueError("bbox deve essere 'ovest,sud,est,nord'")
+    west, south, east, north = (_to_number(p, float, 'bbox') for p in parts)
+    if west > east or south > north:
+        raise ValueError("bbox non valido: ovest/sud devono essere minori di est/nord")
+    return west, south, east, north
+
+
+def parse_alerts_query(args) -> dict:
+    """Valida i parametri di filtro di /api/alerts. Solleva ValueError con un messaggio leggibile."""
+    query = {'bbox': parse_bbox(args), 'levels': None, 'min_score': None, 'limit': None, 'offset': 0}
+    if args.get('level'):
+        levels = [level.strip().upper() for level in args['level'].split(',') if level.strip()]
+        unknown = [level for level in levels if level not in LEVEL_CODES]
+        if unknown:
+            raise ValueError(f"Livelli non validi: {', '.join(unknown)}")
+        query['levels'] = levels
+    if args.get('min_score'):
+        query['min_score'] = _to_number(args['min_score'], float, 'min_score')
+    if args.get('limit'):
+        query['limit'] = _to_number(args['limit'], int, 'limit')
+        if query['limit'] < 0:
+            raise ValueError("limit deve essere >= 0")
+    if args.get('offset'):
+        query['offset'] = _to_number(args['offset'], int, 'offset')
+        if query['offset'] < 0:
+            raise ValueError("offset deve essere >= 0")
+    return query
+
+
 @app.route('/api/alerts')
 def get_alerts():
-    """Fornisce i dati delle allerte."""
-    alerts_file = DATA_DIR / 'alerts_data.json'
+    """
+    Fornisce i dati delle allerte. Parametri opzionali: bbox=ovest,sud,est,nord,
+    level=ROSSO,ARANCIONE, min_score, limit e offset (paginazione), oppure
+    since=<versione> per ricevere solo le differenze dall'ultima versione vista.
+    """
+    snapshot = alerts_cache.get()
     
-    if alerts_file.exists():
-        return send_file(str(alerts_file), mimetype='application/json')
+    if snapshot is not None:
+        if request.args.get('since'):
+            if any(request.args.get(name) for name in ALERTS_QUERY_PARAMS):
+                return jsonify({"error": "since non è combinabile con i filtri"}), 400
+            try:
+                return delta_response(snapshot, request.args['since'])
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+        if not any(request.args.get(name) for name in ALERTS_QUERY_PARAMS):
+            return snapshot_response(snapshot)
+        try:
+            query = parse_alerts_query(request.args)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        # ETag legato a istantanea e query: i poll ripetuti ricevono 304 senza rifiltrare
+        etag = f"{snapshot.etag}-{hashlib.sha256(request.query_string).hexdigest()[:12]}"
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = jsonify(snapshot.filtered(**query))
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
     
     # Dati demo se il file non esiste
     logger.warning("File alerts_data.json non trovato, invio dati demo")
@@ -70,6 +257,84 @@ def get_alerts():
     })
 
 
+@app.route('/api/alerts/columnar')
+def get_alerts_columnar():
+    """
+    Istantanea completa nel formato binario colonnare (vedi columnar.py):
+    stesse allerte e stesso ordine di /api/alerts, con le colonne leggibili
+    direttamente come typed array.
+    """
+    snapshot = columnar_cache.get()
+    if snapshot is None:
+        return jsonify({"error": "Istantanea colonnare non disponibile"}), 404
+    return snapshot_response(snapshot)
+
+
+@app.route('/api/risk-surface')
+def get_risk_surface():
+    """
+    Lettura per finestra della superficie di rischio: bbox=ovest,sud,est,nord
+    (default: tutta la superficie), width e height in pixel (max 1024) e
+    format=json (valori arrotondati, null dove non c'è dato) oppure f32
+    (float32 little endian riga per riga, nodata -9999).
+    """
+    if not RASTERIO_AVAILABLE:
+        return jsonify({"error": "Superficie di rischio non disponibile su questo server"}), 501
+    if not RISK_SURFACE_FILE.exists():
+        return jsonify({"error": "Superficie di rischio non ancora generata"}), 404
+
+    try:
+        bbox = parse_bbox(request.args) or (-180.0, -90.0, 180.0, 90.0)
+        width = _to_number(request.args.get('width', '256'), int, 'width')
+        height = _to_number(request.args.get('height', '256'), int, 'height')
+        if not (0 < width <= RISK_SURFACE_MAX_PIXELS and 0 < height <= RISK_SURFACE_MAX_PIXELS):
+            raise ValueError(f"width e height devono essere tra 1 e {RISK_SURFACE_MAX_PIXELS}")
+        output_format = request.args.get('format', 'json')
+        if output_format not in ('json', 'f32'):
+            raise ValueError("format deve essere 'json' o 'f32'")
+        result = read_window(str(RISK_SURFACE_FILE), bbox, width, height)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    values = result['values']
+    if output_format == 'f32':
+        body = values.filled(NODATA).astype('<f4').tobytes()
+        response = Response(body, mimetype='application/octet-stream')
+        response.headers['X-Bbox'] = ','.join(f"{v:.6f}" for v in result['bbox'])
+        response.headers['X-Width'] = str(width)
+        response.headers['X-Height'] = str(height)
+        response.headers['X-Nodata'] = str(NODATA)
+        return response
+
+    rounded = np.round(values.astype(np.float64), 1)
+    result['values'] = [[None if masked else value for value, masked in zip(row, mask_row)]
+                        for row, mask_row in zip(rounded.data.tolist(), np.ma.getmaskarray(rounded).tolist())]
+    return jsonify(result)
+
+
+@app.route('/api/tiles/<int:z>/<int:x>/<int:y>')
+def get_tile(z: int, x: int, y: int):
+    """
+    Tile XYZ delle allerte: cluster (conteggio, rischio massimo, istogramma dei
+    livelli) fino allo zoom TILE_CLUSTER_MAX_ZOOM, allerte singole oltre.
+    """
+    if not 0 <= z <= 22 or not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        return jsonify({"error": f"Tile non valida: {z}/{x}/{y}"}), 400
+
+    snapshot = alerts_cache.get()
+    if snapshot is None:
+        return jsonify({"error": "Nessuna istantanea delle allerte disponibile"}), 404
+
+    etag = f"{snapshot.etag}-{z}-{x}-{y}"
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(snapshot.tile(z, x, y), mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
 @app.route('/')
 def serve_index():
     """Serve il file index.html."""
@@ -87,6 +352,35 @@ def serve_static(path):
     return f"File non trovato: {path}", 404
 
 
+def load_run_report():
+    "Report JSON dell'ultima esecuzione del pipeline, o None se assente o non leggibile."
+    try:
+        with open(RUN_REPORT_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning(f"Report dell'esecuzione non leggibile: {e}")
+        return None
+
+
+@app.route('/metrics')
+def get_metrics():
+    """
+    Metriche in formato di testo Prometheus: ultima esecuzione del pipeline
+    (durate delle fasi e contatori), ricariche delle istantanee e latenza di /api/alerts.
+    """
+    lines = render_run_report(load_run_report())
+    lines += [
+        "# HELP georisk_alerts_snapshot_reloads_total Istantanee delle allerte ricaricate dal server",
+        "# TYPE georisk_alerts_snapshot_reloads_total counter",
+        f'georisk_alerts_snapshot_reloads_total{{format="json"}} {alerts_cache.reloads}',
+        f'georisk_alerts_snapshot_reloads_total{{format="columnar"}} {columnar_cache.reloads}'
+    ]
+    lines += REQUEST_LATENCY.render()
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/health')
 def health_check():
     """Health check endpoint."""
@@ -0,0 +1,204 @@
+import gzip
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+_SNAPSHOT_RE = re.compile(r'^alerts_v(\d+)\.json\.gz$')
+
+# umask del processo, letta una volta sola (os.umask la reimposta e non è thread-safe)
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def _file_mode(path: Path) -> int:
+    "Permessi del file pubblicato: quelli del file esistente, o quelli di open() (0666 meno umask)."
+    try:
+        return path.stat().st_mode & 0o7777
+    except OSError:
+        return 0o666 & ~_UMASK
+
+
+@contextmanager
+def atomic_open(path: Path, before_replace: Optional[Callable[[Path], None]] = None):
+    """
+    File binario da scrivere in modo atomico: si scrive su un file temporaneo
+    nella stessa cartella, rinominato sul file finale solo alla chiusura senza errori.
+    mkstemp crea il file con permessi 0600: prima del rename si applicano
+    quelli del file sostituito, o quelli di un normale open(), così server e
+    altri utenti possono continuare a leggerlo.
+
+    `before_replace`, se indicata, riceve il file temporaneo completo prima del
+    rename (es. per conservarlo nello storico prima di pubblicarlo); se solleva
+    un'eccezione il file finale non viene toccato.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            yield f
+            f.flush()
+            if hasattr(os, 'fchmod'):
+                os.fchmod(f.fileno(), _file_mode(path))
+            os.fsync(f.fileno())
+        if before_replace is not None:
+            before_replace(Path(tmp_path))
+        os.replace(tmp_path, path)
+    except BaseException:
+        Path(tmp_path).unlink(missing_ok=True)
+        raise
+
+
+def atomic_write(path: Path, payload: bytes):
+    """Scrive `payload` in modo atomico (vedi atomic_open)."""
+    with atomic_open(path) as f:
+        f.write(payload)
+
+
+def _cell(alert: Dict) -> tuple:
+    "Identità di una cella della griglia: coordinate come esportate (4 decimali)."
+    return alert['lat'], alert['lon']
+
+
+def compute_delta(old_alerts: Sequence[Dict], new_alerts: Sequence[Dict]) -> Dict:
+    """
+    Differenza tra due elenchi di allerte, per cella: celle nuove (`added`),
+    scomparse (`removed`, solo coordinate) e con valori cambiati (`changed`,
+    con i valori nuovi). L'ordine segue quello delle allerte nuove.
+    """
+    old = {_cell(a): a for a in old_alerts}
+    new_cells = set()
+    added, changed = [], []
+    for alert in new_alerts:
+        cell = _cell(alert)
+        new_cells.add(cell)
+        previous = old.get(cell)
+        if previous is None:
+            added.append(alert)
+        elif previous != alert:
+            changed.append(alert)
+    removed = [{'lat': lat, 'lon': lon} for (lat, lon) in old if (lat, lon) not in new_cells]
+    return {'added': added, 'removed': removed, 'changed': changed}
+
+
+class SnapshotStore:
+    """
+    Storico delle istantanee esportate: ogni esportazione riceve una versione
+    crescente e viene conservata (JSON compresso) insieme alla differenza
+    rispetto alla versione precedente. Restano solo le ultime `keep` versioni.
+    """
+
+    def __init__(self, folder: Path, keep: int = 10):
+        self.folder = Path(folder)
+        self.keep = max(1, int(keep))
+
+    def _snapshot_path(self, version: int) -> Path:
+        return self.folder / f"alerts_v{version:06d}.json.gz"
+
+    def _delta_path(self, version: int) -> Path:
+        return self.folder / f"delta_v{version:06d}.json.gz"
+
+    def versions(self) -> List[int]:
+        "Versioni conservate, in ordine crescente."
+        if not self.folder.exists():
+            return []
+        return sorted(int(m.group(1)) for m in map(_SNAPSHOT_RE.match, os.listdir(self.folder)) if m)
+
+    def latest_version(self) -> int:
+        versions = self.versions()
+        return versions[-1] if versions else 0
+
+    def next_version(self) -> int:
+        return self.latest_version() + 1
+
+    def load(self, version: int) -> Optional[Dict]:
+        "Istantanea della versione indicata, o None se non è più conservata."
+        try:
+            with gzip.open(self._snapshot_path(version), 'rb') as f:
+                return json.loads(f.read())
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Istantanea v{version} non leggibile: {e}")
+            return None
+
+    def _write(self, path: Path, data: Dict):
+        body = json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+        atomic_write(path, gzip.compress(body, compresslevel=6))
+
+    def save(self, data: Dict) -> Dict:
+        """
+        Assegna la versione successiva a `data` (in `metadata.snapshot_version`),
+        la salva con la differenza rispetto alla precedente e rimuove le versioni
+        oltre `keep`. Restituisce la differenza calcolata.
+        """
+        self.folder.mkdir(parents=True, exist_ok=True)
+        version = self.next_version()
+        previous_version = version - 1
+        data['metadata']['snapshot_version'] = version
+
+        previous = self.load(previous_version) if previous_version else None
+        delta = compute_delta(previous['alerts'] if previous else [], data['alerts'])
+        delta.update(type='delta', from_version=previous_version, to_version=version)
+
+        self._write(self._snapshot_path(version), data)
+        self._write(self._delta_path(version), delta)
+        self._prune()
+        logger.info(f"Istantanea v{version}: {len(delta['added'])} nuove, {len(delta['changed'])} modificate, "
+                    f"{len(delta['removed'])} rimosse.")
+        return delta
+
+    def save_file(self, version: int, json_path: Path):
+        """
+        Conserva un'istantanea già scritta su disco (esportazione in streaming)
+        copiandola a blocchi, senza caricarla in memoria. La differenza con la
+        versione precedente non viene salvata: la calcola il server se richiesta.
+        """
+        self.folder.mkdir(parents=True, exist_ok=True)
+        with open(json_path, 'rb') as src, atomic_open(self._snapshot_path(version)) as dst:
+            with gzip.GzipFile(fileobj=dst, mode='wb', compresslevel=6) as gz:
+                shutil.copyfileobj(src, gz, 1 << 20)
+        self._prune()
+        logger.info(f"Istantanea v{version} conservata nello storico.")
+
+    def _prune(self):
+        versions = self.versions()
+        for version in versions[:-self.keep]:
+            self._snapshot_path(version).unlink(missing_ok=True)
+            self._delta_path(version).unlink(missing_ok=True)
+
+    def delta_since(self, since: int, current: Dict) -> Optional[Dict]:
+        """
+        Differenza tra la versione `since` e l'istantanea corrente. Usa la
+        differenza salvata se `since` è la versione immediatamente precedente,
+        altrimenti confronta con l'istantanea conservata. None se `since` non
+        è più disponibile (il client deve scaricare l'istantanea completa).
+        """
+        version = current.get('metadata', {}).get('snapshot_version')
+        if version is None or since > version:
+            return None
+        if since == version:
+            return {'type': 'delta', 'from_version': since, 'to_version': version,
+                    'added': [], 'removed': [], 'changed': []}
+
+        if since == version - 1:
+            try:
+                with gzip.open(self._delta_path(version), 'rb') as f:
+                    delta = json.loads(f.read())
+                if delta.get('from_version') == since:
+                    return delta
+            except (OSError, ValueError):
+                pass
+
+        previous = self.load(since)
+        if previous is None:
+            return None
+        delta = compute_delta(previous['alerts'], current.get('alerts', []))
+        delta.update(type='delta', from_version=since, to_version=version)
+        return delta
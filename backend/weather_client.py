@@ -0,0 +1,298 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import requests
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Codici HTTP per cui ha senso ritentare la richiesta
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """Rate limiter a token bucket: `rate` richieste al secondo con picchi fino a `capacity`."""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1.0, rate))
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+
+    async def acquire(self):
+        "Attende finché non è disponibile un token (nessun limite se rate <= 0)."
+        if self.rate <= 0:
+            return
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class WeatherFetchEngine:
+    """
+    Esegue richieste HTTP GET in parallelo con asyncio: concorrenza massima
+    configurabile, rate limit a token bucket e backoff esponenziale su 429/5xx.
+    Le chiamate bloccanti di `requests` girano in un pool di thread dedicato,
+    quindi il tempo totale dipende dalla concorrenza e non dalla somma delle latenze.
+    """
+
+    def __init__(self, max_concurrency: int = 8, rate_limit_per_sec: float = 10.0,
+                 max_retries: int = 3, backoff_base_s: float = 0.5, timeout_s: float = 10.0,
+                 user_agent: str = 'Georisk-Sentinel/1.0'):
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.max_retries = max(0, int(max_retries))
+        self.backoff_base_s = float(backoff_base_s)
+        self.timeout_s = float(timeout_s)
+        self.headers = {'User-Agent': user_agent}
+        self.bucket = TokenBucket(rate_limit_per_sec, capacity=self.max_concurrency)
+        self._local = threading.local()
+        self.reset_stats()
+
+    @classmethod
+    def from_config(cls, config: Dict) -> 'WeatherFetchEngine':
+        "Crea il motore dalla sezione `weather_fetch` della configurazione."
+        return cls(
+            max_concurrency=config.get('max_concurrency', 8),
+            rate_limit_per_sec=config.get('rate_limit_per_sec', 10.0),
+            max_retries=config.get('max_retries', 3),
+            backoff_base_s=config.get('backoff_base_s', 0.5),
+            timeout_s=config.get('timeout_s', 10.0)
+        )
+
+    def reset_stats(self):
+        "Azzera i contatori di richieste, errori e latenze."
+        self.requests_count = 0
+        self.failures = 0
+        self.retries = 0
+        self.latencies_ms = deque(maxlen=10_000)
+
+    def stats(self) -> Dict:
+        "Riepilogo delle richieste eseguite: conteggi e percentili di latenza."
+        latencies = np.array(self.latencies_ms) if self.latencies_ms else np.zeros(1)
+        return {
+            'requests': self.requests_count,
+            'failures': self.failures,
+            'retries': self.retries,
+            'latency_ms_mean': round(float(latencies.mean()), 1),
+            'latency_ms_p50': round(float(np.percentile(latencies, 50)), 1),
+            'latency_ms_p95': round(float(np.percentile(latencies, 95)), 1),
+            'latency_ms_max': round(float(latencies.max()), 1)
+        }
+
+    def _session(self) -> requests.Session:
+        "Una sessione per thread, per riusare le connessioni in modo sicuro."
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.headers.update(self.headers)
+            self._local.session = session
+        return session
+
+    def _get(self, url: str, params: Dict) -> requests.Response:
+        return self._session().get(url, params=params, timeout=self.timeout_s)
+
+    async def _fetch_one(self, url: str, params: Dict, semaphore: asyncio.Semaphore,
+                         executor: ThreadPoolExecutor, parse: Optional[Callable]) -> Optional[Any]:
+        "Esegue una richiesta con retry; restituisce il JSON o None in caso di errore definitivo."
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.max_retries + 1):
+            async with semaphore:
+                await self.bucket.acquire()
+                start = time.perf_counter()
+                retry_after = None
+                try:
+                    response = await loop.run_in_executor(executor, self._get, url, params)
+                    error = None
+                    if response.status_code in RETRYABLE_STATUS:
+                        error = f"HTTP {response.status_code}"
+                        retry_after = response.headers.get('Retry-After')
+                    else:
+                        response.raise_for_status()
+                        data = response.json()
+                        if parse is not None:
+                            # Riduce subito la risposta, senza trattenere il JSON grezzo
+                            data = parse(data)
+                except (requests.exceptions.HTTPError, ValueError) as e:
+                    # Errori non recuperabili (4xx, JSON non valido): nessun retry
+                    self._record(start, failed=True)
+                    logger.warning(f"Richiesta meteo fallita: {e}")
+                    return None
+                except requests.exceptions.RequestException as e:
+                    error = str(e)
+                self._record(start, failed=error is not None)
+                if error is None:
+                    return data
+
+            if attempt < self.max_retries:
+                self.retries += 1
+                delay = self.backoff_base_s * (2 ** attempt)
+                if retry_after and retry_after.isdigit():
+                    delay = max(delay, float(retry_after))
+                logger.info(f"Richiesta meteo: {error}, nuovo tentativo tra {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+        logger.warning(f"Richiesta meteo fallita dopo {self.max_retries + 1} tentativi: {error}")
+        return None
+
+    def _record(self, start: float, failed: bool):
+        self.requests_count += 1
+        self.latencies_ms.append((time.perf_counter() - start) * 1000)
+        metrics.incr('weather_api_calls')
+        if failed:
+            self.failures += 1
+            metrics.incr('weather_api_failures')
+
+    async def _fetch_all(self, url: str, params_list: List[Dict], parse: Optional[Callable]) -> List[Optional[Any]]:
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            tasks = [self._fetch_one(url, params, semaphore, executor, parse) for params in params_list]
+            return await asyncio.gather(*tasks)
+
+    def fetch_all(self, url: str, params_list: List[Dict], parse: Optional[Callable] = None) -> List[Optional[Any]]:
+        """
+        Esegue tutte le richieste e restituisce i JSON nello stesso ordine di
+        `params_list` (None per le richieste fallite). Se indicata, `parse` viene
+        applicata a ogni risposta appena ricevuta e ne sostituisce il JSON.
+        """
+        if not params_list:
+            return []
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self._fetch_all(url, params_list, parse))
+        # Già dentro un event loop: esegue in un thread separato con un loop proprio
+        with ThreadPoolExecutor(max_workers=1) as runner:
+            return runner.submit(asyncio.run, self._fetch_all(url, params_list, parse)).result()
+
+
+class WeatherFeatureCache:
+    """
+    Cache delle feature meteo già calcolate (`precip_*`), indicizzata per cella
+    della griglia (coordinate agganciate a `resolution_deg`) e ora della previsione.
+    Le voci di un'ora precedente non vengono più usate: ogni aggiornamento orario
+    scarica il meteo nuovo, mentre le esecuzioni nella stessa ora riusano la cache.
+    Applica una scadenza (TTL) e un'espulsione LRU oltre `max_entries` voci.
+    """
+
+    def __init__(self, resolution_deg: float = 0.05, ttl_s: float = 3600,
+                 max_entries: int = 50_000, path: Optional[str] = None):
+        self.resolution_deg = float(resolution_deg)
+        self.ttl_s = float(ttl_s)
+        self.max_entries = max(1, int(max_entries))
+        self.path = Path(path) if path else None
+        self._entries = OrderedDict()  # chiave -> (istante di inserimento, feature)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @classmethod
+    def from_config(cls, config: Dict) -> Optional['WeatherFeatureCache']:
+        "Crea la cache dalla sezione `weather_cache` (None se disabilitata) e carica quella su disco."
+        if not config.get('enabled', False):
+            return None
+        cache = cls(
+            resolution_deg=config.get('resolution_deg', 0.05),
+            ttl_s=config.get('ttl_s', 3600),
+            max_entries=config.get('max_entries', 50_000),
+            path=config.get('path')
+        )
+        cache.load()
+        return cache
+
+    def key(self, lat: float, lon: float, when: Optional[datetime] = None) -> Tuple[int, int, str]:
+        "Chiave della cella che contiene il punto, per l'ora della previsione (default: l'ora corrente)."
+        hour = (when or datetime.now()).strftime('%Y-%m-%dT%H')
+        return (int(round(lat / self.resolution_deg)), int(round(lon / self.resolution_deg)), hour)
+
+    def cell_center(self, key: Tuple[int, int, str]) -> Tuple[float, float]:
+        "Coordinate (lat, lon) del centro della cella, usate per la richiesta all'API."
+        return key[0] * self.resolution_deg, key[1] * self.resolution_deg
+
+    def get(self, key: Tuple[int, int, str]) -> Optional[Dict]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[0] <= self.ttl_s:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                metrics.incr('weather_cache_hits')
+                return dict(entry[1])
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            metrics.incr('weather_cache_misses')
+            return None
+
+    def put(self, key: Tuple[int, int, str], features: Dict):
+        with self._lock:
+            self._entries[key] = (time.time(), dict(features))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> Dict:
+        "Contatori di hit, miss ed espulsioni."
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0
+        }
+
+    def save(self):
+        "Salva su disco le voci ancora valide (scrittura atomica)."
+        if self.path is None:
+            return
+        now = time.time()
+        with self._lock:
+            entries = [[list(k), ts, feats] for k, (ts, feats) in self._entries.items() if now - ts <= self.ttl_s]
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(self.path.suffix + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'resolution_deg': self.resolution_deg, 'entries': entries}, f, separators=(',', ':'))
+        os.replace(tmp_path, self.path)
+        logger.info(f"Cache meteo salvata: {len(entries)} celle in {self.path}")
+
+    def load(self):
+        "Carica le voci valide salvate da un'esecuzione precedente."
+        if self.path is None or not self.path.exists():
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            logger.warning(f"Cache meteo su disco non leggibile ({e}). Riparto da vuota.")
+            return
+        if data.get('resolution_deg') != self.resolution_deg:
+            logger.info("Risoluzione della cache meteo cambiata. Riparto da vuota.")
+            return
+        now = time.time()
+        with self._lock:
+            for k, ts, feats in data.get('entries', []):
+                if now - ts <= self.ttl_s:
+                    self._entries[tuple(k)] = (ts, feats)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        logger.info(f"Cache meteo caricata: {len(self._entries)} celle da {self.path}")
@@ -0,0 +1,108 @@
+"""
+Benchmark dell'inferenza del RiskPredictor su una griglia sintetica.
+
+Confronta il percorso storico (DataFrame -> StandardScaler.transform ->
+XGBRegressor.predict) con l'inferenza nativa su array float32 tramite
+`Booster.inplace_predict`, con e senza scaling. Non richiede rete né DEM.
+
+Uso:
+    python benchmarks/bench_inference.py --points 1000000 --nthread 0
+"""
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'backend'))
+
+from ml_forecast import FEATURE_NAMES, RiskPredictor  # noqa: E402
+
+
+def synthetic_features(n: int, rng: np.random.Generator) -> pd.DataFrame:
+    "Matrice di features plausibile per la Lombardia, nello stesso ordine di FEATURE_NAMES."
+    lats = rng.uniform(45.4, 46.6, n)
+    data = {
+        'elevation_mean': 200 + (lats - 45.4) * 1500 + rng.normal(0, 100, n),
+        'elevation_std': rng.uniform(5, 200, n),
+        'slope_mean': rng.uniform(0, 40, n),
+        'roughness': rng.uniform(0, 30, n),
+        'precip_1d_past': rng.gamma(1.5, 4, n),
+        'precip_3d_past': rng.gamma(2, 8, n),
+        'precip_7d_past': rng.gamma(3, 12, n),
+        'precip_3d_forecast': rng.gamma(2, 6, n),
+        'month': rng.integers(1, 13, n),
+        'day_of_year': rng.integers(1, 366, n),
+        'latitude': lats,
+        'longitude': rng.uniform(8.5, 11.4, n),
+    }
+    return pd.DataFrame(data, columns=FEATURE_NAMES).astype(np.float32)
+
+
+def train_predictor(X: pd.DataFrame, y: pd.Series, scale_features: bool, nthread: int) -> RiskPredictor:
+    predictor = RiskPredictor({'model': {'scale_features': scale_features, 'inference_nthread': nthread}})
+    predictor.train(X, y)
+    return predictor
+
+
+def best_time(fn, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--points', type=int, default=1_000_000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--nthread', type=int, default=0, help='Thread del booster (0 = default XGBoost)')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    X_train = synthetic_features(5000, rng)
+    y_train = pd.Series(np.clip(X_train['slope_mean'] * 1.5 + X_train['precip_3d_past'] * 0.5, 0, 100))
+    grid = synthetic_features(args.points, rng)
+
+    legacy = train_predictor(X_train, y_train, scale_features=True, nthread=args.nthread)
+    native = train_predictor(X_train, y_train, scale_features=False, nthread=args.nthread)
+    grid_array = np.ascontiguousarray(grid.to_numpy(dtype=np.float32))
+
+    timings = {
+        'legacy_dataframe_scaler_predict': best_time(
+            lambda: legacy.model.predict(legacy.scaler.transform(grid)), args.repeat),
+        'native_inplace_predict_folded_scaling': best_time(
+            lambda: legacy._predict_scores(grid_array), args.repeat),
+        'native_inplace_predict_no_scaling': best_time(
+            lambda: native._predict_scores(grid_array), args.repeat),
+    }
+    # Le due vie sullo stesso modello devono dare gli stessi punteggi
+    max_abs_diff = float(np.max(np.abs(
+        legacy.model.predict(legacy.scaler.transform(grid)) - legacy._predict_scores(grid_array)
+    )))
+
+    baseline = timings['legacy_dataframe_scaler_predict']
+    report = {
+        'benchmark': 'inference',
+        'points': args.points,
+        'nthread': args.nthread,
+        'results': {
+            name: {
+                'seconds': round(seconds, 4),
+                'points_per_second': round(args.points / seconds),
+                'speedup': round(baseline / seconds, 2)
+            }
+            for name, seconds in timings.items()
+        },
+        'max_abs_score_diff_legacy_vs_folded': max_abs_diff
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,344 @@
+"""
+Benchmark delle fasi del pipeline su dati sintetici, senza rete.
+
+Per ogni combinazione di risoluzione della griglia e numero di eventi misura:
+  - ingestion: DEM, eventi e uso del suolo sintetici (generatori di DataDownloader), salvati su disco
+  - feature_extraction: matrice delle feature (terreno dal DEM + meteo) sulla griglia di predizione
+  - training: preparazione del dataset dagli eventi e addestramento del modello
+  - prediction: predizione a blocchi sulla griglia (terreno precalcolato, meteo richiesto)
+  - post_processing: arricchimento dei blocchi sopra soglia (comune, provincia, colore)
+  - export: pubblicazione JSON, GeoJSON e colonnare con storico delle versioni
+
+Il meteo arriva da un server locale (weather_stub.py) e la cache meteo è
+disattivata, così ogni fase misura le proprie richieste. Ogni scenario gira in
+una directory temporanea con i percorsi relativi di config.json. Gli eventi
+sono ricampionati (con uno spostamento casuale) da quelli sintetici di
+`_generate_synthetic_events` fino al numero richiesto.
+
+Il risultato è un JSON (stdout o --output) con durata, contatori (metrics.py),
+throughput e memoria del processo (RSS corrente e di picco) dopo ogni fase.
+Con --compare si confronta con un risultato precedente: il codice di uscita è
+1 se una fase è più lenta della tolleranza.
+
+Con --cells la griglia ha circa il numero di celle indicato e la soglia di
+rischio è 0, così tutte le celle passano da predizione, arricchimento ed
+esportazione: serve a misurare la memoria di quel percorso su griglie grandi.
+
+Uso:
+    python benchmarks/bench_pipeline.py --resolutions 0.15 0.05 --events 50 500 --output bench.json
+    python benchmarks/bench_pipeline.py --resolutions 0.15 0.05 --events 50 500 --compare bench.json
+    python benchmarks/bench_pipeline.py --cells 100000 --events 50 --output memoria.json
+"""
+import argparse
+import copy
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT / 'backend'))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import geopandas as gpd  # noqa: E402
+import xgboost as xgb  # noqa: E402
+
+import metrics  # noqa: E402
+from data_exporter import DataExporter  # noqa: E402
+from data_ingestion import DataDownloader  # noqa: E402
+from ml_forecast import FeatureEngineering, RiskPredictor  # noqa: E402
+from post_processor import PredictionPostProcessor  # noqa: E402
+from weather_stub import WeatherStub  # noqa: E402
+
+STAGES = ('ingestion', 'feature_extraction', 'training', 'prediction', 'post_processing', 'export')
+
+
+def bench_config(base: Dict, weather_url: str, resolution_deg: float, weather_cache: bool,
+                 terrain_buffer_m: float, min_risk_score: Optional[float] = None) -> Dict:
+    "Configurazione del repository adattata al benchmark (meteo locale, nessun rate limit)."
+    config = copy.deepcopy(base)
+    fe = config['ml_params']['feature_engineering']
+    fe['weather_api_url'] = weather_url
+    fe['terrain_buffer_radius_m'] = terrain_buffer_m
+    fe.setdefault('weather_fetch', {})['rate_limit_per_sec'] = 0
+    fe.setdefault('weather_cache', {})['enabled'] = weather_cache
+    config['ml_params']['model']['training_workers'] = 1
+    config['ml_params']['prediction']['grid_resolution_deg'] = resolution_deg
+    if min_risk_score is not None:
+        config['ml_params']['prediction']['min_risk_score_threshold'] = min_risk_score
+    # Confini comunali del repository, se presenti; altrimenti capoluogo più vicino
+    boundaries = config.get('post_processing', {}).get('comuni_boundaries')
+    if boundaries and boundaries.get('path'):
+        path = REPO_ROOT / boundaries['path']
+        boundaries['path'] = str(path) if path.exists() else None
+    return config
+
+
+def resolution_for_cells(config: Dict, n_cells: int) -> float:
+    "Passo della griglia che copre i limiti configurati con circa `n_cells` celle."
+    b = config['ml_params']['prediction']['lombardy_bounds']
+    return round(float(np.sqrt((b['lat_max'] - b['lat_min']) * (b['lon_max'] - b['lon_min']) / n_cells)), 6)
+
+
+def memory_usage() -> Dict:
+    "RSS corrente (Linux, /proc/self/statm; altrimenti None) e di picco del processo, in MB."
+    try:
+        with open('/proc/self/statm') as f:
+            rss = round(int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20, 1)
+    except (OSError, ValueError, IndexError):
+        rss = None
+    return {'rss_mb': rss, 'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)}
+
+
+def synthetic_events(downloader: DataDownloader, n: int, rng: np.random.Generator) -> gpd.GeoDataFrame:
+    "`n` eventi ricampionati da quelli sintetici, spostati in modo casuale di qualche km."
+    base = downloader._generate_synthetic_events()
+    idx = rng.integers(0, len(base), n)
+    events = base.iloc[idx].reset_index(drop=True)
+    lats = events['lat'].to_numpy() + rng.normal(0, 0.05, n)
+    lons = events['lon'].to_numpy() + rng.normal(0, 0.05, n)
+    events['lat'], events['lon'] = lats, lons
+    return gpd.GeoDataFrame(events, geometry=gpd.points_from_xy(lons, lats), crs='EPSG:4326')
+
+
+def grid_points(config: Dict) -> np.ndarray:
+    "Griglia di predizione come in MLPipeline._generate_predictions (centri, ordine lat-lon)."
+    cfg = config['ml_params']['prediction']
+    bounds, res = cfg['lombardy_bounds'], cfg['grid_resolution_deg']
+    lats = np.arange(bounds['lat_min'], bounds['lat_max'], res)
+    lons = np.arange(bounds['lon_min'], bounds['lon_max'], res)
+    lat_grid, lon_grid = np.meshgrid(lats, lons, indexing='ij')
+    return np.column_stack([lat_grid.ravel(), lon_grid.ravel()])
+
+
+def run_scenario(config: Dict, n_events: int, seed: int) -> Dict:
+    "Esegue tutte le fasi una volta, nella directory corrente, e restituisce le misure."
+    rng = np.random.default_rng(seed)
+    run = metrics.RunMetrics()
+    items = {}
+    memory = {}
+
+    with run.phase('ingestion'):
+        downloader = DataDownloader(config)
+        dem_path = downloader._generate_synthetic_dem(downloader.data_dir / "lombardia_dem.tif")
+        events = synthetic_events(downloader, n_events, rng)
+        events.to_file(downloader.data_dir / "iffi_lombardia.geojson", driver='GeoJSON')
+        landuse = downloader._generate_synthetic_landuse()
+        landuse.to_file(downloader.data_dir / "landuse_lombardia.geojson", driver='GeoJSON')
+    items['ingestion'] = n_events + len(landuse)
+    memory['ingestion'] = memory_usage()
+
+    points = grid_points(config)
+    feature_engineer = FeatureEngineering(config['ml_params'], dem_path=dem_path)
+    with run.phase('feature_extraction'):
+        features = feature_engineer.create_feature_matrix(points[:, 0], points[:, 1], datetime.now())
+        static_features = {name: features[name].to_numpy(dtype=np.float32)
+                           for name in ('elevation_mean', 'elevation_std', 'slope_mean', 'roughness')}
+    items['feature_extraction'] = len(points)
+    memory['feature_extraction'] = memory_usage()
+
+    predictor = RiskPredictor(config['ml_params'])
+    predictor.feature_engineer = feature_engineer
+    with run.phase('training'):
+        X, y = predictor.prepare_training_data(events)
+        predictor.train(X, y)
+    items['training'] = len(X)
+    memory['training'] = memory_usage()
+
+    cfg = config['ml_params']['prediction']
+    threshold = cfg['min_risk_score_threshold']
+    with run.phase('prediction'):
+        chunks = []
+        for chunk in predictor.predict_iter(points, cfg.get('chunk_size'), static_features):
+            chunk = chunk[chunk['risk_score'] >= threshold]
+            if not chunk.empty:
+                chunks.append(gpd.GeoDataFrame(
+                    chunk, geometry=gpd.points_from_xy(chunk.longitude, chunk.latitude), crs='EPSG:4326'))
+    items['prediction'] = len(points)
+    memory['prediction'] = memory_usage()
+
+    post_processor = PredictionPostProcessor(config)
+    timestamp = datetime.now().isoformat()
+    with run.phase('post_processing'):
+        chunks = [post_processor.enrich_predictions(chunk, timestamp) for chunk in chunks]
+        predictions = gpd.GeoDataFrame(pd.concat(chunks, ignore_index=True), crs='EPSG:4326') \
+            if chunks else gpd.GeoDataFrame()
+        predictions.attrs['timestamp'] = timestamp
+    items['post_processing'] = len(predictions)
+    memory['post_processing'] = memory_usage()
+
+    exporter = DataExporter(config['project_paths'].get('frontend_data', 'frontend/data'))
+    with run.phase('export'):
+        exporter.export_geodataframe(predictions, "Benchmark Georisk Sentinel")
+    items['export'] = len(predictions)
+    memory['export'] = memory_usage()
+
+    run.finish()
+    report = run.to_dict()
+    frame = predictions.drop(columns='geometry', errors='ignore')
+    return {
+        'grid_points': len(points),
+        'training_samples': int(items['training']),
+        'alerts': int(len(predictions)),
+        # Colonne delle predizioni esclusa la geometria, come arrivano all'esportazione
+        'predictions_frame_mb': round(frame.memory_usage(deep=True).sum() / 2 ** 20, 1),
+        'stages': {
+            phase['name']: {
+                'seconds': phase['duration_s'],
+                'items': int(items[phase['name']]),
+                'items_per_second': round(items[phase['name']] / phase['duration_s']) if phase['duration_s'] else None,
+                'counters': phase['counters'],
+                **memory[phase['name']]
+            }
+            for phase in report['phases']
+        }
+    }
+
+
+def best_of(runs: List[Dict]) -> Dict:
+    "Unisce le ripetizioni di uno scenario tenendo il tempo minimo di ogni fase."
+    merged = copy.deepcopy(runs[0])
+    for name, stage in merged['stages'].items():
+        seconds = [run['stages'][name]['seconds'] for run in runs]
+        stage['seconds'] = min(seconds)
+        stage['seconds_all'] = seconds
+        stage['items_per_second'] = round(stage['items'] / stage['seconds']) if stage['seconds'] else None
+    return merged
+
+
+def environment() -> Dict:
+    "Commit, versioni e macchina, per confrontare risultati tra commit."
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_ROOT, capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'geopandas': gpd.__version__,
+        'xgboost': xgb.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count()
+    }
+
+
+def scenario_key(scenario: Dict) -> tuple:
+    return scenario['grid_resolution_deg'], scenario['events']
+
+
+def compare(current: Dict, baseline: Dict, tolerance: float) -> bool:
+    """
+    Stampa su stderr il rapporto dei tempi rispetto a `baseline` per gli scenari
+    in comune. Restituisce True se almeno una fase è più lenta oltre `tolerance`.
+    """
+    previous = {scenario_key(s): s for s in baseline.get('scenarios', [])}
+    regression = False
+    print(f"Confronto con il commit {baseline.get('environment', {}).get('commit')}:", file=sys.stderr)
+    for scenario in current['scenarios']:
+        old = previous.get(scenario_key(scenario))
+        if old is None:
+            continue
+        print(f"  risoluzione {scenario['grid_resolution_deg']}°, {scenario['events']} eventi:", file=sys.stderr)
+        for name, stage in scenario['stages'].items():
+            old_stage = old['stages'].get(name)
+            if not old_stage or not old_stage['seconds']:
+                continue
+            ratio = stage['seconds'] / old_stage['seconds']
+            slower = ratio > 1 + tolerance
+            regression |= slower
+            print(f"    {name:<20} {old_stage['seconds']:>9.4f}s -> {stage['seconds']:>9.4f}s  "
+                  f"x{ratio:.2f}{'  REGRESSIONE' if slower else ''}", file=sys.stderr)
+    return regression
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--resolutions', type=float, nargs='+', default=[0.15, 0.05],
+                        help='Risoluzioni della griglia di predizione in gradi')
+    parser.add_argument('--events', type=int, nargs='+', default=[50, 500], help='Numero di eventi di training')
+    parser.add_argument('--cells', type=int,
+                        help='Griglia di circa CELLS celle al posto di --resolutions, con soglia di rischio 0 '
+                             '(tutte le celle arrivano all\'esportazione)')
+    parser.add_argument('--repeat', type=int, default=1, help='Ripetizioni per scenario (vale il tempo minimo)')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--weather-cache', action='store_true', help='Attiva la cache meteo (di default disattivata)')
+    parser.add_argument('--terrain-buffer-m', type=float, default=2000,
+                        help='Raggio del buffer del terreno: il DEM sintetico ha pixel di circa 1 km, '
+                             'con il raggio di config.json quasi tutti i punti userebbero il fallback')
+    parser.add_argument('--config', default=str(REPO_ROOT / 'config.json'))
+    parser.add_argument('--output', help='File JSON dei risultati (default: stdout)')
+    parser.add_argument('--compare', help='Risultato precedente con cui confrontare i tempi')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Rallentamento relativo tollerato da --compare (0.2 = 20%%)')
+    parser.add_argument('--verbose', action='store_true', help='Mostra i log del pipeline')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+    with open(args.config, 'r', encoding='utf-8') as f:
+        base_config = json.load(f)
+
+    resolutions = [resolution_for_cells(base_config, args.cells)] if args.cells else args.resolutions
+    min_risk_score = 0 if args.cells else None
+
+    scenarios = []
+    cwd = os.getcwd()
+    with WeatherStub() as weather_url:
+        for resolution in resolutions:
+            for n_events in args.events:
+                config = bench_config(base_config, weather_url, resolution, args.weather_cache,
+                                      args.terrain_buffer_m, min_risk_score)
+                runs = []
+                for _ in range(max(1, args.repeat)):
+                    work_dir = tempfile.mkdtemp(prefix='georisk_bench_')
+                    try:
+                        os.chdir(work_dir)
+                        runs.append(run_scenario(config, n_events, args.seed))
+                    finally:
+                        os.chdir(cwd)
+                        shutil.rmtree(work_dir, ignore_errors=True)
+                scenario = {'grid_resolution_deg': resolution, 'events': n_events, **best_of(runs)}
+                scenarios.append(scenario)
+                total = sum(stage['seconds'] for stage in scenario['stages'].values())
+                print(f"risoluzione {resolution}°, {n_events} eventi: {scenario['grid_points']} celle, "
+                      f"{scenario['alerts']} allerte, {total:.2f}s, "
+                      f"picco RSS {scenario['stages']['export']['peak_rss_mb']:.0f} MB", file=sys.stderr)
+
+    result = {
+        'benchmark': 'pipeline',
+        'created_at': datetime.now().isoformat(),
+        'environment': environment(),
+        'parameters': {'repeat': args.repeat, 'seed': args.seed, 'weather_cache': args.weather_cache,
+                       'terrain_buffer_m': args.terrain_buffer_m, 'cells': args.cells},
+        'stages': list(STAGES),
+        'scenarios': scenarios,
+        'process_peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    }
+    body = json.dumps(result, indent=2)
+    if args.output:
+        Path(args.output).write_text(body + '\n', encoding='utf-8')
+    else:
+        print(body)
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        if compare(result, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
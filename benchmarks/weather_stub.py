@@ -0,0 +1,110 @@
+"""
+Server HTTP locale che imita l'endpoint `forecast` di Open-Meteo, per i
+benchmark senza rete. Risponde a richieste multi-coordinata (latitude e
+longitude separate da virgola) con precipitazioni giornaliere deterministiche
+in funzione della posizione: un oggetto per una coordinata, una lista per più.
+Per i test può simulare errori HTTP (`fail_next`, con Retry-After) e località
+senza dati (`invalid_lat_above`).
+
+Uso:
+    with WeatherStub() as url:
+        config['ml_params']['feature_engineering']['weather_api_url'] = url
+"""
+import json
+import math
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+def daily_precipitation(lat: float, lon: float, days: int):
+    "Serie giornaliera plausibile: più pioggia verso le Alpi, variazione lenta con la longitudine."
+    base = max(0.0, (lat - 45.4) * 12 + 4 * math.sin(lon * 3))
+    return [round(base * (1 + 0.3 * math.sin(i + lon)), 2) for i in range(days)]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server_version = 'WeatherStub/1.0'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        try:
+            lats = [float(v) for v in query['latitude'][0].split(',')]
+            lons = [float(v) for v in query['longitude'][0].split(',')]
+            days = int(query.get('past_days', ['7'])[0]) + int(query.get('forecast_days', ['3'])[0])
+        except (KeyError, ValueError):
+            self.send_error(400, 'parametri non validi')
+            return
+
+        self.server.requests += 1
+        try:
+            status, retry_after = self.server.failures.popleft()
+        except IndexError:
+            status = None
+        if status is not None:
+            self.send_response(status)
+            if retry_after is not None:
+                self.send_header('Retry-After', str(retry_after))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        invalid_above = self.server.invalid_lat_above
+        locations = [{'latitude': lat, 'longitude': lon, 'error': True}
+                     if invalid_above is not None and lat > invalid_above else {
+            'latitude': lat,
+            'longitude': lon,
+            'daily': {'time': [''] * days, 'precipitation_sum': daily_precipitation(lat, lon, days)}
+        } for lat, lon in zip(lats, lons)]
+        body = json.dumps(locations if len(locations) > 1 else locations[0]).encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class WeatherStub:
+    "Avvia il server su una porta libera di localhost; `url` è l'endpoint da configurare."
+
+    def __init__(self):
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self._server.daemon_threads = True
+        self._server.requests = 0
+        self._server.failures = deque()
+        self._server.invalid_lat_above = None
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_address[1]}/v1/forecast"
+
+    @property
+    def requests(self) -> int:
+        return self._server.requests
+
+    def fail_next(self, status: int, times: int = 1, retry_after=None):
+        "Le prossime `times` richieste ricevono `status` (con Retry-After, se indicato) invece dei dati."
+        self._server.failures.extend([(status, retry_after)] * times)
+
+    @property
+    def invalid_lat_above(self):
+        return self._server.invalid_lat_above
+
+    @invalid_lat_above.setter
+    def invalid_lat_above(self, lat):
+        "Le località a nord di `lat` vengono restituite senza dati giornalieri."
+        self._server.invalid_lat_above = lat
+
+    def __enter__(self) -> str:
+        self._thread.start()
+        return self.url
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
@@ -6,14 +6,20 @@ import Graphic from "@arcgis/core/Graphic.js";
 import PopupTemplate from "@arcgis/core/PopupTemplate.js";
 import Search from "@arcgis/core/widgets/Search.js";
 import BasemapToggle from "@arcgis/core/widgets/BasemapToggle.js";
+import * as reactiveUtils from "@arcgis/core/core/reactiveUtils.js";
+import * as webMercatorUtils from "@arcgis/core/geometry/support/webMercatorUtils.js";
 
 // --- Costanti e Configurazione ---
 
 const CONSTANTS = {
     API: {
         CONFIG: '/api/config',
-        ALERTS: '/api/alerts'
+        ALERTS: '/api/alerts',
+        ALERTS_COLUMNAR: '/api/alerts/columnar',
+        TILES: '/api/tiles'
     },
+    // Oltre questo numero di tile visibili si scende di un livello di zoom
+    MAX_TILES: 64,
     ALERT_LEVELS: {
         RED: 'ROSSO',
         ORANGE: 'ARANCIONE',
@@ -37,7 +43,9 @@ const app = {
     map: null,
     view: null,
     graphicsLayer: null,
-    alertsData: []
+    alertsData: [],
+    currentFilter: 'tutti',
+    tileRequest: 0
 };
 
 // --- Funzioni Helper ---
@@ -53,6 +61,17 @@ function getSymbolSize(riskScore) {
     return 8;
 }
 
+function getClusterSize(count) {
+    return Math.min(36, 12 + 8 * Math.log10(count + 1));
+}
+
+// Livello più alto presente nell'istogramma di un cluster, tra quelli ammessi dal filtro.
+function clusterLevel(levels) {
+    const order = [CONSTANTS.ALERT_LEVELS.RED, CONSTANTS.ALERT_LEVELS.ORANGE,
+                   CONSTANTS.ALERT_LEVELS.YELLOW, CONSTANTS.ALERT_LEVELS.GREEN];
+    return order.find(level => levels[level] && matchesFilter(level, app.currentFilter));
+}
+
 
 
 //Inizializza e avvia l'applicazione.
@@ -86,6 +105,9 @@ function initMap() {
     const basemapToggle = new BasemapToggle({ view: app.view, nextBasemap: "arcgis-imagery" });
     app.view.ui.add(search, "top-right");
     app.view.ui.add(basemapToggle, "bottom-right");
+
+    // A ogni spostamento della mappa richiede al server solo le tile visibili
+    reactiveUtils.when(() => app.view.stationary, () => refreshMapAlerts());
 }
 
 
@@ -93,7 +115,8 @@ function initMap() {
 
 function initUI() {
     document.querySelector('#filtro-livello')?.addEventListener('calciteSegmentedControlChange', (event) => {
-        filterMapGraphics(event.target.value);
+        app.currentFilter = event.target.value;
+        refreshMapAlerts();
     });
 
     document.querySelector('#btn-info')?.addEventListener('click', () => {
@@ -103,17 +126,72 @@ function initUI() {
 
 // Carica i dati delle allerte e aggiorna la UI.
 async function loadAndDisplayData() {
-    const data = await fetchAlerts();
+    const data = await fetchAlertsColumnar() || await fetchAlerts();
     if (data && data.alerts) {
         app.alertsData = data.alerts;
-        displayAlertsOnMap(app.alertsData);
         updateDashboard(app.alertsData);
+        await refreshMapAlerts();
     } else {
         console.warn('Nessun dato di allerta da visualizzare.');
         updateDashboard([]);
     }
 }
 
+// Tile XYZ che coprono l'area visibile, allo zoom corrente della mappa.
+function visibleTiles() {
+    if (!app.view?.extent) return [];
+    const extent = webMercatorUtils.webMercatorToGeographic(app.view.extent);
+    let z = Math.max(0, Math.min(22, Math.round(app.view.zoom)));
+
+    const tileX = (lon, n) => Math.floor((lon + 180) / 360 * n);
+    const tileY = (lat, n) => {
+        const rad = Math.max(-85.05, Math.min(85.05, lat)) * Math.PI / 180;
+        return Math.floor((1 - Math.log(Math.tan(rad) + 1 / Math.cos(rad)) / Math.PI) / 2 * n);
+    };
+
+    while (true) {
+        const n = 2 ** z;
+        const clamp = v => Math.max(0, Math.min(n - 1, v));
+        const [x0, x1] = [clamp(tileX(extent.xmin, n)), clamp(tileX(extent.xmax, n))];
+        const [y0, y1] = [clamp(tileY(extent.ymax, n)), clamp(tileY(extent.ymin, n))];
+        if ((x1 - x0 + 1) * (y1 - y0 + 1) <= CONSTANTS.MAX_TILES || z === 0) {
+            const tiles = [];
+            for (let x = x0; x <= x1; x++) {
+                for (let y = y0; y <= y1; y++) tiles.push({ z, x, y });
+            }
+            return tiles;
+        }
+        z -= 1;
+    }
+}
+
+// Aggiorna la mappa con le tile visibili: cluster a zoom bassi, allerte singole a zoom alti.
+async function refreshMapAlerts() {
+    const request = ++app.tileRequest;
+    const tiles = await Promise.all(visibleTiles().map(fetchTile));
+    if (request !== app.tileRequest) return; // risposta superata da uno spostamento successivo
+
+    if (tiles.length === 0 || tiles.every(tile => tile === null)) {
+        // Server senza istantanea (o non raggiungibile): allerte complete filtrate sul client
+        const data = await fetchAlerts();
+        const alerts = (data && data.alerts) ? data.alerts : [];
+        displayAlertsOnMap(alerts.filter(alert => matchesFilter(alert.alert_level, app.currentFilter)));
+        return;
+    }
+
+    const alerts = [];
+    const clusters = [];
+    tiles.filter(Boolean).forEach(tile => {
+        if (tile.type === 'clusters') {
+            clusters.push(...tile.features);
+        } else {
+            alerts.push(...tile.features.filter(alert => matchesFilter(alert.alert_level, app.currentFilter)));
+        }
+    });
+    displayAlertsOnMap(alerts);
+    displayClustersOnMap(clusters);
+}
+
 // --- Funzioni di Interazione con l'API ---
 
 async function getApiKey() {
@@ -129,9 +207,72 @@ async function getApiKey() {
     }
 }
 
-async function fetchAlerts() {
+async function fetchTile({ z, x, y }) {
     try {
-        const response = await fetch(CONSTANTS.API.ALERTS);
+        const response = await fetch(`${CONSTANTS.API.TILES}/${z}/${x}/${y}`);
+        if (!response.ok) return null;
+        return await response.json();
+    } catch (error) {
+        return null;
+    }
+}
+
+// Istantanea completa nel formato binario colonnare; null se non disponibile (si usa il JSON).
+async function fetchAlertsColumnar() {
+    try {
+        const response = await fetch(CONSTANTS.API.ALERTS_COLUMNAR);
+        if (!response.ok) return null;
+        return decodeColumnarAlerts(await response.arrayBuffer());
+    } catch (error) {
+        console.warn(`Formato colonnare non disponibile: ${error.message}`);
+        return null;
+    }
+}
+
+// Decodifica il formato di backend/columnar.py: preambolo, header JSON e colonne come typed array.
+function decodeColumnarAlerts(buffer) {
+    const preamble = new DataView(buffer, 0, 12);
+    const magic = new TextDecoder().decode(new Uint8Array(buffer, 0, 4));
+    if (magic !== 'GRSK' || preamble.getUint32(4, true) !== 1) {
+        throw new Error('formato colonnare non riconosciuto');
+    }
+    const headerLength = preamble.getUint32(8, true);
+    const header = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 12, headerLength)));
+    const base = 12 + headerLength;
+    const arrayTypes = { '<f4': Float32Array, '|u1': Uint8Array, '<u2': Uint16Array, '<u4': Uint32Array };
+
+    const columns = {};
+    header.columns.forEach(({ name, dtype, offset }) => {
+        columns[name] = new arrayTypes[dtype](buffer, base + offset, header.count);
+    });
+
+    const round = (value, digits) => Number(value.toFixed(digits));
+    const dict = header.dictionaries;
+    const alerts = new Array(header.count);
+    for (let i = 0; i < header.count; i++) {
+        alerts[i] = {
+            comune: dict.comune[columns.comune[i]],
+            provincia: dict.provincia[columns.provincia[i]],
+            lat: round(columns.lat[i], 4),
+            lon: round(columns.lon[i], 4),
+            alert_level: header.levels[columns.alert_level[i]],
+            alert_color: dict.alert_color[columns.alert_color[i]],
+            risk_score: round(columns.risk_score[i], 1),
+            precipitation_mm: round(columns.precipitation_mm[i], 1)
+        };
+    }
+    return {
+        metadata: header.metadata,
+        summary: header.summary,
+        alerts,
+        critical_areas: alerts.filter(alert => isCritical(alert.alert_level))
+    };
+}
+
+async function fetchAlerts(params) {
+    try {
+        const url = params && params.toString() ? `${CONSTANTS.API.ALERTS}?${params}` : CONSTANTS.API.ALERTS;
+        const response = await fetch(url);
         if (!response.ok) throw new Error('API allerte non raggiungibile');
         return await response.json();
     } catch (error) {
@@ -168,6 +309,34 @@ function displayAlertsOnMap(alerts) {
     app.graphicsLayer.addMany(graphics);
 }
 
+// Aggiunge i cluster delle tile: dimensione in base al numero di allerte, colore del livello più alto.
+function displayClustersOnMap(clusters) {
+    const graphics = clusters.map(cluster => {
+        const level = clusterLevel(cluster.levels);
+        if (!level) return null;
+        const count = Object.entries(cluster.levels)
+            .filter(([name]) => matchesFilter(name, app.currentFilter))
+            .reduce((total, [, n]) => total + n, 0);
+
+        return new Graphic({
+            geometry: { type: "point", longitude: cluster.lon, latitude: cluster.lat },
+            symbol: {
+                type: "simple-marker",
+                color: [...CONSTANTS.COLORS[level], 0.8],
+                size: `${getClusterSize(count)}px`,
+                outline: { color: "white", width: 2 }
+            },
+            attributes: { count, max_risk: cluster.max_risk, alert_level: level },
+            popupTemplate: new PopupTemplate({
+                title: "{count} allerte",
+                content: `<b>Livello massimo:</b> {alert_level}<br><b>Rischio massimo:</b> {max_risk}%`
+            })
+        });
+    }).filter(Boolean);
+
+    app.graphicsLayer.addMany(graphics);
+}
+
 function updateDashboard(alerts) {
     const criticalList = document.querySelector('#lista-aree-critiche');
     criticalList.innerHTML = '';
@@ -197,17 +366,11 @@ function updateDashboard(alerts) {
     }
 }
 
-function filterMapGraphics(filterValue) {
-    app.graphicsLayer.graphics.forEach(graphic => {
-        const level = graphic.attributes.alert_level;
-        if (filterValue === CONSTANTS.FILTERS.ALL) {
-            graphic.visible = true;
-        } else if (filterValue === CONSTANTS.FILTERS.CRITICAL) {
-            graphic.visible = isCritical(level);
-        } else {
-            graphic.visible = (level === filterValue);
-        }
-    });
+// Filtro per livello applicato sul client alle tile e ai dati demo di fallback.
+function matchesFilter(level, filterValue) {
+    if (filterValue === CONSTANTS.FILTERS.ALL) return true;
+    if (filterValue === CONSTANTS.FILTERS.CRITICAL) return isCritical(level);
+    return level === filterValue;
 }
 
 function closeLoadingModal() {
@@ -0,0 +1,53 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_bounds
+
+# I moduli del backend si importano come moduli locali, come fa pipeline.py
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / 'backend'))
+sys.path.insert(0, str(ROOT / 'benchmarks'))
+
+from weather_stub import WeatherStub  # noqa: E402
+
+# Area del DEM sintetico: (ovest, sud, est, nord), pixel di circa 150 m
+DEM_BOUNDS = (9.0, 45.8, 9.6, 46.2)
+DEM_SHAPE = (200, 300)
+
+
+@pytest.fixture
+def weather_stub():
+    "Server meteo locale (vedi benchmarks/weather_stub.py); `url` è l'endpoint."
+    stub = WeatherStub()
+    with stub:
+        yield stub
+
+
+@pytest.fixture
+def synthetic_dem(tmp_path) -> str:
+    "DEM EPSG:4326 deterministico: rilievo crescente verso nord, rumore e un blocco di nodata."
+    height, width = DEM_SHAPE
+    rng = np.random.default_rng(0)
+    rows, cols = np.mgrid[0:height, 0:width]
+    elevation = 2000 - rows * 8 + 120 * np.sin(cols / 15) + rng.normal(0, 25, (height, width))
+    elevation[150:170, 20:60] = -9999
+    path = tmp_path / 'dem.tif'
+    with rasterio.open(path, 'w', driver='GTiff', height=height, width=width, count=1, dtype='float32',
+                       crs='EPSG:4326', transform=from_bounds(*DEM_BOUNDS, width, height), nodata=-9999) as dst:
+        dst.write(elevation.astype(np.float32), 1)
+    return str(path)
+
+
+@pytest.fixture
+def feature_config(weather_stub) -> dict:
+    "Sezione `feature_engineering` che punta al server meteo locale, senza cache su disco."
+    return {
+        'terrain_buffer_radius_m': 500,
+        'weather_api_url': weather_stub.url,
+        'weather_batch_size': 1000,
+        'weather_fetch': {'max_concurrency': 4, 'rate_limit_per_sec': 0, 'max_retries': 0, 'timeout_s': 5},
+        'weather_cache': {'enabled': False}
+    }
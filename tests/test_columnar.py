@@ -0,0 +1,65 @@
+import json
+
+import numpy as np
+
+from columnar import ColumnarWriter, decode_alerts, encode_alerts, _PREAMBLE
+
+
+def _alerts(n=300, seed=0):
+    rng = np.random.default_rng(seed)
+    levels = ['VERDE', 'GIALLO', 'ARANCIONE', 'ROSSO']
+    colors = {'VERDE': '#00ff00', 'GIALLO': '#ffff00', 'ARANCIONE': '#ff8000', 'ROSSO': '#ff0000'}
+    comuni = [f"Comune {i}" for i in rng.permutation(40)]
+    alerts = []
+    for i in range(n):
+        level = levels[int(rng.integers(4))]
+        alerts.append({
+            'comune': comuni[int(rng.integers(len(comuni)))],
+            'provincia': ['MI', 'BG', 'SO', 'CO'][int(rng.integers(4))],
+            'lat': round(float(rng.uniform(44.7, 46.6)), 4),
+            'lon': round(float(rng.uniform(8.5, 11.4)), 4),
+            'alert_level': level,
+            'alert_color': colors[level],
+            'risk_score': round(float(rng.uniform(0, 100)), 1),
+            'precipitation_mm': round(float(rng.uniform(0, 80)), 1)
+        })
+    return alerts
+
+
+def _header(raw):
+    _, _, header_len = _PREAMBLE.unpack_from(raw)
+    return json.loads(raw[_PREAMBLE.size:_PREAMBLE.size + header_len])
+
+
+def test_streaming_writer_matches_batch_encoder(tmp_path):
+    alerts = _alerts()
+    metadata, summary = {'title': 'test'}, {'total_alerts': len(alerts)}
+    batch = encode_alerts({'metadata': metadata, 'summary': summary, 'alerts': alerts})
+
+    writer = ColumnarWriter(tmp_path / 'alerts_data.bin')
+    for start in range(0, len(alerts), 64):
+        writer.append(alerts[start:start + 64])
+    writer.close(metadata, summary)
+    streamed = (tmp_path / 'alerts_data.bin').read_bytes()
+
+    assert _header(streamed) == _header(batch)
+    assert streamed == batch
+    assert not [p for p in tmp_path.iterdir() if p.name.startswith('.')]
+
+
+def test_dictionary_columns_use_numpy_dtype_strings(tmp_path):
+    writer = ColumnarWriter(tmp_path / 'alerts_data.bin')
+    writer.append(_alerts(50))
+    writer.close({}, {})
+    dtypes = {c['name']: c['dtype'] for c in _header((tmp_path / 'alerts_data.bin').read_bytes())['columns']}
+
+    # Chiavi note al decoder del frontend (arrayTypes in frontend/script.js)
+    assert dtypes['comune'] == dtypes['alert_level'] == '|u1'
+    assert set(dtypes.values()) <= {'<f4', '|u1', '<u2', '<u4'}
+
+
+def test_decode_roundtrip():
+    alerts = _alerts(120, seed=3)
+    decoded = decode_alerts(encode_alerts({'metadata': {}, 'summary': {}, 'alerts': alerts}))
+    assert decoded['alerts'] == alerts
+    assert decoded['critical_areas'] == [a for a in alerts if a['alert_level'] in ('ROSSO', 'ARANCIONE')]
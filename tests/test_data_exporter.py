@@ -0,0 +1,89 @@
+import json
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+
+from data_exporter import DataExporter
+
+TIMESTAMP = '2026-10-16T12:00:00'
+
+
+def _chunk(n, seed):
+    rng = np.random.default_rng(seed)
+    risk = rng.uniform(0, 100, n).round(1)
+    gdf = gpd.GeoDataFrame({
+        'risk_score': risk,
+        'alert_level': np.where(risk > 70, 'ROSSO', np.where(risk > 50, 'ARANCIONE', 'GIALLO')),
+        'comune': 'Sondrio',
+        'provincia': 'SO',
+        'precipitation_mm': rng.uniform(0, 50, n)
+    }, geometry=gpd.points_from_xy(rng.uniform(9, 10, n), rng.uniform(45.5, 46.5, n)), crs='EPSG:4326')
+    gdf.attrs['timestamp'] = TIMESTAMP
+    return gdf
+
+
+def _published(exporter):
+    return json.loads((exporter.output_folder / 'alerts_data.json').read_text(encoding='utf-8'))
+
+
+def test_stream_uses_prediction_timestamp_like_batch(tmp_path):
+    chunks = [_chunk(20, 1), _chunk(15, 2)]
+    merged = gpd.GeoDataFrame(pd.concat(chunks, ignore_index=True), crs='EPSG:4326')
+    merged.attrs['timestamp'] = TIMESTAMP
+    batch = DataExporter(tmp_path / 'batch')
+    batch.export_geodataframe(merged)
+    stream = DataExporter(tmp_path / 'stream')
+    stream.export_stream(iter(chunks))
+
+    assert _published(batch)['metadata']['timestamp'] == TIMESTAMP
+    assert _published(stream)['metadata']['timestamp'] == TIMESTAMP
+    assert _published(stream)['summary'] == _published(batch)['summary']
+
+
+def test_stream_saves_history_before_publishing(tmp_path):
+    exporter = DataExporter(tmp_path)
+    exporter.export_stream([_chunk(10, 1)])
+    assert exporter.snapshots.latest_version() == _published(exporter)['metadata']['snapshot_version'] == 1
+
+    def crash(version, path):
+        raise OSError("disco pieno")
+
+    exporter.snapshots.save_file = crash
+    with pytest.raises(OSError):
+        exporter.export_stream([_chunk(10, 2)])
+
+    # Lo storico non ha accettato la v2: il file pubblicato resta la v1, senza file temporanei
+    assert _published(exporter)['metadata']['snapshot_version'] == 1
+    assert not [p for p in tmp_path.iterdir() if p.name.startswith('.alerts_data.json')]
+
+    del exporter.snapshots.save_file
+    exporter.export_stream([_chunk(10, 3)])
+    assert _published(exporter)['metadata']['snapshot_version'] == 2
+    assert exporter.snapshots.load(2)['metadata']['snapshot_version'] == 2
+
+
+def test_geojson_keeps_prediction_columns(tmp_path):
+    gdf = _chunk(12, 4)
+    gdf['alert_color'] = '#ff4757'
+    gdf.insert(0, 'longitude', gdf.geometry.x)
+    gdf.insert(0, 'latitude', gdf.geometry.y)
+    # Proprietà scritte in precedenza da gdf.to_file, con il timestamp su ogni riga
+    legacy = gdf.assign(timestamp=TIMESTAMP)
+    legacy.to_file(tmp_path / 'legacy.geojson', driver='GeoJSON')
+    expected = json.loads((tmp_path / 'legacy.geojson').read_text())['features']
+    expected.sort(key=lambda f: -f['properties']['risk_score'])
+
+    batch = DataExporter(tmp_path / 'batch')
+    batch.export_geodataframe(gdf)
+    stream = DataExporter(tmp_path / 'stream')
+    stream.export_stream([gdf])
+    for exporter in (batch, stream):
+        features = json.loads((exporter.output_folder / 'current_alerts.geojson').read_text())['features']
+        assert [set(f['properties']) for f in features] == [set(f['properties']) for f in expected]
+        for feature, old in zip(features, expected):
+            assert feature['properties']['timestamp'] == TIMESTAMP
+            assert feature['properties']['latitude'] == pytest.approx(old['properties']['latitude'], abs=1e-4)
+            assert feature['properties']['comune'] == old['properties']['comune']
+            assert feature['geometry']['coordinates'] == pytest.approx(old['geometry']['coordinates'], abs=1e-4)
@@ -0,0 +1,95 @@
+import geopandas as gpd
+import joblib
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import DEM_BOUNDS
+from ml_forecast import FeatureEngineering, RiskPredictor
+from pipeline import MLPipeline
+
+
+def _events(n=40, seed=1):
+    rng = np.random.default_rng(seed)
+    west, south, east, north = DEM_BOUNDS
+    return gpd.GeoDataFrame({
+        'intensita': rng.integers(20, 100, n),
+        'data_evento': pd.Timestamp('2024-01-01') + pd.to_timedelta(rng.integers(0, 365, n), unit='D')
+    }, geometry=gpd.points_from_xy(rng.uniform(west, east, n), rng.uniform(south, north, n)), crs='EPSG:4326')
+
+
+def test_parallel_training_data_matches_serial(weather_stub, synthetic_dem, feature_config):
+    west, south, east, north = DEM_BOUNDS
+    config = {
+        'feature_engineering': feature_config,
+        'model': {'random_state': 7},
+        'prediction': {'lombardy_bounds': {'lat_min': south, 'lat_max': north, 'lon_min': west, 'lon_max': east}}
+    }
+    predictor = RiskPredictor(config)
+    predictor.feature_engineer = FeatureEngineering(config, dem_path=synthetic_dem)
+    events = _events()
+
+    X_serial, y_serial = predictor.prepare_training_data(events, n_workers=1)
+    serial_requests = weather_stub.requests
+    X_parallel, y_parallel = predictor.prepare_training_data(events, n_workers=4)
+
+    pd.testing.assert_frame_equal(X_serial, X_parallel)
+    pd.testing.assert_series_equal(y_serial, y_parallel)
+    # Il meteo viene scaricato dal processo principale in un'unica richiesta (batch da 1000),
+    # non una volta per processo o per blocco: il rate limit vale per tutto il pool
+    assert serial_requests == 1
+    assert weather_stub.requests - serial_requests == 1
+
+
+def _trained_predictor(scale_features):
+    rng = np.random.default_rng(3)
+    X = pd.DataFrame(rng.normal(size=(200, 4)) * [1, 10, 100, 1000], columns=['pendenza', 'quota', 'pioggia', 'dist'])
+    y = pd.Series(X['pendenza'] * 10 + X['quota'] + rng.normal(size=200))
+    predictor = RiskPredictor({'model': {'scale_features': scale_features,
+                                         'model_params': {'n_estimators': 20, 'max_depth': 3}}})
+    predictor.train(X, y)
+    return predictor, X.to_numpy(dtype=np.float32)
+
+
+@pytest.mark.parametrize('scale_features', [False, True])
+def test_save_load_roundtrip(tmp_path, scale_features):
+    predictor, X = _trained_predictor(scale_features)
+    predictor.save_model(str(tmp_path / 'model'))
+
+    loaded = RiskPredictor({})
+    loaded.load_model(str(tmp_path / 'model'))
+    np.testing.assert_array_equal(loaded._predict_scores(X), predictor._predict_scores(X))
+    assert loaded.feature_names_ == predictor.feature_names_
+    assert loaded.metrics_ == predictor.metrics_
+    assert (loaded.scale_mean_ is None) == (not scale_features)
+
+
+@pytest.mark.parametrize('name', ['model.ubj', 'scaler_mean.npy'])
+def test_load_rejects_checksum_mismatch(tmp_path, name):
+    predictor, _ = _trained_predictor(scale_features=True)
+    predictor.save_model(str(tmp_path / 'model'))
+    with open(tmp_path / 'model' / name, 'r+b') as f:
+        f.seek(-1, 2)
+        last = f.read(1)
+        f.seek(-1, 2)
+        f.write(bytes([last[0] ^ 0xFF]))
+
+    with pytest.raises(ValueError, match='Checksum'):
+        RiskPredictor({}).load_model(str(tmp_path / 'model'))
+
+
+def test_legacy_pickle_is_converted(tmp_path):
+    predictor, X = _trained_predictor(scale_features=True)
+    joblib.dump({'model': predictor.model, 'scaler': predictor.scaler, 'features': predictor.feature_names_},
+                tmp_path / 'model.pkl')
+
+    pipeline = object.__new__(MLPipeline)
+    pipeline.predictor = RiskPredictor({})
+    assert pipeline._find_model(tmp_path / 'model') == tmp_path / 'model'
+    assert (tmp_path / 'model' / 'manifest.json').is_file()
+
+    converted = RiskPredictor({})
+    converted.load_model(str(tmp_path / 'model'))
+    np.testing.assert_allclose(converted._predict_scores(X), predictor._predict_scores(X), rtol=1e-6)
+    assert converted.feature_names_ == predictor.feature_names_
+    assert pipeline._find_model(tmp_path / 'missing') is None
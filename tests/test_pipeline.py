@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from pipeline import MLPipeline
+from prediction_grid import grid_axes
+
+
+class HotCornerPredictor:
+    "Punteggio 100 nel quadrato [0, 1) x [0, 1), 0 altrove; registra i punti valutati per livello."
+
+    def __init__(self):
+        self.levels = []
+
+    def predict_iter(self, coords, chunk_size=None):
+        self.levels.append(coords)
+        hot = (coords[:, 0] < 1) & (coords[:, 1] < 1)
+        yield pd.DataFrame({'risk_score': np.where(hot, 100.0, 0.0)})
+
+
+def _adaptive_pipeline(min_resolution_deg=0.25):
+    pipeline = object.__new__(MLPipeline)
+    pipeline.config = {'ml_params': {'prediction': {
+        'grid_resolution_deg': 0.5,
+        'min_risk_score_threshold': 50,
+        'lombardy_bounds': {'lat_min': 0.0, 'lat_max': 4.0, 'lon_min': 0.0, 'lon_max': 4.0},
+        'adaptive_refinement': {'enabled': True, 'coarse_resolution_deg': 1.0,
+                                'min_resolution_deg': min_resolution_deg, 'score_margin': 10}
+    }}}
+    pipeline.predictor = HotCornerPredictor()
+    return pipeline
+
+
+def test_refinement_only_subdivides_near_threshold_cells_and_neighbours():
+    pipeline = _adaptive_pipeline()
+    coords, rows, cols = pipeline._adaptive_grid_points()
+
+    level0, level1 = pipeline.predictor.levels
+    # Livello 0: tutte le 16 celle da 1°; solo la cella (0, 0) è sopra soglia,
+    # quindi vengono suddivise lei e le sue 3 vicine dentro i limiti
+    assert len(level0) == 16
+    assert len(level1) == 16 and level1.max() < 2
+    # Livello 1: le celle sopra soglia sono in [0, 1)², le vicine arrivano a 1.5
+    assert len(coords) == 36
+    np.testing.assert_array_equal(np.unique(coords[:, 0]), np.arange(0.125, 1.5, 0.25))
+    np.testing.assert_array_equal(np.unique(coords[:, 1]), np.arange(0.125, 1.5, 0.25))
+
+
+def test_refined_points_are_nodes_of_the_static_grid():
+    pipeline = _adaptive_pipeline(min_resolution_deg=0.3)  # passo effettivo 0.25 = 1° / 2**2
+    coords, rows, cols = pipeline._adaptive_grid_points()
+    lats, lons, res = grid_axes(pipeline.config['ml_params']['prediction'])
+
+    assert res == 0.25 and len(lats) == len(lons) == 16
+    # Stesse coordinate: feature statiche e tabella dei comuni si leggono per indice
+    np.testing.assert_array_equal(lats[rows], coords[:, 0])
+    np.testing.assert_array_equal(lons[cols], coords[:, 1])
+
+
+@pytest.mark.parametrize('enabled, expected', [(False, (8, 0.0, 3.5)), (True, (16, 0.125, 3.875))])
+def test_grid_axes(enabled, expected):
+    config = _adaptive_pipeline().config['ml_params']['prediction']
+    config['adaptive_refinement']['enabled'] = enabled
+    lats, lons, res = grid_axes(config)
+    assert (len(lats), lats[0], lats[-1]) == expected
+    np.testing.assert_array_equal(lats, lons)
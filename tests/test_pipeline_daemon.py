@@ -0,0 +1,105 @@
+import fcntl
+import os
+import threading
+
+import pytest
+
+from pipeline_daemon import PipelineDaemon, RunLock
+
+
+class StubPipeline:
+    "Pipeline finto: registra le esecuzioni e fallisce quelle indicate."
+
+    def __init__(self, fail_on=(), on_run=None):
+        self.calls = []
+        self.data = {}
+        self.fail_on = set(fail_on)
+        self.on_run = on_run
+
+    def run(self, refresh=False):
+        self.calls.append(refresh)
+        self.data['predictions'] = object()
+        if self.on_run:
+            self.on_run(len(self.calls))
+        if len(self.calls) in self.fail_on:
+            raise RuntimeError('esecuzione fallita')
+
+
+@pytest.fixture
+def lock(tmp_path):
+    return RunLock(tmp_path / 'pipeline.lock')
+
+
+def test_lock_is_exclusive_across_threads(lock):
+    assert lock.acquire(blocking=False)
+    result = []
+    worker = threading.Thread(target=lambda: result.append(lock.acquire(blocking=False)))
+    worker.start()
+    worker.join()
+    assert result == [False]
+    lock.release()
+    assert lock.acquire(blocking=False)
+    lock.release()
+
+
+def test_lock_is_exclusive_across_file_descriptors(lock):
+    with lock:
+        assert lock.path.read_text() == str(os.getpid())
+        # Un altro processo apre il proprio descrittore sullo stesso file
+        other = RunLock(lock.path)
+        assert not other.acquire(blocking=False)
+        with open(lock.path) as f, pytest.raises(BlockingIOError):
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    assert other.acquire(blocking=False)
+    other.release()
+
+
+def test_run_once_skips_when_locked(lock):
+    pipeline = StubPipeline()
+    daemon = PipelineDaemon(pipeline, interval_s=3600, lock=lock)
+    with RunLock(lock.path):
+        assert not daemon.run_once()
+    assert pipeline.calls == []
+    assert daemon.run_once() and pipeline.calls == [False]
+
+
+def test_refresh_after_first_run_and_failures_do_not_stop_loop(lock):
+    pipeline = StubPipeline(fail_on={2})
+    daemon = PipelineDaemon(pipeline, interval_s=0, lock=lock)
+    daemon.run_forever(max_runs=4)
+
+    # La seconda esecuzione fallisce ma il ciclo continua; solo la prima è completa
+    assert pipeline.calls == [False, True, True, True]
+    assert (daemon.runs, daemon.failures) == (3, 1)
+    assert 'predictions' not in pipeline.data
+    assert lock.acquire(blocking=False)
+    lock.release()
+
+
+def test_failed_first_run_is_retried_in_full(lock):
+    pipeline = StubPipeline(fail_on={1})
+    PipelineDaemon(pipeline, interval_s=0, lock=lock).run_forever(max_runs=2)
+    assert pipeline.calls == [False, False]
+
+
+def test_triggers_during_a_run_are_coalesced(lock):
+    second_run = threading.Event()
+
+    def trigger_many(n):
+        if n == 1:
+            for _ in range(5):
+                daemon.trigger()
+        else:
+            second_run.set()
+
+    pipeline = StubPipeline(on_run=trigger_many)
+    daemon = PipelineDaemon(pipeline, interval_s=3600, lock=lock)
+    loop = threading.Thread(target=daemon.run_forever)
+    loop.start()
+    # Prima esecuzione immediata, poi una sola per i cinque trigger
+    assert second_run.wait(timeout=5)
+    threading.Event().wait(0.2)
+    daemon.stop()
+    loop.join(timeout=5)
+    assert not loop.is_alive()
+    assert pipeline.calls == [False, True]
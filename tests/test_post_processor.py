@@ -0,0 +1,107 @@
+import geopandas as gpd
+import numpy as np
+import pytest
+from shapely.geometry import Polygon, box
+
+from post_processor import PredictionPostProcessor
+from prediction_grid import grid_axes
+
+BOUNDS = {'lat_min': 45.0, 'lat_max': 46.0, 'lon_min': 9.0, 'lon_max': 10.0}
+
+
+def _write_comuni(path, names=('Ovest', 'Nord-Est', 'Sud-Est')):
+    "Tre comuni con confini obliqui che non passano per i nodi della griglia."
+    geometries = [
+        box(8.9, 44.9, 9.537, 46.1),
+        Polygon([(9.537, 45.43), (10.1, 45.61), (10.1, 46.1), (9.537, 46.1)]),
+        Polygon([(9.537, 44.9), (10.1, 44.9), (10.1, 45.61), (9.537, 45.43)]),
+    ]
+    gpd.GeoDataFrame({'COMUNE': list(names), 'SIGLA': ['AA', 'BB', 'BB']},
+                     geometry=geometries, crs='EPSG:4326').to_file(path, driver='GeoJSON')
+
+
+def _processor(tmp_path, adaptive=False):
+    return PredictionPostProcessor({
+        'post_processing': {'comuni_boundaries': {'path': str(tmp_path / 'comuni.geojson')}},
+        'ml_params': {'prediction': {
+            'grid_resolution_deg': 0.1, 'lombardy_bounds': BOUNDS,
+            'adaptive_refinement': {'enabled': adaptive, 'coarse_resolution_deg': 0.4, 'min_resolution_deg': 0.05}
+        }},
+        'project_paths': {'processed_data': str(tmp_path / 'processed')}
+    })
+
+
+def _sjoin_names(path, lons, lats):
+    points = gpd.GeoDataFrame(geometry=gpd.points_from_xy(lons, lats), crs='EPSG:4326')
+    joined = gpd.sjoin(points, gpd.read_file(path), predicate='within', how='left')
+    return joined['COMUNE'].to_numpy()
+
+
+def _spy_locate(processor):
+    "Registra quanti punti passano dall'indice spaziale."
+    calls, locate = [], processor._locate
+
+    def spy(lons, lats):
+        calls.append(len(lons))
+        return locate(lons, lats)
+    processor._locate = spy
+    return calls
+
+
+@pytest.fixture
+def comuni_path(tmp_path):
+    _write_comuni(tmp_path / 'comuni.geojson')
+    return tmp_path / 'comuni.geojson'
+
+
+@pytest.mark.parametrize('adaptive', [False, True])
+def test_grid_points_match_sjoin(tmp_path, comuni_path, adaptive):
+    processor = _processor(tmp_path, adaptive)
+    lookup = processor._load_grid_lookup()
+    lats, lons, _ = grid_axes(processor.prediction_config)
+    np.testing.assert_array_equal(lookup['lats'], lats)
+
+    lat_grid, lon_grid = np.meshgrid(lats, lons, indexing='ij')
+    located = _spy_locate(processor)
+    # Coordinate arrotondate a float32 come nelle predizioni
+    codes = processor._comune_codes(lon_grid.ravel().astype(np.float32).astype(np.float64),
+                                    lat_grid.ravel().astype(np.float32).astype(np.float64))
+
+    assert located == []  # tutti i punti letti dalla tabella
+    names = processor._comuni['comune'].to_numpy()[codes]
+    np.testing.assert_array_equal(names, _sjoin_names(comuni_path, lon_grid.ravel(), lat_grid.ravel()))
+    assert set(names) == {'Ovest', 'Nord-Est', 'Sud-Est'}
+
+
+def test_off_grid_points_use_spatial_index(tmp_path, comuni_path):
+    processor = _processor(tmp_path)
+    processor._load_grid_lookup()
+    located = _spy_locate(processor)
+
+    # Due punti fuori dai nodi, uno sul nodo, uno fuori dalla griglia e dai poligoni
+    lats = np.array([45.05, 45.77, 45.5, 45.5])
+    lons = np.array([9.93, 9.21, 9.6, 10.5])
+    codes = processor._comune_codes(lons, lats)
+
+    assert located == [3]
+    names = list(processor._comuni['comune'].to_numpy()[codes])
+    assert names[:3] == list(_sjoin_names(comuni_path, lons[:3], lats[:3]))
+    assert names[3] in ('Nord-Est', 'Sud-Est')  # il più vicino
+
+
+def test_lookup_is_reused_and_rebuilt_when_boundaries_change(tmp_path, comuni_path):
+    _processor(tmp_path)._load_grid_lookup()
+    [saved] = (tmp_path / 'processed').glob('comuni_lookup_*.npz')
+
+    reused = _processor(tmp_path)
+    reused._load_comuni()
+    located = _spy_locate(reused)
+    reused._load_grid_lookup()
+    assert located == []  # tabella letta dal file, non ricalcolata
+
+    _write_comuni(comuni_path, names=('Est', 'Ovest', 'Centro'))
+    rebuilt = _processor(tmp_path)
+    codes = rebuilt._comune_codes(np.array([9.2]), np.array([45.5]))
+    assert rebuilt._comuni['comune'].to_numpy()[codes][0] == 'Est'
+    [new] = (tmp_path / 'processed').glob('comuni_lookup_*.npz')
+    assert new != saved
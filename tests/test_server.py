@@ -0,0 +1,234 @@
+import gzip
+import json
+import math
+import re
+
+import geopandas as gpd
+import numpy as np
+import pytest
+
+import server
+from alerts_cache import BROTLI_AVAILABLE, TILE_CLUSTER_MAX_ZOOM, AlertsCache, ColumnarSnapshot
+from data_exporter import DataExporter
+from metrics import RunMetrics
+from risk_surface import RiskSurfaceWriter
+from snapshot_store import SnapshotStore
+
+# (lat, lon, livello, rischio): due allerte vicine a Sondrio, le altre sparse
+ALERTS = [
+    (46.1700, 9.8700, 'ROSSO', 85.0),
+    (46.1710, 9.8710, 'ARANCIONE', 60.0),
+    (45.8100, 9.0800, 'GIALLO', 40.0),
+    (45.7000, 9.6700, 'GIALLO', 35.0),
+    (45.4600, 9.1900, 'VERDE', 10.0),
+]
+
+
+def _gdf(alerts):
+    lats, lons, levels, risk = zip(*alerts)
+    return gpd.GeoDataFrame({'alert_level': levels, 'risk_score': risk, 'comune': 'Test', 'provincia': 'SO'},
+                            geometry=gpd.points_from_xy(lons, lats), crs='EPSG:4326')
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    "Cartella dati isolata: cache, storico, superficie e report del server puntano qui."
+    monkeypatch.setattr(server, 'alerts_cache', AlertsCache(tmp_path / 'alerts_data.json'))
+    monkeypatch.setattr(server, 'columnar_cache',
+                        AlertsCache(tmp_path / 'alerts_data.bin', snapshot_cls=ColumnarSnapshot))
+    monkeypatch.setattr(server, 'snapshot_store', SnapshotStore(tmp_path / 'snapshots'))
+    monkeypatch.setattr(server, 'RISK_SURFACE_FILE', tmp_path / 'risk_surface.tif')
+    monkeypatch.setattr(server, 'RUN_REPORT_FILE', tmp_path / 'run_report.json')
+    return tmp_path
+
+
+@pytest.fixture
+def exporter(data_dir):
+    return DataExporter(data_dir, keep_versions=2)
+
+
+@pytest.fixture
+def client(exporter):
+    exporter.export_geodataframe(_gdf(ALERTS))
+    return server.app.test_client()
+
+
+def _tile(lat, lon, z):
+    n = 2 ** z
+    x = int((lon + 180) / 360 * n)
+    y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)
+    return x, y
+
+
+# --- istantanea, ETag e compressione ---
+
+def test_etag_and_not_modified(client):
+    first = client.get('/api/alerts')
+    assert first.status_code == 200 and first.headers['ETag']
+    assert first.json['summary']['total'] == len(ALERTS)
+
+    again = client.get('/api/alerts', headers={'If-None-Match': first.headers['ETag']})
+    assert again.status_code == 304 and again.data == b''
+
+
+@pytest.mark.parametrize('accept, encoding', [
+    ('gzip', 'gzip'),
+    ('identity', None),
+    pytest.param('br, gzip', 'br', marks=pytest.mark.skipif(not BROTLI_AVAILABLE, reason='brotli non installato')),
+])
+def test_content_encoding_negotiation(client, accept, encoding):
+    response = client.get('/api/alerts', headers={'Accept-Encoding': accept})
+    assert response.headers.get('Content-Encoding') == encoding
+    assert 'Accept-Encoding' in response.headers['Vary']
+    body = response.data
+    if encoding == 'gzip':
+        body = gzip.decompress(body)
+    elif encoding == 'br':
+        import brotli
+        body = brotli.decompress(body)
+    assert json.loads(body)['summary']['total'] == len(ALERTS)
+
+
+def test_columnar_snapshot_etag(client):
+    response = client.get('/api/alerts/columnar')
+    assert response.status_code == 200 and response.data[:4] == b'GRSK'
+    assert client.get('/api/alerts/columnar',
+                      headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+
+
+# --- filtri ---
+
+def test_bbox_level_and_score_filters(client):
+    near_sondrio = client.get('/api/alerts?bbox=9.8,46.1,9.9,46.2').json
+    assert [a['risk_score'] for a in near_sondrio['alerts']] == [85.0, 60.0]
+    assert near_sondrio['summary'] == {'total': 2, 'red': 1, 'orange': 1, 'yellow': 0, 'green': 0}
+
+    gialli = client.get('/api/alerts?level=giallo').json
+    assert {a['alert_level'] for a in gialli['alerts']} == {'GIALLO'} and gialli['summary']['total'] == 2
+
+    assert [a['risk_score'] for a in client.get('/api/alerts?min_score=40').json['alerts']] == [85.0, 60.0, 40.0]
+
+
+def test_pagination(client):
+    page = client.get('/api/alerts?limit=2&offset=1').json
+    assert [a['risk_score'] for a in page['alerts']] == [60.0, 40.0]
+    assert page['pagination'] == {'total': len(ALERTS), 'offset': 1, 'limit': 2, 'returned': 2}
+
+    first = client.get('/api/alerts?limit=2&offset=1')
+    assert client.get('/api/alerts?limit=2&offset=1',
+                      headers={'If-None-Match': first.headers['ETag']}).status_code == 304
+
+
+@pytest.mark.parametrize('query', [
+    'bbox=1,2,3', 'bbox=10,45,9,46', 'bbox=a,b,c,d', 'level=VIOLA', 'min_score=alto',
+    'limit=-1', 'offset=-2', 'since=1&level=ROSSO', 'since=-1', 'since=ieri'
+])
+def test_invalid_queries_return_400(client, query):
+    response = client.get(f'/api/alerts?{query}')
+    assert response.status_code == 400
+    assert 'error' in response.json
+
+
+# --- differenze ?since= ---
+
+def test_since_returns_delta(client, exporter):
+    changed = list(ALERTS)
+    changed[2] = (45.81, 9.08, 'ARANCIONE', 55.0)
+    exporter.export_geodataframe(_gdf(changed[:-1]))
+
+    delta = client.get('/api/alerts?since=1').json
+    assert delta['type'] == 'delta' and (delta['from_version'], delta['to_version']) == (1, 2)
+    assert [a['risk_score'] for a in delta['changed']] == [55.0]
+    assert delta['removed'] == [{'lat': 45.46, 'lon': 9.19}]
+    assert delta['added'] == []
+
+    current = client.get('/api/alerts?since=2').json
+    assert current['added'] == current['changed'] == current['removed'] == []
+
+
+def test_since_outside_history_falls_back_to_full_snapshot(client, exporter):
+    for score in (50.0, 55.0):
+        exporter.export_geodataframe(_gdf(ALERTS[:-1] + [(45.46, 9.19, 'GIALLO', score)]))
+    # keep_versions=2: la v1 non è più nello storico
+    assert exporter.snapshots.versions() == [2, 3]
+
+    response = client.get('/api/alerts?since=1')
+    assert response.status_code == 200
+    assert 'type' not in response.json and response.json['metadata']['snapshot_version'] == 3
+    assert response.headers['ETag'] == client.get('/api/alerts').headers['ETag']
+
+
+# --- tile ---
+
+def test_tiles_switch_from_clusters_to_alerts(client):
+    lat, lon = ALERTS[0][:2]
+    z = TILE_CLUSTER_MAX_ZOOM
+    clusters = client.get('/api/tiles/{}/{}/{}'.format(z, *_tile(lat, lon, z))).json
+    assert clusters['type'] == 'clusters'
+    [cluster] = clusters['features']
+    assert cluster['count'] == 2 and cluster['alert_level'] == 'ROSSO'
+    assert cluster['levels'] == {'ROSSO': 1, 'ARANCIONE': 1} and cluster['max_risk'] == 85.0
+
+    alerts = client.get('/api/tiles/{}/{}/{}'.format(z + 1, *_tile(lat, lon, z + 1))).json
+    assert alerts['type'] == 'alerts'
+    assert {a['risk_score'] for a in alerts['features']} == {85.0, 60.0}
+
+    assert client.get('/api/tiles/3/8/0').status_code == 400
+
+
+# --- superficie di rischio ---
+
+@pytest.fixture
+def risk_surface(data_dir):
+    writer = RiskSurfaceWriter(server.RISK_SURFACE_FILE, (9.0, 45.0, 10.0, 46.0), 0.125, block_size=16)
+    lats, lons = np.meshgrid(np.arange(45.0625, 46, 0.125), np.arange(9.0625, 10, 0.125), indexing='ij')
+    writer.add(lats.ravel(), lons.ravel(), (lons.ravel() - 9) * 100)  # il rischio cresce verso est
+    writer.close()
+    return server.RISK_SURFACE_FILE
+
+
+def test_risk_surface_window(client, risk_surface):
+    window = client.get('/api/risk-surface?bbox=9.0,45.0,9.5,45.5&width=2&height=2').json
+    assert window['bbox'] == [9.0, 45.0, 9.5, 45.5]
+    # Media dei pixel di ogni metà: 9.0625..9.1875 -> 12.5, 9.3125..9.4375 -> 37.5
+    assert window['values'] == [[12.5, 37.5], [12.5, 37.5]]
+
+
+def test_risk_surface_f32_and_clipping(client, risk_surface):
+    response = client.get('/api/risk-surface?bbox=9.5,45.5,11,47&width=4&height=2&format=f32')
+    assert response.status_code == 200
+    assert response.headers['X-Bbox'] == '9.500000,45.500000,10.000000,46.000000'
+    values = np.frombuffer(response.data, dtype='<f4').reshape(2, 4)
+    assert np.all(np.diff(values, axis=1) > 0)
+
+
+def test_risk_surface_ignores_alert_filters(client, risk_surface):
+    # Parametri delle allerte non pertinenti per il raster: nessun 400
+    response = client.get('/api/risk-surface?bbox=9,45,10,46&width=2&height=2&level=VIOLA&limit=-1')
+    assert response.status_code == 200
+    for query in ('bbox=9,45,10', 'width=0', 'format=png', 'bbox=20,10,21,11'):
+        assert client.get(f'/api/risk-surface?{query}').status_code == 400
+
+
+# --- /metrics ---
+
+PROMETHEUS_LINE = re.compile(r'^(# (HELP|TYPE) \w+ .+|\w+(\{(\w+="[^"]*",?)*\})? -?(\d+(\.\d+)?|\+Inf))$')
+
+
+def test_metrics_text_format(client):
+    run = RunMetrics()
+    with run.phase('predizione'):
+        pass
+    run.finish()
+    run.save(server.RUN_REPORT_FILE)
+    client.get('/api/alerts?level=ROSSO')
+
+    response = client.get('/metrics')
+    assert response.mimetype == 'text/plain'
+    assert 'version=0.0.4' in response.headers['Content-Type']
+    lines = response.get_data(as_text=True).splitlines()
+    assert all(PROMETHEUS_LINE.match(line) for line in lines), [l for l in lines if not PROMETHEUS_LINE.match(l)]
+    assert 'georisk_run_success 1' in lines
+    assert any(line.startswith('georisk_run_phase_duration_seconds{phase="predizione"}') for line in lines)
+    assert ('georisk_http_request_duration_seconds_count'
+            '{endpoint="/api/alerts",method="GET",status="200"} ') in '\n'.join(lines)
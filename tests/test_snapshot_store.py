@@ -0,0 +1,40 @@
+import os
+import stat
+
+import pytest
+
+import snapshot_store
+from snapshot_store import atomic_write, compute_delta
+
+
+def _mode(path):
+    return stat.S_IMODE(path.stat().st_mode)
+
+
+@pytest.mark.skipif(not hasattr(os, 'fchmod'), reason="permessi POSIX")
+def test_atomic_write_uses_open_permissions(tmp_path, monkeypatch):
+    monkeypatch.setattr(snapshot_store, '_UMASK', 0o022)
+    path = tmp_path / 'alerts_data.json'
+    atomic_write(path, b'{}')
+    assert path.read_bytes() == b'{}'
+    assert _mode(path) == 0o644
+    assert list(tmp_path.iterdir()) == [path]
+
+
+@pytest.mark.skipif(not hasattr(os, 'fchmod'), reason="permessi POSIX")
+def test_atomic_write_keeps_mode_of_replaced_file(tmp_path):
+    path = tmp_path / 'alerts_data.bin'
+    path.write_bytes(b'old')
+    path.chmod(0o640)
+    atomic_write(path, b'new')
+    assert path.read_bytes() == b'new'
+    assert _mode(path) == 0o640
+
+
+def test_compute_delta():
+    old = [{'lat': 45.0, 'lon': 9.0, 'risk_score': 10}, {'lat': 45.1, 'lon': 9.1, 'risk_score': 20}]
+    new = [{'lat': 45.0, 'lon': 9.0, 'risk_score': 15}, {'lat': 45.2, 'lon': 9.2, 'risk_score': 30}]
+    delta = compute_delta(old, new)
+    assert delta['added'] == [new[1]]
+    assert delta['changed'] == [new[0]]
+    assert delta['removed'] == [{'lat': 45.1, 'lon': 9.1}]
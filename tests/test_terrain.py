@@ -0,0 +1,55 @@
+import geopandas as gpd
+import numpy as np
+import pytest
+import rasterio
+from rasterio.mask import mask
+from rasterio.transform import from_bounds
+from shapely.geometry import mapping
+
+from conftest import DEM_BOUNDS
+from ml_forecast import TerrainSampler
+
+
+def _reference(dem_path, lat, lon, buffer_m):
+    "Estrazione per-punto originale: buffer in UTM 32N, rasterio.mask con all_touched."
+    with rasterio.open(dem_path) as dem:
+        buffer = gpd.GeoSeries(gpd.points_from_xy([lon], [lat]), crs='EPSG:4326') \
+            .to_crs('EPSG:32632').buffer(buffer_m).to_crs(dem.crs)
+        image, _ = mask(dem, shapes=[mapping(g) for g in buffer], crop=True, all_touched=True)
+        values = image[0][image[0] != dem.nodata].astype(np.float64)
+    return values.mean(), values.std()
+
+
+@pytest.mark.parametrize('buffer_m', [500, 2000])
+def test_elevation_stats_match_rasterio_mask(synthetic_dem, buffer_m):
+    rng = np.random.default_rng(5)
+    west, south, east, north = DEM_BOUNDS
+    # Punti a nord del blocco di nodata del DEM sintetico
+    lats = rng.uniform(south + 0.15, north - 0.05, 25)
+    lons = rng.uniform(west + 0.05, east - 0.05, 25)
+
+    features = TerrainSampler(synthetic_dem, buffer_m).sample(lats, lons)
+    reference = np.array([_reference(synthetic_dem, lat, lon, buffer_m) for lat, lon in zip(lats, lons)])
+
+    np.testing.assert_allclose(features['elevation_mean'], reference[:, 0], atol=3.0)
+    np.testing.assert_allclose(features['elevation_std'], reference[:, 1], atol=5.0)
+
+
+def test_slope_and_roughness_on_a_plane(tmp_path):
+    # Piano inclinato: gradiente costante (3 m per riga, 4 m per colonna), nessuna rugosità
+    height, width = 60, 80
+    rows, cols = np.mgrid[0:height, 0:width]
+    path = tmp_path / 'plane.tif'
+    with rasterio.open(path, 'w', driver='GTiff', height=height, width=width, count=1, dtype='float32',
+                       crs='EPSG:4326', transform=from_bounds(9.0, 45.9, 9.08, 45.96, width, height)) as dst:
+        dst.write((500 + 3 * rows + 4 * cols).astype(np.float32), 1)
+
+    features = TerrainSampler(path, 300).sample([45.93], [9.04])
+    assert features['slope_mean'][0] == pytest.approx(5.0)
+    assert features['roughness'][0] == pytest.approx(0.0, abs=1e-6)
+
+
+def test_too_few_pixels_returns_nan(synthetic_dem):
+    # Centro del blocco di nodata del DEM sintetico: meno di MIN_PIXELS pixel validi
+    features = TerrainSampler(synthetic_dem, 100).sample([45.8 + 0.4 * 40 / 200], [9.0 + 0.6 * 40 / 300])
+    assert np.isnan(features['elevation_mean'][0])
@@ -0,0 +1,121 @@
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+import weather_client
+from ml_forecast import WEATHER_FALLBACK, FeatureEngineering
+from weather_client import WeatherFeatureCache, WeatherFetchEngine
+from weather_stub import daily_precipitation
+
+LATS = [45.81, 45.9, 46.0, 46.1, 46.2, 46.3, 46.4]
+LONS = [9.1, 9.2, 9.3, 9.4, 9.5, 9.6, 9.7]
+
+
+def _expected(lat, lon, past=7, forecast=3):
+    precip = daily_precipitation(float(f"{lat:.4f}"), float(f"{lon:.4f}"), past + forecast)
+    return {
+        'precip_1d_past': precip[past - 1],
+        'precip_3d_past': sum(precip[past - 3:past]),
+        'precip_7d_past': sum(precip[:past]),
+        'precip_3d_forecast': sum(precip[past:])
+    }
+
+
+def _feature_engineering(feature_config, **overrides):
+    return FeatureEngineering({'feature_engineering': {**feature_config, **overrides}})
+
+
+def test_batches_map_back_to_points(weather_stub, feature_config):
+    # 7 località in blocchi da 3: l'ultimo blocco ha una sola coordinata (risposta oggetto)
+    fe = _feature_engineering(feature_config, weather_batch_size=3)
+    results = fe.extract_weather_features_batch(LATS, LONS)
+
+    assert weather_stub.requests == 3
+    for lat, lon, features in zip(LATS, LONS, results):
+        assert features == pytest.approx(_expected(lat, lon))
+
+
+def test_retry_after_is_honoured_on_429(weather_stub):
+    engine = WeatherFetchEngine(max_retries=2, backoff_base_s=0.01, rate_limit_per_sec=0)
+    weather_stub.fail_next(429, retry_after=1)
+    params = {'latitude': '45.9', 'longitude': '9.2'}
+
+    start = time.perf_counter()
+    [data] = engine.fetch_all(weather_stub.url, [params])
+
+    assert time.perf_counter() - start >= 1.0
+    assert data['daily']['precipitation_sum'][:7] == daily_precipitation(45.9, 9.2, 10)[:7]
+    assert engine.retries == 1
+    assert engine.stats()['failures'] == 1
+    assert weather_stub.requests == 2
+
+
+def test_5xx_backoff_then_failure_uses_fallback(weather_stub, feature_config):
+    fe = _feature_engineering(feature_config, weather_fetch={
+        'max_retries': 2, 'backoff_base_s': 0.01, 'rate_limit_per_sec': 0})
+    weather_stub.fail_next(503, times=3)
+
+    results = fe.extract_weather_features_batch(LATS[:2], LONS[:2])
+
+    assert results == [WEATHER_FALLBACK, WEATHER_FALLBACK]
+    assert weather_stub.requests == 3
+    assert fe.weather_engine.retries == 2
+
+
+def test_client_errors_are_not_retried(weather_stub):
+    engine = WeatherFetchEngine(max_retries=3, backoff_base_s=0.01, rate_limit_per_sec=0)
+    weather_stub.fail_next(400)
+    assert engine.fetch_all(weather_stub.url, [{'latitude': '45.9', 'longitude': '9.2'}]) == [None]
+    assert engine.retries == 0
+    assert weather_stub.requests == 1
+
+
+def test_invalid_location_falls_back_per_point(weather_stub, feature_config):
+    fe = _feature_engineering(feature_config)
+    weather_stub.invalid_lat_above = 46.25
+
+    results = fe.extract_weather_features_batch(LATS, LONS)
+
+    assert weather_stub.requests == 1
+    for lat, lon, features in zip(LATS, LONS, results):
+        if lat > 46.25:
+            assert features == WEATHER_FALLBACK
+        else:
+            assert features == pytest.approx(_expected(lat, lon))
+
+
+def test_feature_cache_shares_cells_within_the_forecast_hour():
+    cache = WeatherFeatureCache(resolution_deg=0.05, ttl_s=7200)
+    now = datetime(2026, 10, 16, 10, 5)
+    key = cache.key(45.901, 9.199, now)
+    assert cache.key(45.899, 9.201, now + timedelta(minutes=50)) == key
+    assert cache.get(key) is None
+
+    cache.put(key, {'precip_1d_past': 1.0})
+    assert cache.get(key) == {'precip_1d_past': 1.0}
+    # Ora successiva: stessa cella, chiave diversa, anche con voci più giovani del TTL
+    assert cache.get(cache.key(45.901, 9.199, now + timedelta(minutes=56))) is None
+    assert cache.stats()['hits'] == 1
+
+
+class _Clock(datetime):
+    "datetime con `now()` controllato dal test."
+    current = None
+
+    @classmethod
+    def now(cls, tz=None):
+        return cls.current
+
+
+def test_next_hour_refetches_weather(weather_stub, feature_config, monkeypatch):
+    monkeypatch.setattr(weather_client, 'datetime', _Clock)
+    fe = _feature_engineering(feature_config, weather_cache={'enabled': True, 'ttl_s': 7200})
+
+    # Stessa ora: la seconda esecuzione usa la cache; ora successiva: nuova richiesta
+    for when, expected_requests in [(datetime(2026, 10, 16, 10, 1), 1),
+                                    (datetime(2026, 10, 16, 10, 40), 1),
+                                    (datetime(2026, 10, 16, 11, 1), 2)]:
+        _Clock.current = when
+        fe.extract_weather_features_batch(LATS[:1], LONS[:1])
+        assert weather_stub.requests == expected_requests